@@ -1,14 +1,23 @@
+import sys
 from flask import Flask
 from flask_restful import Api
 from typing import List
 
-from SCIM.helpers import config
+from SCIM.helpers import config, logger, BULK_SUPPORTED
 
 BACKEND_TYPE: str = config['General']['backend_type'].lower()
 # init this to False, read from config if the backend is a DB
 LOCAL_DATABASE = False
 APP_SCHEMA: str = config['Okta']['schema']
 USERNAME_FIELD: str = config['Okta']['username_field']
+# relationship loading strategies the backends can use when building SCIM objects
+# 'selectin' - one extra SELECT ... WHERE id IN (...) per relationship no matter how many rows (best for lists)
+# 'joined' - LEFT OUTER JOINs in the same query (best for single object lookups)
+# 'lazy' - one SELECT per relationship access, N+1 queries for lists
+LOAD_STRATEGIES: List[str] = ['selectin', 'joined', 'lazy']
+# init these to the defaults, read from config if the backend is a DB
+LIST_LOAD_STRATEGY = 'selectin'
+GET_LOAD_STRATEGY = 'joined'
 
 app: Flask = Flask(__name__)
 app.logger.handlers.clear()
@@ -18,12 +27,25 @@ if BACKEND_TYPE == 'database':
     from flask_sqlalchemy import SQLAlchemy
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     LOCAL_DATABASE = config['Database']['local'].lower() == 'true'
+    LIST_LOAD_STRATEGY = config['Database'].get('list_load_strategy', LIST_LOAD_STRATEGY).lower() or LIST_LOAD_STRATEGY
+    GET_LOAD_STRATEGY = config['Database'].get('get_load_strategy', GET_LOAD_STRATEGY).lower() or GET_LOAD_STRATEGY
+    for load_strategy in [LIST_LOAD_STRATEGY, GET_LOAD_STRATEGY]:
+        if load_strategy not in LOAD_STRATEGIES:
+            logger.error('The load strategy %s is not one of %s' % (load_strategy, LOAD_STRATEGIES))
+            sys.exit(1)
+    from SCIM.classes.implementation.database.routing import REPLICA_HOSTS, REPLICA_BINDS, RoutingSQLAlchemy
     if LOCAL_DATABASE:
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///example.db'
     else:
         # https://docs.sqlalchemy.org/en/14/core/engines.html#database-urls
-        app.config['SQLALCHEMY_DATABASE_URI'] = '%s://%s:%s@%s/%s' % (config['Database']['dialect_driver_string'], config['Database']['username'], config['Database']['password'], config['Database']['host'], config['Database']['database'])
-    db = SQLAlchemy(app)
+        database_uri = lambda host: '%s://%s:%s@%s/%s' % (config['Database']['dialect_driver_string'], config['Database']['username'], config['Database']['password'], host, config['Database']['database'])
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_uri(config['Database']['host'])
+        # the read replicas are binds without any tables, reads are routed to them by RoutingSession
+        app.config['SQLALCHEMY_BINDS'] = {bind: database_uri(host) for bind, host in zip(REPLICA_BINDS, REPLICA_HOSTS)}
+        # every worker process has its own pool, sized and tuned by the pool settings in [Database]
+        from SCIM.classes.implementation.database.pool import engine_options
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(config['Database'])
+    db = RoutingSQLAlchemy(app) if REPLICA_BINDS else SQLAlchemy(app)
 
 possible_provisioning_features = config['SCIM Features'].keys()
 SUPPORTED_PROVISIONING_FEATURES: List[str] = []
@@ -50,10 +72,22 @@ groups_features = [
 ]
 group_specific_features = ['GROUP_PUSH']
 
-from SCIM.endpoints.general import ServiceProviderConfigSCIM, ClearCache, HealthCheck
+from SCIM.endpoints.general import ServiceProviderConfigSCIM, ClearCache, HealthCheck, snapshot_refresher
 api.add_resource(ServiceProviderConfigSCIM, '/ServiceProviderConfigs')
 api.add_resource(ClearCache, '/ClearCache')
 api.add_resource(HealthCheck, '/')
+if BACKEND_TYPE == 'database':
+    from SCIM.endpoints.general import PoolStats
+    api.add_resource(PoolStats, '/PoolStats')
+    if REPLICA_BINDS:
+        from SCIM.classes.implementation.database.routing import remove_expired_recent_writes
+        snapshot_refresher.register_task(remove_expired_recent_writes)
+    # incremental imports only need the change journal back to their lastModified filter
+    CHANGE_JOURNAL_RETENTION_DAYS = float(config['Database'].get('change_journal_retention_days', '30') or 0)
+    if CHANGE_JOURNAL_RETENTION_DAYS > 0:
+        from datetime import datetime, timedelta
+        from SCIM.classes.implementation.database.models import ChangeJournal
+        snapshot_refresher.register_task(lambda: ChangeJournal.prune(datetime.now() - timedelta(days=CHANGE_JOURNAL_RETENTION_DAYS)))
 
 for feature in users_features:
     if feature in SUPPORTED_PROVISIONING_FEATURES:
@@ -74,4 +108,30 @@ for feature in group_specific_features:
     if feature in SUPPORTED_PROVISIONING_FEATURES:
         from SCIM.endpoints.groups import GroupsSpecificSCIM
         api.add_resource(GroupsSpecificSCIM, '/Groups/<group_id>')
-        break
\ No newline at end of file
+        break
+if BULK_SUPPORTED:
+    from SCIM.endpoints.bulk import BulkSCIM
+    api.add_resource(BulkSCIM, '/Bulk')
+
+# what each worker sets up before serving requests, it cant run at import: under uwsgi every worker runs it after
+# it is forked from the master since connections and threads do not survive the fork, and run.py calls it itself
+# once the local example database is created and populated
+def start_worker() -> None:
+    if BACKEND_TYPE == 'database':
+        from SCIM.classes.implementation.database.migrations import upgrade_database
+        with app.app_context():
+            upgrade_database()
+        if not LOCAL_DATABASE and config['Database'].get('pool_prewarm', 'true').lower() != 'false':
+            # the first requests a worker serves do not wait for connections to be opened
+            from SCIM.classes.implementation.database.pool import prewarm_pool
+            with app.app_context():
+                for bind in [None] + REPLICA_BINDS:
+                    prewarm_pool(db.get_engine(bind=bind))
+    snapshot_refresher.start()
+
+try:
+    from uwsgidecorators import postfork
+    postfork(start_worker)
+except ImportError:
+    # not running under uwsgi, the caller starts the worker
+    pass
@@ -0,0 +1,47 @@
+from contextlib import nullcontext
+from typing import List, Union, AsyncContextManager
+
+from SCIM.classes.generic.SCIMGroup import SCIMGroup
+from SCIM.classes.generic.Patch import GroupPatch
+from SCIM.classes.generic.Projection import Projection
+
+# the coroutine version of GroupsBackend, for serving the groups from an asyncio event loop. The methods and what
+# they return are the same as in GroupsBackend
+class AsyncGroupsBackend:
+    # writes made inside the returned context manager (async with) should be committed together as one transaction,
+    # or all rolled back if it raises. Backends without transactions can leave this as is
+    def batch(self) -> AsyncContextManager[None]:
+        return nullcontext()
+
+    # return None if a group with group_id cannot be found
+    async def get_group(self, group_id: str, load_strategy: str = 'joined') -> Union[SCIMGroup, None]:
+        return None
+
+    # see GroupsBackend.get_group_version
+    async def get_group_version(self, group_id: str) -> Union[str, None]:
+        return None
+
+    # see GroupsBackend.list_groups
+    async def list_groups(self, filter: str=None, load_strategy: str='selectin', start_index: int=1, count: int=None, after_id: str=None, projection: Projection=None) -> List[SCIMGroup]:
+        return []
+
+    # return the number of groups matching the filter, used for totalResults when only a page is listed
+    async def count_groups(self, filter: str=None) -> int:
+        return len(await self.list_groups(filter=filter))
+
+    async def create_group(self, scim_group: SCIMGroup) -> SCIMGroup:
+        pass
+
+    async def update_group(self, scim_group: SCIMGroup) -> SCIMGroup:
+        pass
+
+    # see GroupsBackend.patch_group
+    async def patch_group(self, group_id: str, patch: GroupPatch) -> bool:
+        scim_group = await self.get_group(group_id)
+        if scim_group is None: return False
+        await self.update_group(patch.apply(scim_group))
+        return True
+
+    # return None on a successful delete
+    async def delete_group(self, group_id: str) -> None:
+        return None
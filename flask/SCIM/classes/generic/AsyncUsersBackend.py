@@ -0,0 +1,65 @@
+from contextlib import nullcontext
+from typing import List, Union, AsyncContextManager
+
+from SCIM.classes.generic.SCIMUser import SCIMUser, obj_list_to_scim_json_list
+from SCIM.classes.generic.Patch import UserPatch
+from SCIM.classes.generic.Projection import Projection
+
+# the coroutine version of UserBackend, for serving the users from an asyncio event loop (ex: the handlers of an
+# ASGI app running next to the Flask one). The methods and what they return are the same as in UserBackend
+class AsyncUserBackend:
+    # writes made inside the returned context manager (async with) should be committed together as one transaction,
+    # or all rolled back if it raises. Backends without transactions can leave this as is
+    def batch(self) -> AsyncContextManager[None]:
+        return nullcontext()
+
+    # returns None if a user with user_id cannot be found
+    async def get_user(self, user_id: str, load_strategy: str = 'joined') -> Union[SCIMUser, None]:
+        return None
+
+    # see UserBackend.get_user_version
+    async def get_user_version(self, user_id: str) -> Union[str, None]:
+        return None
+
+    # see UserBackend.list_users
+    async def list_users(self, filter: str=None, load_strategy: str='selectin', start_index: int=1, count: int=None, after_id: str=None, projection: Projection=None) -> List[SCIMUser]:
+        return []
+
+    # see UserBackend.list_user_resources
+    async def list_user_resources(self, filter: str=None, start_index: int=1, count: int=None, after_id: str=None) -> List[dict]:
+        return obj_list_to_scim_json_list(await self.list_users(filter=filter, start_index=start_index, count=count, after_id=after_id))
+
+    # return the number of users matching the filter, used for totalResults when only a page is listed
+    async def count_users(self, filter: str=None) -> int:
+        return len(await self.list_users(filter=filter))
+
+    async def create_user(self, scim_user: SCIMUser) -> SCIMUser:
+        pass
+
+    async def update_user(self, scim_user: SCIMUser) -> SCIMUser:
+        pass
+
+    # applies a PATCH with the methods below, return None if a user with user_id cannot be found
+    async def patch_user(self, user_id: str, patch: UserPatch) -> Union[SCIMUser, None]:
+        scim_user = SCIMUser({'id': user_id}, init_type='backend')
+        out_scim_user = None
+        # the password and active changes are committed together
+        async with self.batch():
+            if patch.password is not None:
+                scim_user.password = patch.password
+                out_scim_user = await self.reset_password(scim_user)
+            if patch.active is not None:
+                out_scim_user = await (self.enable_user(scim_user) if patch.active else self.disable_user(scim_user))
+        return out_scim_user
+
+    # should only be called in PATCH, return None if a user with scim_user.id cannot be found
+    async def enable_user(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
+        pass
+
+    # should only be called in PATCH, return None if a user with scim_user.id cannot be found
+    async def disable_user(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
+        pass
+
+    # see UserBackend.reset_password
+    async def reset_password(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
+        pass
@@ -1,9 +1,20 @@
 import os
 import json
+import mmap
+from array import array
 import platform
 import time
 import logging
-from typing import Union, List
+import tempfile
+from uuid import uuid4
+from contextlib import contextmanager
+from typing import Union, List, Tuple, Sequence, Iterator, Callable
+try:
+    import fcntl
+except ImportError:
+    # advisory locks are only needed for the multi process uwsgi deployment,
+    # a single process local run (ex: on Windows) does not need them
+    fcntl = None
 
 from SCIM.helpers import set_up_logger, config
 
@@ -26,6 +37,19 @@ def creation_time(path_to_file: str) -> float:
             # so we'll settle for when its content was last modified.
             return stat.st_mtime
 
+# holds an advisory lock on lock_path for the duration of the with block, the lock is released by the
+# kernel if the process dies so a crashed worker can never leave it held
+@contextmanager
+def file_lock(lock_path: str, shared: bool = False) -> Iterator[None]:
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
 class Cache:
     cache_base_dir: str = config['Cache']['dir']
     cache_lifetime_sec: float = float(config['Cache']['lifetime_min'])*60
@@ -35,96 +59,257 @@ class Cache:
         if not os.path.exists(self.cache_base_dir):
             os.mkdir(self.cache_base_dir)
         self.cache_file_path = self.cache_base_dir.strip('/').strip('\\') + '/' + file_name
+        # sidecar file with the byte offset of every resource in the snapshot
+        self.index_file_path = self.cache_file_path + '.idx'
+        # one lease per pagination process reading the snapshot
+        self.lock_file_path = self.cache_file_path + '.lock'
+        # advisory lock file guarding the leases and snapshot publication, it is never deleted
+        # so every process always locks the same file
+        self.mutex_file_path = self.cache_file_path + '.mutex'
+        # advisory lock file held while a process builds a new snapshot, also never deleted
+        self.build_file_path = self.cache_file_path + '.build'
+        # a snapshot built while the current one was leased, it replaces the current one once the last lease is released
+        self.pending_file_path = self.cache_file_path + '.next'
+        self.pending_index_file_path = self.pending_file_path + '.idx'
+        # (file identity, mapped snapshot, record offsets) of the snapshot this process has mapped
+        self.snapshot: Tuple[tuple, Union[mmap.mmap, bytes], Sequence[int]] = None
         # if there already exists a cache file on startup delete it
         if os.path.isfile(self.cache_file_path):
             logging.debug('Deleting existing cache')
             os.remove(self.cache_file_path)
+        for path in [self.index_file_path, self.pending_file_path, self.pending_index_file_path]:
+            if os.path.isfile(path): os.remove(path)
 
     def check_cache_lifetime_valid(self) -> bool:
         cache_created = creation_time(self.cache_file_path)
         return time.time() < cache_created + self.cache_lifetime_sec
 
-    def write_json_cache(self, json_obj: dict) -> None:
-        # if the cache already exists
-        if os.path.isfile(self.cache_file_path):
-            # if there is no cache lock overwrite it
-            # if there is a lock file do nothing
-            if not self.check_for_lock_file():
-                logger.info('Cache no longer valid and no lock in place, refreshing cache')
-                os.remove(self.cache_file_path)
-                cache_file = open(self.cache_file_path, 'w')
-                json.dump(json_obj, cache_file)
-                cache_file.close()
-        # if not write it
-        else:
-            logger.info('No cache found, writing data to cache')
-            with open(self.cache_file_path, 'w') as cache_file:
-                json.dump(json_obj, cache_file)
-        
-    def read_json_cache(self) -> Union[List[dict], dict]:
+    # single flight snapshot build: one process at a time holds the build lock and scans the backend,
+    # processes that queued up behind it reuse the snapshot it published instead of scanning again
+    def build_snapshot(self, build: Callable[[], List[dict]], acquire_lease: bool = False) -> None:
+        requested = time.time()
+        with file_lock(self.build_file_path):
+            if os.path.isfile(self.cache_file_path) and (os.stat(self.cache_file_path).st_mtime >= requested or self.check_for_lock_file()):
+                logger.info('Snapshot was published by another process, reusing it')
+                if acquire_lease: self.acquire_lease()
+                return
+            logger.info('Building new snapshot')
+            self.write_json_cache(build(), acquire_lease=acquire_lease)
+
+    # rebuilds the snapshot unless it, or a snapshot waiting to replace it, is younger than max_age_sec
+    def refresh_snapshot(self, build: Callable[[], List[dict]], max_age_sec: float) -> None:
+        with file_lock(self.build_file_path):
+            built = [creation_time(path) for path in [self.cache_file_path, self.pending_file_path] if os.path.isfile(path)]
+            if built != [] and time.time() < max(built) + max_age_sec:
+                logger.info('Snapshot %s is less than %f minutes old, not refreshing' % (self.cache_file_path, max_age_sec / 60))
+                return
+            logger.info('Refreshing snapshot %s' % self.cache_file_path)
+            self.write_json_cache(build())
+
+    def write_json_cache(self, json_obj: List[dict], acquire_lease: bool = False) -> None:
+        # the new snapshot is written to temporary files first and then renamed over the old one, a
+        # rename is atomic so readers only ever see a whole snapshot. Readers that already mapped
+        # the old snapshot keep reading it until they remap
+        snapshot_tmp_path, index_tmp_path = self.write_snapshot(json_obj)
+        try:
+            with file_lock(self.mutex_file_path):
+                leases = self.active_leases()
+                if os.path.isfile(self.cache_file_path) and leases != []:
+                    # swapping the snapshot out from under a pagination process would mix two snapshots in one
+                    # import, so the new one waits until the last lease is released
+                    logger.info('Cache is leased by a pagination process, publishing new cache once it is released')
+                    os.replace(index_tmp_path, self.pending_index_file_path)
+                    os.replace(snapshot_tmp_path, self.pending_file_path)
+                else:
+                    logger.info('Publishing new cache')
+                    # the snapshot's age is counted from when it was published
+                    os.utime(snapshot_tmp_path)
+                    # the index is published first, it names the snapshot it belongs to so a reader
+                    # that sees a new index with the old snapshot will not use it
+                    os.replace(index_tmp_path, self.index_file_path)
+                    os.replace(snapshot_tmp_path, self.cache_file_path)
+                # leased in the same critical section as the publish so the snapshot can not be
+                # replaced before the pagination process that built it reads it
+                if acquire_lease:
+                    leases.append((str(uuid4()), time.time()))
+                    self.write_leases(leases)
+        finally:
+            for tmp_path in [snapshot_tmp_path, index_tmp_path]:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    # the snapshot is stored as one JSON resource per line, that way a page can be read
+    # without parsing (or even reading from disk) the rest of the snapshot. json.dumps escapes
+    # newlines inside of strings so a newline always ends a resource. The .idx sidecar is written as
+    # unsigned 64 bit ints, the inode of the snapshot it belongs to followed by the start offset
+    # of every resource and the end of the file, so readers can go straight to the byte range of a page.
+    # returns the temporary (snapshot, index) paths
+    def write_snapshot(self, json_list: List[dict]) -> Tuple[str, str]:
+        snapshot_fd, snapshot_tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_file_path), suffix='.tmp')
+        offsets = array('Q')
+        with open(snapshot_fd, 'wb') as cache_file:
+            # renames keep the inode, so this is the inode of the published snapshot
+            offsets.append(os.fstat(cache_file.fileno()).st_ino)
+            offsets.append(0)
+            for resource in json_list:
+                cache_file.write(json.dumps(resource, separators=(',', ':')).encode('utf-8'))
+                cache_file.write(b'\n')
+                offsets.append(cache_file.tell())
+        index_fd, index_tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_file_path), suffix='.tmp')
+        with open(index_fd, 'wb') as index_file:
+            offsets.tofile(index_file)
+        return snapshot_tmp_path, index_tmp_path
+
+    # every worker process memory maps the same snapshot and index files, so the OS page cache holds
+    # one copy for all of them and a page read only touches the index entries and records it needs
+    def map_snapshot(self) -> Tuple[Union[mmap.mmap, bytes], Sequence[int]]:
+        stat = os.stat(self.cache_file_path)
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self.snapshot is not None and self.snapshot[0] == identity:
+            return self.snapshot[1], self.snapshot[2]
+        logger.debug('Mapping new snapshot %s' % self.cache_file_path)
+        with open(self.cache_file_path, 'rb') as cache_file:
+            # the snapshot may have been replaced since the stat above, use what was actually opened
+            stat = os.fstat(cache_file.fileno())
+            identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            # an empty file can not be mapped
+            mapped = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size > 0 else b''
+        offsets = self.map_index(stat.st_ino, stat.st_size)
+        if offsets is None:
+            logger.info('No index matching %s, scanning the snapshot for record offsets' % self.cache_file_path)
+            offsets = [0]
+            end = mapped.find(b'\n')
+            while end != -1:
+                offsets.append(end + 1)
+                end = mapped.find(b'\n', end + 1)
+        # replaced as a whole so a thread never sees the offsets of a different snapshot
+        self.snapshot = (identity, mapped, offsets)
+        return mapped, offsets
+
+    # returns None if the index is missing or does not belong to the snapshot with snapshot_inode and snapshot_size
+    def map_index(self, snapshot_inode: int, snapshot_size: int) -> Union[Sequence[int], None]:
+        try:
+            with open(self.index_file_path, 'rb') as index_file:
+                index_size = os.fstat(index_file.fileno()).st_size
+                if index_size < 16 or index_size % 8 != 0:
+                    return None
+                index = memoryview(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)).cast('Q')
+        except FileNotFoundError:
+            return None
+        if index[0] != snapshot_inode or index[-1] != snapshot_size:
+            return None
+        return index[1:]
+
+    def check_cache_readable(self) -> None:
         if self.check_cache_lifetime_valid():
             logger.info('Reading data from cache')
-            with open(self.cache_file_path, 'r') as cache_file:
-                return json.load(cache_file)
-        elif not self.check_cache_lifetime_valid() and self.check_for_lock_file():
+        elif self.check_for_lock_file():
             logger.info('Cache has timed out but is currently locked, reading from expired cache')
-            with open(self.cache_file_path, 'r') as cache_file:
-                return json.load(cache_file)
         else:
             logger.info('Cache has timed out and no lock file exists')
             raise TimeoutError('The cache has timed out')
 
-    # create a lock file and add a 'start' to the beginning to notate a pagination process is using it
-    def create_lock_file(self, identifier_string: str = '') -> None:
-        lock_file = open(self.cache_file_path + '.lock', 'w')
-        lock_file.write('start\t' + identifier_string)
-        lock_file.close()
-
-    # if a second pagination process needs access to the cache so data is not overwritten
-    # append a 'start' to the lock file to notate another pagination process is using it
-    # when a pagination loop is completed, append 'end' to the lock file
-    # lock files can only be removed when the number of 'starts' equals the number of 'ends'
-    # this way the cache will not be modified in the middle of a pagination process
-    def append_lock_file(self, text: str) -> None:
-        lock_file = open(self.cache_file_path + '.lock', 'a')
-        lock_file.write('\n' + text)
-        lock_file.close()
-
-    # lock files can only be removed when the number of 'starts' equals the number of 'ends'
-    # this way the cache will not be modified in the middle of a pagination process
-    def cleanup_lock_file(self, force = False) -> None:
-        if force:
-            logger.info('Force deleting %s lock file' % self.cache_file_path + '.lock')
-            if os.path.exists(self.cache_file_path + '.lock'): os.remove(self.cache_file_path + '.lock')
-        else:
+    # zero copy views of the encoded resources on a page, start_index is 1 based like the SCIM startIndex
+    def read_raw_cache(self, start_index: int = 1, count: int = None) -> List[memoryview]:
+        self.check_cache_readable()
+        mapped, offsets = self.map_snapshot()
+        first = max(start_index - 1, 0)
+        last = len(offsets) - 1 if count is None else min(first + count, len(offsets) - 1)
+        view = memoryview(mapped)
+        # leave the trailing newline off of each resource
+        return [view[offsets[i]:offsets[i + 1] - 1] for i in range(first, last)]
+
+    def read_json_cache(self, start_index: int = 1, count: int = None) -> Union[List[dict], dict]:
+        return [json.loads(bytes(resource)) for resource in self.read_raw_cache(start_index, count)]
+
+    # number of resources in the snapshot, used for totalResults when only a page is read
+    def resource_count(self) -> int:
+        mapped, offsets = self.map_snapshot()
+        return len(offsets) - 1
+
+    # leases are kept in the lock file as one '<lease id>\t<time acquired>' line per pagination process
+    # reading the snapshot. They are only read and written while holding the mutex lock, and a lease
+    # that is older than lock_lifetime_min is dropped, so a reader that crashed mid pagination
+    # can only hold the snapshot for that long. Must be called while holding the mutex lock
+    def active_leases(self) -> List[Tuple[str, float]]:
+        try:
+            with open(self.lock_file_path, 'r') as lock_file:
+                lines = lock_file.read().splitlines()
+        except FileNotFoundError:
+            return []
+        leases = []
+        for line in lines:
             try:
-                with open(self.cache_file_path + '.lock', 'r') as lock_file:
-                    file_contents = lock_file.read()
-                if file_contents.count('start') == file_contents.count('end'):
-                    logger.info('All threads finished with lock file, deleting it')
-                    os.remove(self.cache_file_path + '.lock')
-                else:
-                    logger.info('There is a thread still using the cache lock, once that thread is completed the lock will be removed')
-            except FileNotFoundError:
-                logger.info('Cache lock file not found, nothing to clean up')
+                lease_id, acquired = line.split('\t')
+                leases.append((lease_id, float(acquired)))
+            except ValueError:
+                logger.info('Ignoring malformed cache lease: %s' % line)
+        active = [lease for lease in leases if time.time() < lease[1] + self.lock_lifetime_sec]
+        if len(active) != len(leases):
+            logger.info('%i cache leases have not been released in %f minutes, dropping them' % (len(leases) - len(active), self.lock_lifetime_sec / 60))
+            self.write_leases(active)
+        return active
 
-    def check_for_lock_file(self) -> bool:
-        # if the lock file exists
-        if os.path.isfile(self.cache_file_path + '.lock'):
-            stat = os.stat(self.cache_file_path + '.lock')
-            # if the lock file has timed out, force a cleanup and return False
-            if time.time() > stat.st_mtime + self.lock_lifetime_sec: 
-                logger.info('Cache lock has not been modified in %f minutes, forcing cleanup' % (time.time() - stat.st_mtime))
-                self.cleanup_lock_file(force=True)
-                return False
-            # if it exists and nothing has timed out then return True
-            else:
-                return True
-        # if the lock file does not exist
+    # swaps in a snapshot that was built while the current one was leased, must be called while
+    # holding the mutex lock with no active leases
+    def publish_pending(self) -> None:
+        if not os.path.isfile(self.pending_file_path): return
+        logger.info('Publishing snapshot built while the cache was leased')
+        # index first, same as write_json_cache
+        if os.path.isfile(self.pending_index_file_path): os.replace(self.pending_index_file_path, self.index_file_path)
+        os.replace(self.pending_file_path, self.cache_file_path)
+
+    # must be called while holding the mutex lock
+    def write_leases(self, leases: List[Tuple[str, float]]) -> None:
+        if leases == []:
+            if os.path.exists(self.lock_file_path): os.remove(self.lock_file_path)
+            self.publish_pending()
+            return
+        lock_fd, lock_tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.lock_file_path), suffix='.tmp')
+        with open(lock_fd, 'w') as lock_file:
+            lock_file.write(''.join('%s\t%f\n' % lease for lease in leases))
+        os.replace(lock_tmp_path, self.lock_file_path)
+
+    # take a lease on the snapshot for a pagination process so it is not replaced until the
+    # process has read its last page. With require_snapshot no lease is taken if there is no
+    # snapshot to read (ex: a pre-warmed one) and None is returned
+    def acquire_lease(self, require_snapshot: bool = False) -> Union[str, None]:
+        lease_id = str(uuid4())
+        with file_lock(self.mutex_file_path):
+            leases = self.active_leases()
+            if require_snapshot and not os.path.isfile(self.cache_file_path): return None
+            leases.append((lease_id, time.time()))
+            self.write_leases(leases)
+        logger.info('Acquired cache lease, %i active leases' % len(leases))
+        return lease_id
+
+    # pagination requests do not say which pagination process they belong to, so a finished
+    # process releases the oldest lease
+    def release_lease(self) -> None:
+        with file_lock(self.mutex_file_path):
+            leases = self.active_leases()
+            if leases == []:
+                logger.info('No cache lease found, nothing to clean up')
+                return
+            leases.remove(min(leases, key=lambda lease: lease[1]))
+            self.write_leases(leases)
+        if leases == []:
+            logger.info('All pagination processes finished with the cache, lock removed')
         else:
-            return False
+            logger.info('There are %i pagination processes still using the cache, once they are completed the lock will be removed' % len(leases))
+
+    def cleanup_lock_file(self) -> None:
+        logger.info('Force deleting %s lock file' % self.lock_file_path)
+        with file_lock(self.mutex_file_path):
+            self.write_leases([])
+
+    def check_for_lock_file(self) -> bool:
+        with file_lock(self.mutex_file_path):
+            return self.active_leases() != []
 
     def force_clear_cache(self) -> None:
-        self.cleanup_lock_file(force=True)
+        self.cleanup_lock_file()
         logger.info('Force deleting %s cache file' % self.cache_file_path)
-        if os.path.exists(self.cache_file_path): os.remove(self.cache_file_path)
\ No newline at end of file
+        self.snapshot = None
+        if os.path.exists(self.cache_file_path): os.remove(self.cache_file_path)
+        for path in [self.index_file_path, self.pending_file_path, self.pending_index_file_path]:
+            if os.path.exists(path): os.remove(path)
\ No newline at end of file
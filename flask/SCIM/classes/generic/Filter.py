@@ -1,34 +1,169 @@
-from re import match
-from typing import Tuple
+import re
+import json
+from functools import lru_cache
+from typing import Tuple, List, NamedTuple, Union, Iterator
 
 class FilterValidationError(Exception):
-    def __init__(self, *args: object) -> None:
+    def __init__(self, *args: object, message: str = None) -> None:
+        if message is not None: args = (message,) + args
         super().__init__(*args)
 
+# SCIM filter AST (https://datatracker.ietf.org/doc/html/rfc7644#section-3.4.2.2). The nodes are tuples so a
+# parsed filter can be cached and shared between requests. A Comparison takes the same (search_key, comparator,
+# search_value) form the filter_args passed to set_search_key_and_value always had, value is the string from the
+# filter (unquoted, true/false and numbers as written), or None for pr and null
+class Comparison(NamedTuple):
+    attribute: str
+    operator: str
+    value: Union[str, None]
+
+class And(NamedTuple):
+    left: 'FilterNode'
+    right: 'FilterNode'
+
+class Or(NamedTuple):
+    left: 'FilterNode'
+    right: 'FilterNode'
+
+class Not(NamedTuple):
+    operand: 'FilterNode'
+
+FilterNode = Union[Comparison, And, Or, Not]
+
+OPERATORS: List[str] = ['eq', 'ne', 'co', 'sw', 'ew', 'gt', 'lt', 'ge', 'le', 'pr']
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|("(?:[^"\\]|\\.)*")|([^\s()"]+))')
+
+# splits a filter string into (kind, text) tokens, kind is one of ( ) string word
+def tokenize(filter: str) -> List[Tuple[str, str]]:
+    tokens: List[Tuple[str, str]] = []
+    position = 0
+    filter = filter.strip()
+    while position < len(filter):
+        token_match = TOKEN_PATTERN.match(filter, position)
+        if token_match is None or token_match.end() == position:
+            raise FilterValidationError(message='Unable to parse filter string at position %i: %s' % (position, filter))
+        lparen, rparen, string, word = token_match.groups()
+        if lparen is not None: tokens.append(('(', lparen))
+        elif rparen is not None: tokens.append((')', rparen))
+        elif string is not None: tokens.append(('string', string))
+        else: tokens.append(('word', word))
+        position = token_match.end()
+    return tokens
+
+# recursive descent parser for the filter grammar, lowest to highest precedence: or, and, not, comparisons and grouping
+class FilterParser:
+    def __init__(self, filter: str) -> None:
+        self.filter = filter
+        self.tokens = tokenize(filter)
+        self.position = 0
+
+    def parse(self) -> FilterNode:
+        if self.tokens == []:
+            raise FilterValidationError(message='The filter string is empty')
+        node = self.parse_or()
+        if self.position != len(self.tokens):
+            raise FilterValidationError(message='Unexpected "%s" in filter string: %s' % (self.tokens[self.position][1], self.filter))
+        return node
+
+    def peek_keyword(self) -> Union[str, None]:
+        if self.position < len(self.tokens) and self.tokens[self.position][0] == 'word':
+            return self.tokens[self.position][1].lower()
+        return None
+
+    def next_token(self) -> Tuple[str, str]:
+        if self.position >= len(self.tokens):
+            raise FilterValidationError(message='Unexpected end of filter string: %s' % self.filter)
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse_or(self) -> FilterNode:
+        node = self.parse_and()
+        while self.peek_keyword() == 'or':
+            self.position += 1
+            node = Or(node, self.parse_and())
+        return node
+
+    def parse_and(self) -> FilterNode:
+        node = self.parse_not()
+        while self.peek_keyword() == 'and':
+            self.position += 1
+            node = And(node, self.parse_not())
+        return node
+
+    def parse_not(self) -> FilterNode:
+        if self.peek_keyword() == 'not':
+            self.position += 1
+            return Not(self.parse_not())
+        if self.position < len(self.tokens) and self.tokens[self.position][0] == '(':
+            self.position += 1
+            node = self.parse_or()
+            if self.next_token()[0] != ')':
+                raise FilterValidationError(message='Missing ")" in filter string: %s' % self.filter)
+            return node
+        return self.parse_comparison()
+
+    def parse_comparison(self) -> Comparison:
+        kind, attribute = self.next_token()
+        if kind != 'word':
+            raise FilterValidationError(message='Expected an attribute name but found "%s" in filter string: %s' % (attribute, self.filter))
+        if '[' in attribute:
+            raise FilterValidationError(message='Value path filters are not supported: %s' % self.filter)
+        operator = self.next_token()[1].lower()
+        if operator not in OPERATORS:
+            raise FilterValidationError(message='Comparator must be one of %s, value received was: %s' % (OPERATORS, operator))
+        if operator == 'pr':
+            return Comparison(attribute, operator, None)
+        kind, value = self.next_token()
+        if kind == 'string':
+            try:
+                value = json.loads(value)
+            except ValueError as e:
+                raise FilterValidationError(message='Invalid string %s in filter string: %s' % (value, e))
+        elif kind != 'word':
+            raise FilterValidationError(message='Expected a value after "%s %s" in filter string: %s' % (attribute, operator, self.filter))
+        elif value.lower() == 'null':
+            value = None
+        return Comparison(attribute, operator, value)
+
+# Okta sends the same few filters over and over, so parsed filters are cached
+@lru_cache(maxsize=256)
+def parse_filter(filter: str) -> FilterNode:
+    return FilterParser(filter).parse()
+
+# the comparisons in a filter from left to right
+def comparisons(node: FilterNode) -> Iterator[Comparison]:
+    if isinstance(node, Comparison):
+        yield node
+    elif isinstance(node, Not):
+        yield from comparisons(node.operand)
+    else:
+        yield from comparisons(node.left)
+        yield from comparisons(node.right)
+
 class Filter:
     def __init__(self, filter: str, ) -> None:
-        if '"' in filter:
-            match_string = '([\w\._-]+) (\w+) "([^"]*)"'
-            filter_match = match(match_string, filter)
+        self.ast: FilterNode = parse_filter(filter)
+        # every attribute in the filter has to be mapped, set_search_key_and_value raises a
+        # FilterValidationError for one that is not
+        for comparison in comparisons(self.ast):
+            self.set_search_key_and_value(comparison)
+        # a filter with a single comparison keeps it in comparator, search_key and search_value for backends
+        # that only handle single comparisons, otherwise they are None and the backend has to use the ast
+        if isinstance(self.ast, Comparison):
+            self.comparator = self.ast.operator
         else:
-            match_string = '([\w\._-]+) (\w+) ([a-zA-Z0-9_]+)'
-            filter_match = match(match_string, filter)
-
-        try:
-            filter_args = filter_match.groups()
-        except AttributeError:
-            raise FilterValidationError(message='Error in REGEX expression matching (%s) of filter string, unable to parse filter string: %s' % (match_string, filter))
-        self.comparator = filter_args[1]
-        if self.comparator not in ['lt', 'gt', 'eq']:
-            raise FilterValidationError(message='Comparator must be one of [lt, gt, eq], value received was: %s' % self.comparator)
-
-        self.set_search_key_and_value(filter_args)
+            self.comparator = None
+            self.search_key = None
+            self.search_value = None
 
     # filter_args takes the form (str(search_key), comparator, str(search_value))
     # the purpose of this function is to get the proper lookup key for search_key
-    # and the proper datatype for search_value. For example, in a DB w/SQLalchemy we 
+    # and the proper datatype for search_value. For example, in a DB w/SQLalchemy we
     # would need the DB Column attribute to search on, and data type of the value
     # needs to match the data type of the Column (can't do DB.query.filter(id='100'))
-    # if the id column is an int and '100' is a string)
+    # if the id column is an int and '100' is a string). search_value is None for
+    # pr and null comparisons
     def set_search_key_and_value(self, filter_args: Tuple[str]):
-        pass
\ No newline at end of file
+        pass
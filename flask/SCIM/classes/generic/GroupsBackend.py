@@ -1,23 +1,55 @@
-from typing import List, Union
+from contextlib import nullcontext
+from typing import List, Union, ContextManager
 
 from SCIM.classes.generic.SCIMGroup import SCIMGroup
+from SCIM.classes.generic.Patch import GroupPatch
+from SCIM.classes.generic.Projection import Projection
 
 # this is inteded to be used as an interface which is extended for a specific backend
 class GroupsBackend:
+    # writes made inside the returned context manager should be committed together as one transaction,
+    # or all rolled back if it raises. Used by /Bulk, backends without transactions can leave this as is
+    def batch(self) -> ContextManager[None]:
+        return nullcontext()
+
     # return None if a group with group_id cannot be found
-    def get_group(self, group_id: str) -> Union[SCIMGroup, None]:
+    def get_group(self, group_id: str, load_strategy: str = 'joined') -> Union[SCIMGroup, None]:
+        return None
+
+    # an opaque string that changes whenever the group's SCIM resource changes, used as its weak ETag.
+    # Should be cheaper than get_group. Return None if a group with group_id cannot be found, backends
+    # that dont keep versions can leave this as is and no ETags are sent
+    def get_group_version(self, group_id: str) -> Union[str, None]:
         return None
 
     # return an empty list if no groups were found
-    def list_groups(self, filter: str=None) -> List[SCIMGroup]:
+    # start_index is 1 based like the SCIM startIndex and count=None returns everything after it.
+    # after_id continues after the last id of a previous page (keyset pagination) and replaces start_index.
+    # results should be in a stable order (ex: by id) so pages do not overlap.
+    # projection is the attributes the request asks for (None for all of them), backends can skip loading the ones it
+    # does not return. The endpoints remove them from the response either way
+    def list_groups(self, filter: str=None, load_strategy: str='selectin', start_index: int=1, count: int=None, after_id: str=None, projection: Projection=None) -> List[SCIMGroup]:
         return []
 
+    # return the number of groups matching the filter, used for totalResults when only a page is listed
+    def count_groups(self, filter: str=None) -> int:
+        return len(self.list_groups(filter=filter))
+
     def create_group(self, scim_group: SCIMGroup) -> SCIMGroup:
         pass
 
     def update_group(self, scim_group: SCIMGroup) -> SCIMGroup:
         pass
 
+    # return False if a group with group_id cannot be found. By default the patched group replaces the
+    # old one, backends that can add and remove single members should override this so a PATCH only
+    # costs the members it changes
+    def patch_group(self, group_id: str, patch: GroupPatch) -> bool:
+        scim_group = self.get_group(group_id)
+        if scim_group is None: return False
+        self.update_group(patch.apply(scim_group))
+        return True
+
     # return None on a successful delete
     def delete_group(self, group_id: str) -> None:
         return None
\ No newline at end of file
@@ -1,30 +1,86 @@
-from typing import List, Union
+import json
+from typing import List, Union, Iterator
 
 from SCIM.classes.generic.SCIMUser import SCIMUser
 from SCIM.classes.generic.SCIMGroup import SCIMGroup
+from SCIM.classes.generic.Projection import Projection
 
 class ListResponse:
-    def __init__(self, list: Union[List[SCIMUser], List[dict], List[SCIMGroup]], start_index:int=1, count:int=None, total_results:int=0):
+    # list can also hold resources that are already JSON encoded (ex: pages read from a Cache snapshot).
+    # projection removes the attributes the request did not ask for from every resource
+    def __init__(self, list: Union[List[SCIMUser], List[dict], List[SCIMGroup], List[bytes], List[memoryview]], start_index:int=1, count:int=None, total_results:int=0, projection:Projection=None):
         self.list = list
         self.start_index = start_index
         self.count = count
         self.total_results = total_results
+        self.projection = projection
 
+    # the ListResponse without its Resources
     @property
-    def scim_resource(self) -> dict:
+    def scim_envelope(self) -> dict:
         rv = {
             "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
             "totalResults": self.total_results,
-            "startIndex": self.start_index,
-            "Resources": []
+            "startIndex": self.start_index
         }
-        resources = []
+        if self.count:
+            rv['itemsPerPage'] = self.count
+        return rv
+
+    @property
+    def encoded(self) -> bool:
+        return self.list != [] and isinstance(self.list[0], (bytes, memoryview))
+
+    @property
+    def scim_resources(self) -> Iterator[dict]:
+        if self.projection is None:
+            yield from self.unprojected_resources()
+        else:
+            for resource in self.unprojected_resources():
+                yield self.projection.apply(resource)
+
+    def unprojected_resources(self) -> Iterator[dict]:
         if self.list != [] and (type(self.list[0]) == SCIMUser or type(self.list[0]) == SCIMGroup):
             for item in self.list:
-                resources.append(item.scim_resource)
+                yield item.scim_resource
+        elif self.encoded:
+            for item in self.list:
+                yield json.loads(bytes(item))
         else:
-            resources = self.list
-        if self.count:
-            rv['itemsPerPage'] = self.count
-        rv['Resources'] = resources
-        return rv
\ No newline at end of file
+            yield from self.list
+
+    # the resources as JSON, already encoded resources are passed through as they are unless they are projected
+    def encoded_resources(self) -> Iterator[Union[bytes, memoryview]]:
+        if self.encoded and self.projection is None:
+            yield from self.list
+        else:
+            for resource in self.scim_resources:
+                yield json.dumps(resource).encode('utf-8')
+
+    @property
+    def scim_resource(self) -> dict:
+        rv = self.scim_envelope
+        rv['Resources'] = list(self.scim_resources)
+        return rv
+
+    # the whole ListResponse as JSON, already encoded resources are copied in without decoding them
+    @property
+    def scim_bytes(self) -> bytes:
+        return b''.join(self.chunks())
+
+    # yields the ListResponse as chunks of JSON, one per resource, so the whole body is never
+    # built in memory and the first bytes can be sent before the last resource is encoded
+    def stream(self) -> Iterator[bytes]:
+        for chunk in self.chunks():
+            # WSGI servers only accept bytes
+            yield bytes(chunk)
+
+    def chunks(self) -> Iterator[Union[bytes, memoryview]]:
+        # drop the closing brace of the envelope and open the Resources list
+        yield json.dumps(self.scim_envelope)[:-1].encode('utf-8') + b', "Resources": ['
+        separator = b''
+        for resource in self.encoded_resources():
+            yield separator
+            yield resource
+            separator = b', '
+        yield b']}'
@@ -0,0 +1,146 @@
+import re
+from typing import Any, Iterator, List, Set, Tuple, Union
+
+from SCIM.classes.generic.Filter import FilterValidationError, Comparison, Or, FilterNode, parse_filter, comparisons
+from SCIM.classes.generic.SCIMGroup import SCIMGroup
+
+class PatchValidationError(Exception):
+    def __init__(self, *args: object, message: str = None) -> None:
+        if message is not None: args = (message,) + args
+        super().__init__(*args)
+
+PATCH_OPS: List[str] = ['add', 'remove', 'replace']
+
+# members[value eq "id"], the filter selects which members a remove applies to
+MEMBERS_PATH_PATTERN = re.compile(r'^members\[(.*)\]$', re.IGNORECASE)
+
+# the (op, path, value) of every operation in a SCIM PatchOp (https://datatracker.ietf.org/doc/html/rfc7644#section-3.5.2).
+# An operation without a path has the attributes to change in its value, it is split into one operation per attribute
+def patch_operations(patch_json: dict) -> Iterator[Tuple[str, str, Any]]:
+    try:
+        operations: List[dict] = patch_json['Operations']
+    except (KeyError, TypeError):
+        raise PatchValidationError(message='The PATCH request has no Operations')
+    for operation in operations:
+        # Azure AD capitalizes the op
+        op = str(operation.get('op', '')).lower()
+        if op not in PATCH_OPS:
+            raise PatchValidationError(message='op must be one of %s, value received was: %s' % (PATCH_OPS, operation.get('op')))
+        path = operation.get('path')
+        value = operation.get('value')
+        if path is not None:
+            yield op, path, value
+        elif isinstance(value, dict) and op != 'remove':
+            for attribute, attribute_value in value.items():
+                yield op, attribute, attribute_value
+        else:
+            raise PatchValidationError(message='A %s operation without a path needs an object value' % op)
+
+# the ids in a list of {value: id, display: ...} members
+def member_ids(members: Any) -> Set[str]:
+    if isinstance(members, dict): members = [members]
+    try:
+        return {member['value'] for member in members}
+    except (KeyError, TypeError):
+        raise PatchValidationError(message='members must be a list of objects with a value, value received was: %s' % members)
+
+# the ids selected by a members[value eq "id" or value eq "id2"] path
+def filtered_member_ids(members_filter: str) -> Set[str]:
+    try:
+        node: FilterNode = parse_filter(members_filter)
+    except FilterValidationError as e:
+        raise PatchValidationError(message='Invalid members filter: %s' % e)
+    def only_or(node: FilterNode) -> bool:
+        return isinstance(node, Comparison) or (isinstance(node, Or) and only_or(node.left) and only_or(node.right))
+    ids = set()
+    for comparison in comparisons(node):
+        if not only_or(node) or comparison.attribute != 'value' or comparison.operator != 'eq' or comparison.value is None:
+            raise PatchValidationError(message='Only value eq filters joined by or are supported on members: %s' % members_filter)
+        ids.add(comparison.value)
+    return ids
+
+# a PATCH to a group folded into the end result of its operations, so a backend can apply the membership
+# change as the members added and removed instead of diffing the whole member list
+class GroupPatch:
+    def __init__(self, patch_json: dict) -> None:
+        # None for attributes the patch does not change
+        self.displayName: Union[str, None] = None
+        self.custom_attributes: dict = {}
+        # when the patch replaces the members this is the new member list, the patch becomes a full diff
+        self.members_replaced: Union[Set[str], None] = None
+        self.members_added: Set[str] = set()
+        self.members_removed: Set[str] = set()
+        # SCIM attribute names are case insensitive
+        for op, path, value in patch_operations(patch_json):
+            members_path = MEMBERS_PATH_PATTERN.match(path)
+            if members_path is not None:
+                if op != 'remove':
+                    raise PatchValidationError(message='Only remove is supported on a filtered members path: %s' % path)
+                self.remove_members(filtered_member_ids(members_path.group(1)))
+            elif path.lower() == 'members':
+                if op == 'replace':
+                    self.members_replaced = member_ids(value or [])
+                    self.members_added, self.members_removed = set(), set()
+                elif op == 'add':
+                    self.add_members(member_ids(value or []))
+                # remove without a value removes every member
+                elif value is None:
+                    self.members_replaced = set()
+                    self.members_added, self.members_removed = set(), set()
+                else:
+                    self.remove_members(member_ids(value))
+            elif path.lower() == 'displayname' and op != 'remove':
+                self.displayName = value
+            elif path.lower() == 'urn:okta:custom:group:1.0' and isinstance(value, dict) and op != 'remove':
+                self.custom_attributes.update(value)
+            # Okta includes the id in a replace, it can not change
+            elif path.lower() == 'id':
+                pass
+            else:
+                raise PatchValidationError(message='%s is not supported on group attribute %s' % (op, path))
+
+    def add_members(self, ids: Set[str]) -> None:
+        if self.members_replaced is not None:
+            self.members_replaced |= ids
+        else:
+            self.members_added |= ids
+            self.members_removed -= ids
+
+    def remove_members(self, ids: Set[str]) -> None:
+        if self.members_replaced is not None:
+            self.members_replaced -= ids
+        else:
+            self.members_removed |= ids
+            self.members_added -= ids
+
+    # applies the patch to a group, for backends that can only replace the whole group
+    def apply(self, scim_group: SCIMGroup) -> SCIMGroup:
+        if self.displayName is not None: scim_group.displayName = self.displayName
+        scim_group.custom_attributes.update(self.custom_attributes)
+        if self.members_replaced is not None:
+            scim_group.members = [{'value': id} for id in self.members_replaced]
+        else:
+            scim_group.members = [member for member in scim_group.members if member['value'] not in self.members_removed]
+            current_ids = {member['value'] for member in scim_group.members}
+            scim_group.members += [{'value': id} for id in self.members_added - current_ids]
+        return scim_group
+
+# a PATCH to a user, Okta only uses PATCH for user activation, deactivation and password syncs
+# (https://developer.okta.com/docs/reference/scim/scim-20/#update-a-specific-user-patch)
+class UserPatch:
+    def __init__(self, patch_json: dict) -> None:
+        # None for attributes the patch does not change
+        self.active: Union[bool, None] = None
+        self.password: Union[str, None] = None
+        for op, path, value in patch_operations(patch_json):
+            if op == 'remove':
+                raise PatchValidationError(message='remove is not supported on user attribute %s' % path)
+            if path.lower() == 'active':
+                # Azure AD sends the boolean as a string
+                self.active = value.lower() == 'true' if isinstance(value, str) else bool(value)
+            elif path.lower() == 'password':
+                self.password = value
+            else:
+                raise PatchValidationError(message='Only active and password can be patched on a user, value received was: %s' % path)
+        if self.active is None and self.password is None:
+            raise PatchValidationError(message='The PATCH request does not change active or password')
@@ -0,0 +1,78 @@
+from typing import List, Union
+
+# attribute paths may be prefixed with the core schema and resource type, ex: urn:ietf:params:scim:schemas:core:2.0:User:name.givenName
+CORE_SCHEMA_PREFIX = 'urn:ietf:params:scim:schemas:core:2.0:'
+
+# the lowercased attribute paths in an attributes or excludedAttributes parameter
+def attribute_paths(attributes: Union[str, None]) -> Union[List[str], None]:
+    if attributes is None: return None
+    paths = []
+    for path in attributes.split(','):
+        path = path.strip().lower()
+        if path.startswith(CORE_SCHEMA_PREFIX):
+            path = path[len(CORE_SCHEMA_PREFIX):].partition(':')[2]
+        if path != '': paths.append(path)
+    return paths
+
+# the paths of the sub-attributes of attribute in paths, [] if a path is the whole attribute and None if none
+# of the paths are in it. Extension attributes are URNs with their sub-attributes after a colon instead of a dot
+def sub_attributes(attribute: str, paths: List[str]) -> Union[List[str], None]:
+    attribute = attribute.lower()
+    found = None
+    for path in paths:
+        if path == attribute: return []
+        if path.startswith(attribute + '.') or path.startswith(attribute + ':'):
+            found = (found or []) + [path[len(attribute) + 1:]]
+    return found
+
+# a SCIM resource (or complex attribute) with only the included and without the excluded attributes,
+# included=None includes everything
+def project(resource: dict, included: Union[List[str], None], excluded: List[str], always_returned: List[str] = []) -> dict:
+    out = {}
+    for attribute, value in resource.items():
+        if attribute.lower() in always_returned:
+            out[attribute] = value
+            continue
+        sub_included = None if included is None else sub_attributes(attribute, included)
+        sub_excluded = sub_attributes(attribute, excluded)
+        if (included is not None and sub_included is None) or sub_excluded == []:
+            continue
+        # the whole attribute was asked for
+        if sub_included == []: sub_included = None
+        if sub_excluded is None: sub_excluded = []
+        if sub_included is None and sub_excluded == []:
+            out[attribute] = value
+        elif isinstance(value, dict):
+            out[attribute] = project(value, sub_included, sub_excluded)
+        elif isinstance(value, list):
+            # multi-valued attributes, ex: emails.value
+            out[attribute] = [project(item, sub_included, sub_excluded) if isinstance(item, dict) else item for item in value]
+        else:
+            out[attribute] = value
+    return out
+
+# the attributes and excludedAttributes query parameters (https://datatracker.ietf.org/doc/html/rfc7644#section-3.4.2.5).
+# The endpoints remove what is not returned from the response, backends can also use returns to skip loading it
+class Projection:
+    # returned no matter what the parameters ask for
+    ALWAYS_RETURNED: List[str] = ['id', 'schemas', 'meta']
+
+    def __init__(self, attributes: str = None, excluded_attributes: str = None) -> None:
+        # None returns every attribute
+        self.attributes: Union[List[str], None] = attribute_paths(attributes)
+        self.excluded_attributes: List[str] = attribute_paths(excluded_attributes) or []
+
+    # None if the request has neither parameter, the whole resource is returned
+    @classmethod
+    def from_args(cls, args: dict) -> Union['Projection', None]:
+        if 'attributes' not in args and 'excludedAttributes' not in args: return None
+        return cls(args.get('attributes'), args.get('excludedAttributes'))
+
+    # whether any part of a top level attribute is returned
+    def returns(self, attribute: str) -> bool:
+        if attribute.lower() in self.ALWAYS_RETURNED: return True
+        if self.attributes is not None and sub_attributes(attribute, self.attributes) is None: return False
+        return sub_attributes(attribute, self.excluded_attributes) != []
+
+    def apply(self, resource: dict) -> dict:
+        return project(resource, self.attributes, self.excluded_attributes, self.ALWAYS_RETURNED)
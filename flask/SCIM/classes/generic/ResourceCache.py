@@ -0,0 +1,123 @@
+import os
+import time
+import threading
+from uuid import uuid4
+from collections import OrderedDict
+from typing import Iterable, Tuple, Union
+
+from SCIM.helpers import set_up_logger, config
+from SCIM.classes.generic.Cache import Cache, file_lock
+
+logger = set_up_logger(__name__)
+
+# an encoded SCIM resource and its version (ETag), the version is None if the backend does not keep them
+CachedResource = Tuple[bytes, Union[str, None]]
+
+# read through cache of single encoded SCIM resources for GET /Users/<id> and GET /Groups/<id>. Each process keeps
+# its own LRU, writes are shared through an append only log of the invalidated ids in the cache dir, so a
+# lookup only costs a stat of the log when nothing was written. Backends have to call invalidate after
+# committing a change (the database backend does it from the session's after_commit event). Attributes of
+# related resources (ex: the display of a user's groups) can be up to ttl_sec old
+class ResourceCache:
+    max_size: int = int(config['Cache'].get('resource_cache_size', '10000') or 0)
+    ttl_sec: float = float(config['Cache'].get('resource_cache_ttl_sec', '60') or 0)
+    # the log is started over when it grows past this, every process then drops its whole cache
+    max_log_size: int = 1024*1024
+
+    def __init__(self, file_name: str = 'resource_invalidations.log') -> None:
+        if not os.path.exists(Cache.cache_base_dir):
+            os.mkdir(Cache.cache_base_dir)
+        self.log_file_path = os.path.join(Cache.cache_base_dir, file_name)
+        # (resource type, id) -> (time cached, (encoded resource, version)), least recently used first
+        self.entries: 'OrderedDict[Tuple[str, str], Tuple[float, CachedResource]]' = OrderedDict()
+        self.lock = threading.RLock()
+        # how far into the log this process has applied the invalidations
+        self.log_generation: Union[bytes, None] = None
+        self.log_offset = 0
+        self.log_stat: Union[Tuple[int, int], None] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl_sec > 0
+
+    def get(self, resource_type: str, resource_id: str) -> Union[CachedResource, None]:
+        if not self.enabled: return None
+        with self.lock:
+            self.read_invalidations()
+            entry = self.entries.get((resource_type, resource_id))
+            if entry is None: return None
+            cached, resource = entry
+            if time.monotonic() - cached > self.ttl_sec:
+                del self.entries[(resource_type, resource_id)]
+                return None
+            self.entries.move_to_end((resource_type, resource_id))
+            return resource
+
+    # take the position before reading the resource from the backend and pass it to put, if anything was
+    # invalidated in between the resource read may already be stale and is not cached
+    def position(self) -> Tuple[Union[bytes, None], int]:
+        with self.lock:
+            self.read_invalidations()
+            return self.log_generation, self.log_offset
+
+    def put(self, resource_type: str, resource_id: str, resource: CachedResource, position: Tuple[Union[bytes, None], int]) -> None:
+        if not self.enabled: return
+        with self.lock:
+            self.read_invalidations()
+            if position != (self.log_generation, self.log_offset): return
+            self.entries[(resource_type, resource_id)] = (time.monotonic(), resource)
+            self.entries.move_to_end((resource_type, resource_id))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # resource_ids=None invalidates every resource of resource_type
+    def invalidate(self, resource_type: str, resource_ids: Union[Iterable[str], None]) -> None:
+        if not self.enabled: return
+        ids = ['*'] if resource_ids is None else list(resource_ids)
+        if ids == []: return
+        with self.lock:
+            self.drop(resource_type, ids)
+        lines = b''.join(('%s %s\n' % (resource_type, id)).encode('utf-8') for id in ids)
+        with file_lock(self.log_file_path):
+            with open(self.log_file_path, 'ab') as log:
+                if log.tell() == 0 or log.tell() > self.max_log_size:
+                    log.truncate(0)
+                    log.write(uuid4().hex.encode('utf-8') + b'\n')
+                log.write(lines)
+
+    def drop(self, resource_type: str, ids: Iterable[str]) -> None:
+        for id in ids:
+            if id == '*':
+                for key in [key for key in self.entries if key[0] == resource_type]:
+                    del self.entries[key]
+            else:
+                self.entries.pop((resource_type, id), None)
+
+    # applies the invalidations other processes appended to the log since the last call
+    def read_invalidations(self) -> None:
+        try:
+            stat = os.stat(self.log_file_path)
+            log_stat = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            log_stat = (0, 0)
+        if log_stat == self.log_stat: return
+        with file_lock(self.log_file_path, shared=True):
+            with open(self.log_file_path, 'rb') as log:
+                generation = log.readline()
+                if generation != self.log_generation:
+                    # the log was started over, the invalidations before that are gone
+                    logger.info('Resource invalidation log changed generation, clearing resource cache')
+                    self.entries.clear()
+                    self.log_generation = generation
+                    log.seek(0, os.SEEK_END)
+                else:
+                    log.seek(self.log_offset)
+                    for line in log:
+                        resource_type, _, id = line.decode('utf-8').rstrip('\n').partition(' ')
+                        self.drop(resource_type, [id])
+                self.log_offset = log.tell()
+                # nothing can be appended while the shared lock is held, so the size is the offset
+                self.log_stat = (self.log_offset, os.fstat(log.fileno()).st_mtime_ns)
+
+# one per process, shared by the endpoints that read through it and the backends that invalidate it
+resource_cache = ResourceCache()
@@ -1,8 +1,15 @@
 from typing import List
 
+# computed once instead of for every resource, the schemas list is shared by every scim_resource and must not be modified
+GROUP_CUSTOM_SCHEMA = 'urn:okta:custom:group:1.0'
+GROUP_SCHEMAS = [GROUP_CUSTOM_SCHEMA, "urn:scim:schemas:core:1.0"]
+
 # this class is used to convert scim objects to a python oject, and vice versa
 # this class is meant to be general and work for all backends, therefore the backend conversion portions will be split from this
 class SCIMGroup(object):
+    # a full import holds one of these per group, slots keep them small and attribute access fast
+    __slots__ = ('id', 'displayName', 'members', 'custom_attributes')
+
     def __init__(self, resource, init_type='scim'):
         self.id = ""
         self.displayName = ""
@@ -15,6 +22,16 @@ class SCIMGroup(object):
         elif init_type == 'backend':
             self.update_from_backend(resource)
 
+    # builds the group straight from a backend's values, without the generic dict update_from_backend takes
+    @classmethod
+    def from_backend(cls, id: str, displayName: str, members: List[dict] = None, custom_attributes: dict = None) -> 'SCIMGroup':
+        group = cls.__new__(cls)
+        group.id = id
+        group.displayName = displayName
+        group.members = [] if members is None else members
+        group.custom_attributes = {} if custom_attributes is None else custom_attributes
+        return group
+
     # this function is used to convert the SCIM object to this Groups object
     # examples can be found here: https://developer.okta.com/docs/reference/scim/scim-20/
     def update_from_scim(self, resource: dict) -> None:
@@ -23,26 +40,21 @@ class SCIMGroup(object):
                 setattr(self, attribute, resource[attribute])
         # get custom attributes
         try:
-            for attribute in resource['urn:okta:custom:group:1.0']:
-                self.custom_attributes[attribute] = resource['urn:okta:custom:group:1.0'][attribute]
+            for attribute in resource[GROUP_CUSTOM_SCHEMA]:
+                self.custom_attributes[attribute] = resource[GROUP_CUSTOM_SCHEMA][attribute]
         except KeyError:
             pass
 
     # this function is used by the backend to populate this object, it takes in a generic dict with all the attributes
     def update_from_backend(self, resource: dict) -> None:
-        keys = dict(resource).keys()
-        if 'id' in keys: self.id = resource['id']
-        if 'displayName' in keys: self.active = resource['displayName']
-        if 'members' in keys: self.members = resource['members']
-        if 'custom_attributes' in keys: self.custom_attributes = resource['custom_attributes']
-        
-
+        for attribute in self.__slots__:
+            if attribute in resource: setattr(self, attribute, resource[attribute])
 
     # this function is used to convert this Group object to a SCIM formatted dict to be returned to Okta
     @property
     def scim_resource(self) -> dict:
         rv = {
-            "schemas": ["urn:okta:custom:group:1.0" "urn:scim:schemas:core:1.0"],
+            "schemas": GROUP_SCHEMAS,
             "id": self.id,
             "displayName": self.displayName,
             "members": self.members,
@@ -54,10 +66,14 @@ class SCIMGroup(object):
                 # "created": "2010-01-23T04:56:22Z",
                 # "lastModified": "2011-05-13T04:42:34Z",
             #},
-            "urn:okta:custom:group:1.0": self.custom_attributes
+            GROUP_CUSTOM_SCHEMA: self.custom_attributes
         }
         return rv
 
+    def __repr__(self) -> str:
+        out = {attribute: getattr(self, attribute, None) for attribute in self.__slots__}
+        return 'SCIMGroup<%s>' % str(out)
+
 def obj_list_to_scim_json_list(scim_user_obj_list: List[SCIMGroup]) -> List[dict]:
     out = []
     for obj in scim_user_obj_list:
@@ -2,9 +2,17 @@ from typing import List
 
 from SCIM import APP_SCHEMA
 
+# computed once instead of for every resource, the schemas list is shared by every scim_resource and must not be modified
+USER_CUSTOM_SCHEMA = 'urn:okta:%s:1.0:user:custom' % APP_SCHEMA
+USER_SCHEMAS = ["urn:scim:schemas:extension:enterprise:1.0", USER_CUSTOM_SCHEMA, "urn:scim:schemas:core:1.0"]
+
 # this class is used to convert scim objects to a python oject, and vice versa
 # this class is meant to be general and work for all backends, therefore the backend conversion portions will be split from this
 class SCIMUser(object):
+    # a full import holds one of these per user, slots keep them small and attribute access fast
+    __slots__ = ('id', 'active', 'userName', 'familyName', 'middleName', 'givenName', 'email', 'secondaryEmail',
+                 'mobilePhone', 'password', 'groups', 'custom_attributes')
+
     def __init__(self, resource, init_type='scim'):
         self.id = ""
         self.active: bool
@@ -26,6 +34,26 @@ class SCIMUser(object):
         elif init_type == 'backend':
             self.update_from_backend(resource)
 
+    # builds the user straight from a backend's values, without the generic dict update_from_backend takes
+    @classmethod
+    def from_backend(cls, id: str, active: bool, userName: str, familyName: str = "", middleName: str = "", givenName: str = "",
+                     email: str = "", secondaryEmail: str = "", mobilePhone: str = "", password: str = "",
+                     groups: List[dict] = None, custom_attributes: dict = None) -> 'SCIMUser':
+        user = cls.__new__(cls)
+        user.id = id
+        user.active = active
+        user.userName = userName
+        user.familyName = familyName
+        user.middleName = middleName
+        user.givenName = givenName
+        user.email = email
+        user.secondaryEmail = secondaryEmail
+        user.mobilePhone = mobilePhone
+        user.password = password
+        user.groups = [] if groups is None else groups
+        user.custom_attributes = {} if custom_attributes is None else custom_attributes
+        return user
+
     # this function is used to convert the SCIM object to this User object
     # examples can be found here: https://developer.okta.com/docs/reference/scim/scim-20/
     def update_from_scim(self, resource: dict) -> None:
@@ -62,82 +90,81 @@ class SCIMUser(object):
 
     # this function is used by the backend to populate this object, it takes in a generic dict with all the attributes
     def update_from_backend(self, resource: dict) -> None:
-        keys = dict(resource).keys()
-        if 'id' in keys: self.id = resource['id']
-        if 'active' in keys: self.active = resource['active']
-        if 'userName' in keys: self.userName = resource['userName']
-        if 'familyName' in keys: self.familyName = resource['familyName']
-        if 'middleName' in keys: self.middleName = resource['middleName']
-        if 'givenName' in keys: self.givenName = resource['givenName']
-        if 'email' in keys: self.email = resource['email']
-        if 'secondaryEmail' in keys: self.secondaryEmail = resource['secondaryEmail']
-        if 'mobilePhone' in keys: self.mobilePhone = resource['mobilePhone']
-        if 'password' in keys: self.password = resource['password']
-        if 'custom_attributes' in keys: self.custom_attributes = resource['custom_attributes']
-        if 'groups' in keys: self.groups = resource['groups']
-        
-
+        for attribute in self.__slots__:
+            if attribute in resource: setattr(self, attribute, resource[attribute])
 
     # this function is used to convert this User object to a SCIM formatted dict to be returned to Okta
     @property
     def scim_resource(self) -> dict:
-        if self.secondaryEmail == "":
-            emails = [
-                {
-                    "primary": True,
-                    "value": self.email,
-                    "type": "primary"
-                }
-            ]
-        else:
-            emails = [
-                {
-                    "primary": True,
-                    "value": self.email,
-                    "type": "primary"
-                },
-                {
-                    "primary": False,
-                    "value": self.secondaryEmail,
-                    "type": "secondary"
-                }
-            ]
-        rv = {
-            "schemas": ["urn:scim:schemas:extension:enterprise:1.0", "urn:okta:%s:1.0:user:custom" % APP_SCHEMA, "urn:scim:schemas:core:1.0"],
-            "id": self.id,
-            "userName": self.userName,
-            "name": {
-                "familyName": self.familyName,
-                "givenName": self.givenName,
-                "middleName": self.middleName,
-            },
-            "active": self.active,
-            #"meta": {
-            #    "resourceType": "User",
-            #    "location": url_for('user_get',
-            #                        user_id=self.id,
-            #                        _external=True)
-                # "created": "2010-01-23T04:56:22Z",
-                # "lastModified": "2011-05-13T04:42:34Z",
-            #},
-            "emails": emails,
-            "urn:okta:%s:1.0:user:custom" % APP_SCHEMA: self.custom_attributes
-        }
-        if self.mobilePhone != "":
-            phone_numbers = [
-                {
-                    "primary": True,
-                    "value": self.mobilePhone,
-                    "type": "mobile"
-                }
-            ]
-            rv['phoneNumbers'] = phone_numbers
-        if self.groups != []:
-            rv['groups'] = self.groups
-        return rv
+        return scim_user_resource(self.id, self.active, self.userName, self.familyName, self.middleName, self.givenName, self.email,
+                                  self.secondaryEmail, self.mobilePhone, self.groups, self.custom_attributes)
+
+    def __repr__(self) -> str:
+        # the password is left out of logs
+        out = {attribute: getattr(self, attribute, None) for attribute in self.__slots__ if attribute != 'password'}
+        return 'SCIMUser<%s>' % str(out)
 
 def obj_list_to_scim_json_list(scim_user_obj_list: List[SCIMUser]) -> List[dict]:
     out = []
     for obj in scim_user_obj_list:
         out.append(obj.scim_resource)
-    return out
\ No newline at end of file
+    return out
+
+# the SCIM formatted dict of a user, shared by SCIMUser.scim_resource and backends that build resources straight
+# from their rows without a SCIMUser (ex: list_user_resources in DBUsersBackend)
+def scim_user_resource(id: str, active: bool, userName: str, familyName: str, middleName: str, givenName: str, email: str,
+                       secondaryEmail: str, mobilePhone: str, groups: List[dict], custom_attributes: dict) -> dict:
+    if secondaryEmail == "":
+        emails = [
+            {
+                "primary": True,
+                "value": email,
+                "type": "primary"
+            }
+        ]
+    else:
+        emails = [
+            {
+                "primary": True,
+                "value": email,
+                "type": "primary"
+            },
+            {
+                "primary": False,
+                "value": secondaryEmail,
+                "type": "secondary"
+            }
+        ]
+    rv = {
+        "schemas": USER_SCHEMAS,
+        "id": id,
+        "userName": userName,
+        "name": {
+            "familyName": familyName,
+            "givenName": givenName,
+            "middleName": middleName,
+        },
+        "active": active,
+        #"meta": {
+        #    "resourceType": "User",
+        #    "location": url_for('user_get',
+        #                        user_id=id,
+        #                        _external=True)
+            # "created": "2010-01-23T04:56:22Z",
+            # "lastModified": "2011-05-13T04:42:34Z",
+        #},
+        "emails": emails,
+        USER_CUSTOM_SCHEMA: custom_attributes
+    }
+    if mobilePhone != "":
+        phone_numbers = [
+            {
+                "primary": True,
+                "value": mobilePhone,
+                "type": "mobile"
+            }
+        ]
+        rv['phoneNumbers'] = phone_numbers
+    if groups != []:
+        rv['groups'] = groups
+    return rv
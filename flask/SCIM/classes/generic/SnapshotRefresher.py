@@ -0,0 +1,92 @@
+import time
+import threading
+from flask import Flask
+from typing import List, Tuple, Callable, Set
+
+from SCIM.helpers import set_up_logger, config
+from SCIM.classes.generic.Cache import Cache
+
+logger = set_up_logger(__name__)
+
+class SnapshotRefresher:
+    refresh_interval_sec: float = float(config['Cache'].get('refresh_interval_min', '0') or 0)*60
+    # how often the registered tasks run when the snapshots are not refreshed
+    task_interval_sec: float = 60*60
+
+    def __init__(self, app: Flask) -> None:
+        self.app = app
+        # (cache, function returning the resources to snapshot) for every snapshot kept warm
+        self.snapshots: List[Tuple[Cache, Callable[[], List[dict]]]] = []
+        # housekeeping run by the same thread (ex: pruning the backend's change journal)
+        self.tasks: List[Callable[[], None]] = []
+        # caches with a background refresh running in this process
+        self.refreshing: Set[Cache] = set()
+        self.refreshing_lock = threading.Lock()
+        self.started = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.refresh_interval_sec > 0
+
+    @property
+    def interval_sec(self) -> float:
+        return self.refresh_interval_sec if self.enabled else self.task_interval_sec
+
+    def register(self, cache: Cache, build: Callable[[], List[dict]]) -> None:
+        self.snapshots.append((cache, build))
+
+    # tasks run every interval in every worker process, even when the snapshots are not refreshed, so they
+    # have to be safe to run concurrently
+    def register_task(self, task: Callable[[], None]) -> None:
+        self.tasks.append(task)
+
+    # every worker process runs its own refresher thread, the build lock and the age check in
+    # Cache.refresh_snapshot make sure only one of them rebuilds a snapshot per interval
+    def start(self) -> None:
+        snapshots = self.snapshots if self.enabled else []
+        if self.started or (snapshots == [] and self.tasks == []): return
+        self.started = True
+        logger.info('Starting snapshot refresher, running every %f minutes' % (self.interval_sec / 60))
+        threading.Thread(target=self.run, name='snapshot-refresher', daemon=True).start()
+
+    def run(self) -> None:
+        while True:
+            for cache, build in (self.snapshots if self.enabled else []):
+                # refresh if older than half the interval, the workers' timers are not in sync so a snapshot
+                # another worker refreshed just before this one woke up is left alone
+                self.refresh(cache, build, self.refresh_interval_sec / 2)
+            for task in self.tasks:
+                self.run_task(task)
+            time.sleep(self.interval_sec)
+
+    def run_task(self, task: Callable[[], None]) -> None:
+        try:
+            with self.app.app_context():
+                task()
+        except Exception as e:
+            logger.exception('Error running refresher task: %s' % e)
+
+    def refresh(self, cache: Cache, build: Callable[[], List[dict]], max_age_sec: float) -> None:
+        try:
+            # the backend needs an app context outside of a request
+            with self.app.app_context():
+                cache.refresh_snapshot(build, max_age_sec)
+        except Exception as e:
+            logger.exception('Error refreshing snapshot %s: %s' % (cache.cache_file_path, e))
+
+    # stale while revalidate: the request that found the snapshot stale keeps serving it while it is rebuilt
+    def refresh_async(self, cache: Cache) -> None:
+        for registered_cache, build in self.snapshots:
+            if registered_cache is cache: break
+        else:
+            return
+        with self.refreshing_lock:
+            if cache in self.refreshing: return
+            self.refreshing.add(cache)
+        def refresh_stale() -> None:
+            try:
+                self.refresh(cache, build, cache.cache_lifetime_sec)
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.discard(cache)
+        threading.Thread(target=refresh_stale, name='snapshot-revalidate', daemon=True).start()
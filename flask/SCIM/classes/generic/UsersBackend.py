@@ -1,33 +1,73 @@
-from typing import List, Union
+from contextlib import nullcontext
+from typing import List, Union, ContextManager
 
-from SCIM.classes.generic.SCIMUser import SCIMUser
+from SCIM.classes.generic.SCIMUser import SCIMUser, obj_list_to_scim_json_list
+from SCIM.classes.generic.Patch import UserPatch
+from SCIM.classes.generic.Projection import Projection
 
 # this is inteded to be used as an interface which is extended for a specific backend
 class UserBackend:
+    # writes made inside the returned context manager should be committed together as one transaction,
+    # or all rolled back if it raises. Used by /Bulk, backends without transactions can leave this as is
+    def batch(self) -> ContextManager[None]:
+        return nullcontext()
+
     # returns None if a user with user_id cannot be found
-    def get_user(self, user_id: str) -> Union[SCIMUser, None]:
+    def get_user(self, user_id: str, load_strategy: str = 'joined') -> Union[SCIMUser, None]:
+        return None
+
+    # an opaque string that changes whenever the user's SCIM resource changes, used as its weak ETag.
+    # Should be cheaper than get_user. Return None if a user with user_id cannot be found, backends
+    # that dont keep versions can leave this as is and no ETags are sent
+    def get_user_version(self, user_id: str) -> Union[str, None]:
         return None
 
     # returns an empty list if there were no users found 
-    def list_users(self, filter: str=None) -> List[SCIMUser]:
+    # start_index is 1 based like the SCIM startIndex and count=None returns everything after it.
+    # after_id continues after the last id of a previous page (keyset pagination) and replaces start_index.
+    # results should be in a stable order (ex: by id) so pages do not overlap.
+    # projection is the attributes the request asks for (None for all of them), backends can skip loading the ones it
+    # does not return. The endpoints remove them from the response either way
+    def list_users(self, filter: str=None, load_strategy: str='selectin', start_index: int=1, count: int=None, after_id: str=None, projection: Projection=None) -> List[SCIMUser]:
         return []
 
+    # the scim_resource of each user list_users would return, used for the pages and snapshots of unprojected lists.
+    # Backends that can build the resources without SCIMUsers in between can override this
+    def list_user_resources(self, filter: str=None, start_index: int=1, count: int=None, after_id: str=None) -> List[dict]:
+        return obj_list_to_scim_json_list(self.list_users(filter=filter, start_index=start_index, count=count, after_id=after_id))
+
+    # return the number of users matching the filter, used for totalResults when only a page is listed
+    def count_users(self, filter: str=None) -> int:
+        return len(self.list_users(filter=filter))
+
     def create_user(self, scim_user: SCIMUser) -> SCIMUser:
         pass
 
     def update_user(self, scim_user: SCIMUser) -> SCIMUser:
         pass
 
-    # should only be called in PATCH
-    # not supported in OPP conectors yet
-    def enable_user(self, scim_user: SCIMUser) -> SCIMUser:
+    # applies a PATCH with the methods below, return None if a user with user_id cannot be found
+    def patch_user(self, user_id: str, patch: UserPatch) -> Union[SCIMUser, None]:
+        scim_user = SCIMUser({'id': user_id}, init_type='backend')
+        out_scim_user = None
+        # the password and active changes are committed together
+        with self.batch():
+            if patch.password is not None:
+                scim_user.password = patch.password
+                out_scim_user = self.reset_password(scim_user)
+            if patch.active is not None:
+                out_scim_user = self.enable_user(scim_user) if patch.active else self.disable_user(scim_user)
+        return out_scim_user
+
+    # should only be called in PATCH, return None if a user with scim_user.id cannot be found
+    def enable_user(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
         pass
 
-    # should only be called in PATCH
-    # not supported in OPP conectors yet
-    def disable_user(self, scim_user: SCIMUser) -> SCIMUser:
+    # should only be called in PATCH, return None if a user with scim_user.id cannot be found
+    def disable_user(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
         pass
 
-    # this should only be used if the password can't be updated with the user profile at the same time (if the password is stored somewhere else)
-    def reset_password(self, scim_user: SCIMUser) -> SCIMUser:
+    # called in PATCH, and should be used if the password can't be updated with the user profile at the same time
+    # (if the password is stored somewhere else). Return None if a user with scim_user.id cannot be found
+    def reset_password(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
         pass
\ No newline at end of file
@@ -0,0 +1,38 @@
+from typing import Callable, Dict
+from sqlalchemy import and_, or_, not_
+from sqlalchemy.sql.elements import ColumnElement
+
+from SCIM.classes.generic.Filter import Filter, FilterNode, Comparison, And, Or, Not
+
+# SQLAlchemy expression for each SCIM comparator given the column (search_key) and value (search_value)
+# https://datatracker.ietf.org/doc/html/rfc7644#section-3.4.2.2
+SQL_OPERATORS: Dict[str, Callable] = {
+    'eq': lambda key, value: key == value,
+    'ne': lambda key, value: key != value,
+    'co': lambda key, value: key.contains(value, autoescape=True),
+    'sw': lambda key, value: key.startswith(value, autoescape=True),
+    'ew': lambda key, value: key.endswith(value, autoescape=True),
+    'gt': lambda key, value: key > value,
+    'lt': lambda key, value: key < value,
+    'ge': lambda key, value: key >= value,
+    'le': lambda key, value: key <= value,
+    'pr': lambda key, value: key.isnot(None)
+}
+
+# lowers the whole filter to one SQLAlchemy expression so compound filters are evaluated by the
+# database, set_search_key_and_value in the subclass maps each comparison to a column and value
+class DBFilter(Filter):
+    @property
+    def expression(self) -> ColumnElement:
+        return self.lower(self.ast)
+
+    def lower(self, node: FilterNode) -> ColumnElement:
+        if isinstance(node, Comparison):
+            self.set_search_key_and_value(node)
+            return SQL_OPERATORS[node.operator](self.search_key, self.search_value)
+        elif isinstance(node, And):
+            return and_(self.lower(node.left), self.lower(node.right))
+        elif isinstance(node, Or):
+            return or_(self.lower(node.left), self.lower(node.right))
+        elif isinstance(node, Not):
+            return not_(self.lower(node.operand))
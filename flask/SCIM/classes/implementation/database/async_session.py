@@ -0,0 +1,83 @@
+import asyncio
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, TypeVar, Union, Tuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+
+from SCIM import db, LOCAL_DATABASE
+from SCIM.helpers import config
+from SCIM.classes.implementation.database.transaction import invalidate_changed_resources, forget_changed_resources
+
+# the sessions of the async backends. Each call runs the sync backend method in the sync session of an AsyncSession,
+# so the ORM code is shared and its statements are awaited on the database's asyncio driver
+# https://docs.sqlalchemy.org/en/14/orm/extensions/asyncio.html#running-synchronous-methods-and-functions-under-asyncio
+
+T = TypeVar('T')
+
+# the asyncio driver used in place of the sync one for each dialect, it has to be installed next to it
+# (ex: pip install asyncpg for postgresql). The local example database uses aiosqlite
+ASYNC_DRIVERS = {
+    'sqlite': 'aiosqlite',
+    'postgresql': 'asyncpg',
+    'mysql': 'aiomysql',
+    'mariadb': 'aiomysql'
+}
+
+# the sync session class of the AsyncSessions, it invalidates the resource cache on commit like db.session does.
+# The statements all go to the primary, the replica reads are only routed for db.session
+class BackendSession(Session):
+    pass
+
+event.listen(BackendSession, 'after_commit', invalidate_changed_resources)
+event.listen(BackendSession, 'after_rollback', forget_changed_resources)
+
+# created on the first call, after uwsgi forked the worker. The database is the same one db.engine connects to
+engine: Union[AsyncEngine, None] = None
+
+def async_engine() -> AsyncEngine:
+    global engine
+    if engine is None:
+        url = db.engine.url
+        dialect = url.get_backend_name()
+        if LOCAL_DATABASE:
+            options = {}
+        else:
+            from SCIM.classes.implementation.database.pool import async_engine_options
+            options = async_engine_options(config['Database'])
+        engine = create_async_engine(url.set(drivername='%s+%s' % (dialect, ASYNC_DRIVERS[dialect])), **options)
+    return engine
+
+# the AsyncSession of the batch the current task is in and the lock its calls take turns on, since a session runs
+# one call at a time (ex: calls gathered inside the batch). Each task (ex: each request of an ASGI app) has its own
+current_batch: ContextVar[Union[Tuple[AsyncSession, asyncio.Lock], None]] = ContextVar('current_batch', default=None)
+
+# runs func with a sync session, the one of the current batch or a new one closed once func returns
+async def run_in_session(func: Callable[[Session], T]) -> T:
+    if current_batch.get() is not None:
+        session, lock = current_batch.get()
+        async with lock:
+            return await session.run_sync(func)
+    async with AsyncSession(async_engine(), sync_session_class=BackendSession) as session:
+        return await session.run_sync(func)
+
+# the async version of batch in transaction.py, every call made in the async with block runs in one session
+# and is committed at the end of the outermost block, or rolled back if it raises
+@asynccontextmanager
+async def batch() -> AsyncIterator[None]:
+    if current_batch.get() is not None:
+        yield
+        return
+    async with AsyncSession(async_engine(), sync_session_class=BackendSession) as session:
+        token = current_batch.set((session, asyncio.Lock()))
+        # the backends' commits only flush, like they do in a batch of db.session
+        session.sync_session.info['batch_depth'] = 1
+        try:
+            yield
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            current_batch.reset(token)
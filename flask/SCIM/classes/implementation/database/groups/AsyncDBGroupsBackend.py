@@ -0,0 +1,41 @@
+from typing import List, Union, AsyncContextManager
+
+from SCIM.classes.generic.SCIMGroup import SCIMGroup
+from SCIM.classes.generic.Patch import GroupPatch
+from SCIM.classes.generic.Projection import Projection
+from SCIM.classes.generic.AsyncGroupsBackend import AsyncGroupsBackend
+from SCIM.classes.implementation.database.async_session import batch, run_in_session
+from SCIM.classes.implementation.database.groups.DBGroupsBackend import DBGroupsBackend
+
+# DBGroupsBackend on the database's asyncio driver, see async_session.py. The mappings are all in DBGroupsBackend,
+# every call here runs its method in the session of the call
+class AsyncDBGroupsBackend(AsyncGroupsBackend):
+    # shared with AsyncDBUsersBackend, a batch from either one covers both
+    def batch(self) -> AsyncContextManager[None]:
+        return batch()
+
+    async def get_group(self, group_id: str, load_strategy: str = 'joined') -> Union[SCIMGroup, None]:
+        return await run_in_session(lambda session: DBGroupsBackend(session).get_group(group_id, load_strategy))
+
+    async def get_group_version(self, group_id: str) -> Union[str, None]:
+        return await run_in_session(lambda session: DBGroupsBackend(session).get_group_version(group_id))
+
+    async def list_groups(self, filter: str = None, load_strategy: str = 'selectin', start_index: int = 1, count: int = None, after_id: str = None, projection: Projection = None) -> List[SCIMGroup]:
+        return await run_in_session(lambda session: DBGroupsBackend(session).list_groups(filter=filter, load_strategy=load_strategy, start_index=start_index,
+                                                                                         count=count, after_id=after_id, projection=projection))
+
+    async def count_groups(self, filter: str = None) -> int:
+        return await run_in_session(lambda session: DBGroupsBackend(session).count_groups(filter=filter))
+
+    async def create_group(self, scim_group: SCIMGroup) -> SCIMGroup:
+        return await run_in_session(lambda session: DBGroupsBackend(session).create_group(scim_group))
+
+    async def update_group(self, scim_group: SCIMGroup) -> SCIMGroup:
+        return await run_in_session(lambda session: DBGroupsBackend(session).update_group(scim_group))
+
+    # only the members the patch changes are written, see DBGroupsBackend.patch_group
+    async def patch_group(self, group_id: str, patch: GroupPatch) -> bool:
+        return await run_in_session(lambda session: DBGroupsBackend(session).patch_group(group_id, patch))
+
+    async def delete_group(self, group_id: str) -> None:
+        return await run_in_session(lambda session: DBGroupsBackend(session).delete_group(group_id))
@@ -1,25 +1,40 @@
 import logging
 import uuid
-from typing import List
+from typing import List, ContextManager, Union
 from datetime import datetime
+from sqlalchemy.orm import Session
 
 from SCIM import db
 from SCIM.helpers import set_up_logger, LOG_LEVEL
+from SCIM.classes.generic.Projection import Projection
 from SCIM.classes.generic.GroupsBackend import GroupsBackend
 from SCIM.classes.generic.SCIMGroup import SCIMGroup
-from SCIM.classes.implementation.database.models import GroupsDB, UsersGroupsAssociation
+from SCIM.classes.generic.Patch import GroupPatch
+from SCIM.classes.implementation.database.transaction import batch, commit, replica_read
+from SCIM.classes.implementation.database.models import GroupsDB, UsersGroupsAssociation, ChangeJournal, chunks
 from SCIM.classes.implementation.database.groups.DBGroupsFilter import DBGroupsFilter
 
 logger = set_up_logger(__name__)
 
 class DBGroupsBackend(GroupsBackend):
-    def get_group(self, group_id: str) -> SCIMGroup:
+    # the session the statements run in. By default it is db.session, the scoped session of the current request,
+    # the async backends run this one in the session of each of their calls instead
+    def __init__(self, session: Session = db.session) -> None:
+        self.session = session
+
+    # the users and groups backends share one session, so a batch from either one covers both
+    def batch(self) -> ContextManager[None]:
+        return batch(self.session)
+
+    # the reads go to a read replica when there is one, see replica_read in transaction.py
+    @replica_read
+    def get_group(self, group_id: str, load_strategy: str = 'joined') -> SCIMGroup:
         # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
         # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
         # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
         # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
         # name= input on the Column() constructor
-        group_db_object: List[GroupsDB] = GroupsDB.query.filter_by(id=group_id).all()
+        group_db_object: List[GroupsDB] = self.session.query(GroupsDB).options(*GroupsDB.load_options(load_strategy)).filter_by(id=group_id).all()
 
 
         if len(group_db_object) > 1:
@@ -30,27 +45,58 @@ class DBGroupsBackend(GroupsBackend):
         else:
             return group_db_object[0].scim_group
 
-    def list_groups(self, filter: str = None) -> List[SCIMGroup]:
+    # one row from the groups table and the change journal, the group and its members are not loaded
+    @replica_read
+    def get_group_version(self, group_id: str) -> Union[str, None]:
+        return ChangeJournal.version('Group', GroupsDB, group_id, self.session)
+
+    # applies a SCIM filter string to a GroupsDB query
+    def filter_query(self, query, filter: str = None):
+        if filter is None:
+            return query
+        filter_obj = DBGroupsFilter(filter)
+        # incremental imports, the change journal has the ids that changed since the filter's timestamp so
+        # lastModified does not need to be scanned, and it also has the membership changes
+        # lastModified MAPPING IMPLEMENTATION HERE, IF NOT SUPPORTED THEN REMOVE
+        if filter_obj.search_key is GroupsDB.lastModified and filter_obj.comparator == 'gt':
+            changed_ids = ChangeJournal.changed_since('Group', filter_obj.search_value, self.session)
+            if changed_ids is not None:
+                return query.filter(GroupsDB.id.in_(changed_ids))
+            logger.info('Change journal does not go back to %s, scanning lastModified' % filter_obj.search_value)
+        # the whole filter, compound or not, is one expression evaluated by the database
+        return query.filter(filter_obj.expression)
+
+    @replica_read
+    def list_groups(self, filter: str = None, load_strategy: str = 'selectin', start_index: int = 1, count: int = None, after_id: str = None, projection: Projection = None) -> List[SCIMGroup]:
         out: List[SCIMGroup] = []
-        group_db_objs: List[GroupsDB] = []
 
         # Check for filter, create one if needed, and query the groups
-        if filter is None:
-            group_db_objs: List[GroupsDB] = GroupsDB.query.all()
-        else:
-            filter_obj = DBGroupsFilter(filter)
-            if filter_obj.comparator == 'lt':
-                group_db_objs = GroupsDB.query.filter(filter_obj.search_key < filter_obj.search_value).all()
-            elif filter_obj.comparator == 'eq':
-                group_db_objs = GroupsDB.query.filter(filter_obj.search_key == filter_obj.search_value).all()
-            elif filter_obj.comparator == 'gt':
-                group_db_objs = GroupsDB.query.filter(filter_obj.search_key > filter_obj.search_value).all()
+        # a projection selects only the columns it returns and skips the members if it does not return them
+        query = self.filter_query(self.session.query(GroupsDB).options(*GroupsDB.load_options(load_strategy, projection)), filter)
+        # the pages need a stable order, the primary key is always indexed
+        # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
+        # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
+        # COLUMN THEN IT WILL NEED TO BE CHANGED
+        query = query.order_by(GroupsDB.id)
+        # keyset pagination, continue after the last id of the previous page instead of
+        # having the DB walk and throw away every row before the offset
+        if after_id is not None:
+            query = query.filter(GroupsDB.id > after_id)
+        elif start_index > 1:
+            query = query.offset(start_index - 1)
+        if count is not None:
+            query = query.limit(count)
+        group_db_objs: List[GroupsDB] = query.all()
 
         # format output as scim objects to return to Okta
         for group in group_db_objs: 
             out.append(group.scim_group)
 
         return out
+
+    @replica_read
+    def count_groups(self, filter: str = None) -> int:
+        return self.filter_query(self.session.query(GroupsDB), filter).count()
     
     def create_group(self, scim_group: SCIMGroup) -> SCIMGroup:
         # if no unique ID exists on incoming scim object, create one
@@ -62,7 +108,7 @@ class DBGroupsBackend(GroupsBackend):
             id = scim_group.id
 
         if LOG_LEVEL == logging.DEBUG:
-            logger.debug('Creating group in DB: %s' % vars(scim_group))
+            logger.debug('Creating group in DB: %s' % scim_group)
         else:
             logger.info('Creating %s in groups DB' % scim_group.displayName)
 
@@ -84,39 +130,37 @@ class DBGroupsBackend(GroupsBackend):
         db_group.lastModified = datetime.now()
 
 
-        db.session.add(db_group)
-        db.session.commit()
-        if LOG_LEVEL == logging.DEBUG:
-            logger.debug('Group create sucessful: %s' % str(db_group))
-        else:
-            logger.info('%s created successfully' % scim_group.displayName)
+        self.session.add(db_group)
+        ChangeJournal.record('Group', [id], self.session)
+        # the group row has to exist before the member assignments reference it
+        self.session.flush()
 
         # MAPPING IMPLEMENTATION HERE, THIS LOGIC MAY NEED TO CHANGE DEPENDING ON YOUR SQL STRUCTURE
         # if the group has members to create with...
         if scim_group.members != []:
             logger.info('Attempting to assign %s to %i users' % (scim_group.displayName, len(scim_group.members)))
-            # users take the form of {value: user.id, display: some attribute that doesnt matter}
-            for user in scim_group.members:
-                # group assignments have to be done through the associatio object
-                assoc = UsersGroupsAssociation(user_id=user['value'], group_id=id)
-                db.session.add(assoc)
-            db.session.commit()
-            logger.info('%i users successfully assigned to %s' % (len(scim_group.members), scim_group.displayName))
-            # if in debug mode print a statement with the new groups name as well as a list of the members
-            if LOG_LEVEL == logging.DEBUG:
-                # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
-                # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
-                # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
-                # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
-                # name= input on the Column() constructor
-                new_db_group: GroupsDB = GroupsDB.query.filter_by(id=id).first()
-                members_list: List[str] = []
-                for user in new_db_group.members:
-                    members_list.append(user.scim_user.userName)
-                logger.debug('%s\'s members: %s' % (scim_group.displayName, str(members_list)))
-
-
-        return db_group.scim_group
+            # users take the form of {value: user.id, display: some attribute that doesnt matter}, the
+            # assignments are inserted in bulk
+            user_ids = {user['value'] for user in scim_group.members}
+            UsersGroupsAssociation.add_members(id, user_ids, self.session)
+            # the members gained a group
+            ChangeJournal.record('User', user_ids, self.session)
+            logger.info('%i users successfully assigned to %s' % (len(user_ids), scim_group.displayName))
+
+        # the group and its members are committed together
+        commit(self.session)
+        if LOG_LEVEL == logging.DEBUG:
+            logger.debug('Group create sucessful: %s' % str(db_group))
+        else:
+            logger.info('%s created successfully' % scim_group.displayName)
+
+
+        # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
+        # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
+        # COLUMN THEN IT WILL NEED TO BE CHANGED
+        # the members were inserted outside of the session, load them with the group in one query
+        self.session.expire(db_group, ['member_associations'])
+        return self.session.query(GroupsDB).options(*GroupsDB.load_options('joined')).filter_by(id=id).first().scim_group
 
     def update_group(self, scim_group: SCIMGroup) -> SCIMGroup:
         # we can assume they exist because a get is always called before the update to check for existance 
@@ -126,9 +170,12 @@ class DBGroupsBackend(GroupsBackend):
         # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
         # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
         # name= input on the Column() constructor
-        group_db_object: GroupsDB = GroupsDB.query.filter_by(id=scim_group.id).first()
+        group_db_object: GroupsDB = self.session.query(GroupsDB).filter_by(id=scim_group.id).first()
 
 
+        # the members show the group's name, a rename changes them too
+        if group_db_object.displayName != scim_group.displayName:
+            ChangeJournal.record_select('User', UsersGroupsAssociation.user_id, UsersGroupsAssociation.group_id == scim_group.id, session=self.session)
         group_db_object.displayName = scim_group.displayName
         
 
@@ -141,32 +188,16 @@ class DBGroupsBackend(GroupsBackend):
 
 
         # IMPLEMENTATION MAY CHANGE HERE DEPEDING ON YOUR SQL STRUCTURE
-        # get the users that are currently members of the group
-        user_groups_assoc_db_objs: List[UsersGroupsAssociation] = group_db_object.member_associations
-        # if the incoming scim object has members, figure out if there is a delta and make changes
-        if scim_group.members != []:
-            # loop through incoming users, if they are already part of the group do nothing, if not
-            # then add them
-            for user in scim_group.members:
-                for assoc in user_groups_assoc_db_objs:
-                    if user['value'] == assoc.user_id:
-                        break
-                else:
-                    new_assoc = UsersGroupsAssociation(user_id=user['value'], group_id=scim_group.id)
-                    db.session.add(new_assoc)
-            # loop through existing users, if the dont exist in the incoming object remove them from the group.
-            # All updates are PUT, so the old object is replace with the new one
-            for assoc in user_groups_assoc_db_objs:
-                for user in scim_group.members:
-                    if user['value'] == assoc.user_id:
-                        break
-                else:
-                    db.session.delete(assoc)
-            # if there are no members in the incoming scim object but there are existing members in the db 
-            # then remove all existing members in the db
-        elif scim_group.members == [] and user_groups_assoc_db_objs is not None:
-            for assoc in user_groups_assoc_db_objs:
-                db.session.delete(assoc)
+        # All updates are PUT, so the incoming members replace the existing ones. The delta is two set
+        # differences over the member ids, applied as bulk inserts and deletes
+        current_ids = UsersGroupsAssociation.member_ids(scim_group.id, self.session)
+        incoming_ids = {user['value'] for user in scim_group.members}
+        added_ids = incoming_ids - current_ids
+        removed_ids = current_ids - incoming_ids
+        UsersGroupsAssociation.add_members(scim_group.id, added_ids, self.session)
+        UsersGroupsAssociation.remove_members(scim_group.id, removed_ids, self.session)
+        self.session.expire(group_db_object, ['member_associations'])
+        logger.info('%i users added to and %i users removed from group with ID %s' % (len(added_ids), len(removed_ids), scim_group.id))
 
 
         # update the last modified attribute on the group object to now
@@ -174,37 +205,74 @@ class DBGroupsBackend(GroupsBackend):
         group_db_object.lastModified = datetime.now()
 
 
-        db.session.commit()
+        ChangeJournal.record('Group', [scim_group.id], self.session)
+        # users added to or removed from the group are journaled as changed too
+        ChangeJournal.record('User', added_ids | removed_ids, self.session)
+        commit(self.session)
         # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
         # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
         # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
         # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
         # name= input on the Column() constructor
-        return GroupsDB.query.filter_by(id=scim_group.id).first().scim_group
+        return self.session.query(GroupsDB).options(*GroupsDB.load_options('joined')).filter_by(id=scim_group.id).first().scim_group
+
+    # applies the members added and removed by a PATCH as single association inserts and deletes, so a PATCH
+    # costs the members it changes instead of the size of the group
+    def patch_group(self, group_id: str, patch: GroupPatch) -> bool:
+        logger.info('Patching group with ID %s in DB' % group_id)
+        # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
+        # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
+        # COLUMN THEN IT WILL NEED TO BE CHANGED
+        # the members are not loaded, only the associations the patch touches are queried
+        group_db_object: GroupsDB = self.session.query(GroupsDB).filter_by(id=group_id).first()
+        if group_db_object is None:
+            return False
+
+        # MAPPINGS IMPLEMENTATION DONE HERE
+        if patch.displayName is not None and patch.displayName != group_db_object.displayName:
+            # the members show the group's name, a rename changes them too
+            ChangeJournal.record_select('User', UsersGroupsAssociation.user_id, UsersGroupsAssociation.group_id == group_id, session=self.session)
+            group_db_object.displayName = patch.displayName
+        if 'description' in patch.custom_attributes: group_db_object.description = patch.custom_attributes['description']
+
+        # IMPLEMENTATION MAY CHANGE HERE DEPEDING ON YOUR SQL STRUCTURE
+        members_added, members_removed = patch.members_added, patch.members_removed
+        # replacing the members is a full diff against the current members
+        if patch.members_replaced is not None:
+            current_ids = UsersGroupsAssociation.member_ids(group_id, self.session)
+            members_added = patch.members_replaced - current_ids
+            members_removed = current_ids - patch.members_replaced
+        # skip the users that are already members
+        elif members_added:
+            for chunk in chunks(members_added):
+                members_added = members_added - {user_id for (user_id,) in self.session.query(UsersGroupsAssociation.user_id).filter(
+                    UsersGroupsAssociation.group_id == group_id, UsersGroupsAssociation.user_id.in_(chunk))}
+        UsersGroupsAssociation.add_members(group_id, members_added, self.session)
+        UsersGroupsAssociation.remove_members(group_id, members_removed, self.session)
+        self.session.expire(group_db_object, ['member_associations'])
+        logger.info('%i users added to and %i users removed from group with ID %s' % (len(members_added), len(members_removed), group_id))
+
+        # lastModified MAPPING IMPLEMENTATION HERE, IF NOT SUPPORTED THEN REMOVE
+        group_db_object.lastModified = datetime.now()
+        ChangeJournal.record('Group', [group_id], self.session)
+        ChangeJournal.record('User', members_added | members_removed, self.session)
+        commit(self.session)
+        return True
 
     def delete_group(self, group_id: str) -> None:
-        logger.info('Looking up group with ID %s in DB' % group_id)
+        logger.info('Deleting group with ID %s and its user associations in DB' % group_id)
+        # IMPLEMENTATION CHANGES HERE, UPDATES MAY BE REQUIRED DEPENDING ON SQL STRUCTURE
+        # the members lost a group, they are journaled straight from the associations before those are deleted
+        ChangeJournal.record_select('User', UsersGroupsAssociation.user_id, UsersGroupsAssociation.group_id == group_id, session=self.session)
+        # one DELETE for the associations and one for the group, nothing is loaded
+        self.session.query(UsersGroupsAssociation).filter_by(group_id=group_id).delete()
         # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
         # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
         # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
         # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
         # name= input on the Column() constructor
         # if 'id' is not a string type in the DB you will need to typcast it here
-        group_db_object: GroupsDB = GroupsDB.query.filter_by(id=group_id).first()
-        # IMPLEMENTATION CHANGES HERE, UPDATES MAY BE REQUIRED DEPENDING ON SQL STRUCTURE
-        association_db_objects: List[UsersGroupsAssociation] = UsersGroupsAssociation.query.filter_by(group_id=group_id).all()
-
-
-        # IMPLEMENTATION CHANGES HERE, UPDATES MAY BE REQUIRED DEPENDING ON SQL STRUCTURE
-        # deleteing the associations before the group
-        logger.info('Deleting user associations for group with ID %s' % group_id)
-        for association in association_db_objects:
-            db.session.delete(association)
-        # if something was deleted then commit the changes before deleting the group
-        if len(association_db_objects) != 0:
-            db.session.commit()
-
-
-        logger.info('Deleting group with ID %s in DB' % group_id)
-        db.session.delete(group_db_object)
-        db.session.commit()
\ No newline at end of file
+        self.session.query(GroupsDB).filter_by(id=group_id).delete()
+        ChangeJournal.record('Group', [group_id], self.session)
+        # the associations and the group are deleted in one transaction
+        commit(self.session)
@@ -1,10 +1,11 @@
 from typing import Tuple
 from datetime import datetime
 
-from SCIM.classes.generic.Filter import Filter, FilterValidationError
+from SCIM.classes.generic.Filter import FilterValidationError
+from SCIM.classes.implementation.database.DBFilter import DBFilter
 from SCIM.classes.implementation.database.models import GroupsDB
 
-class DBGroupsFilter(Filter):
+class DBGroupsFilter(DBFilter):
     def set_search_key_and_value(self, filter_args: Tuple[str]):
         # id always needs to be mapped to the column that would be the
         # "externalId" in the okta app profile
@@ -22,7 +23,7 @@ class DBGroupsFilter(Filter):
         elif filter_args[0] == 'meta.lastModified':
             try:
                 # MAPPING IMPLEMENTATION HERE, SET PROPER DATA TYPE
-                self.search_value = datetime.fromisoformat(filter_args[2].strip('Z'))
+                self.search_value = datetime.fromisoformat(filter_args[2].strip('Z')) if filter_args[2] is not None else None
                 # if database has lastModified as date and not datetime
                 # self.search_value = datetime.date(self.search_value)
             except ValueError as e:
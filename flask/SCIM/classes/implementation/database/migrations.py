@@ -0,0 +1,24 @@
+from sqlalchemy.exc import DatabaseError
+
+from SCIM import db
+from SCIM.helpers import set_up_logger
+from SCIM.classes.implementation.database.models import UsersDB, GroupsDB, UsersGroupsAssociation, ChangeJournal
+
+logger = set_up_logger(__name__)
+
+# brings a database created by an older version of the connector up to date, every step has to be safe
+# to run against a database that already has it since every worker process runs this
+def upgrade_database() -> None:
+    # the change journal only has the changes made after its table was created
+    try:
+        ChangeJournal.__table__.create(bind=db.engine, checkfirst=True)
+    except DatabaseError as e:
+        # another worker created it between the check and the create
+        logger.info('Could not create %s, assuming it already exists: %s' % (ChangeJournal.__tablename__, e))
+    # indexes declared in models.py after the tables were first created
+    for model in [UsersDB, GroupsDB, UsersGroupsAssociation, ChangeJournal]:
+        for index in model.__table__.indexes:
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except DatabaseError as e:
+                logger.info('Could not create index %s, assuming it already exists: %s' % (index.name, e))
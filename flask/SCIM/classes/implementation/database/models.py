@@ -1,12 +1,30 @@
-from typing import List
+from datetime import datetime
+from typing import List, Iterable, Iterator, Union
+from sqlalchemy import event, select, literal, inspect
+from sqlalchemy.sql import Select, ColumnElement
+from sqlalchemy.orm import Session, Load, joinedload, selectinload, lazyload, noload, load_only
 from sqlalchemy.sql.schema import Column, ForeignKey
 
-from SCIM import db
-from SCIM.classes.generic.SCIMUser import SCIMUser
+from SCIM import db, APP_SCHEMA
+from SCIM.helpers import set_up_logger
+from SCIM.classes.generic.SCIMUser import SCIMUser, scim_user_resource
 from SCIM.classes.generic.SCIMGroup import SCIMGroup
+from SCIM.classes.generic.Projection import Projection
+from SCIM.classes.implementation.database.transaction import changed, commit
+
+logger = set_up_logger(__name__)
 
 # https://flask-sqlalchemy.palletsprojects.com/en/2.x/models/
 
+# rows per statement for the set based association and journal writes, keeps each executemany batch
+# and IN list under the database's bound parameter limit (999 on older SQLite versions)
+CHUNK_SIZE = 500
+
+def chunks(items: Iterable, size: int = CHUNK_SIZE) -> Iterator[list]:
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 class UsersDB(db.Model):
     __tablename__ = 'users'
     # Set variable names to be what Okta will send them over as, and map to 
@@ -24,8 +42,27 @@ class UsersDB(db.Model):
     active = db.Column(db.Boolean, nullable=False, name='active')
     number = db.Column(db.Integer, nullable=True, name='number')
     lastModified = db.Column(db.DateTime, nullable=True, name='lastModified')
+    # indexes for the columns DBUsersFilter can filter on. SCIM userName matching is case insensitive, the
+    # filter compares lower(email) so the userName eq lookup Okta does before every push uses this index
+    # MAPPING IMPLEMENTATION HERE, INDEX THE COLUMN USERNAME_FIELD IS MAPPED TO
+    __table_args__ = (
+        db.Index('ix_users_email_lower', db.func.lower(email)),
+        db.Index('ix_users_lastModified', lastModified),
+        db.Index('ix_users_number', number),
+        db.Index('ix_users_active', active),
+    )
     # https://docs.sqlalchemy.org/en/14/orm/basic_relationships.html#association-object
     group_associations = db.relationship('UsersGroupsAssociation', back_populates='user', lazy='select')
+    # the columns each top level SCIM attribute in scim_user is built from, a projection only loads the ones it returns
+    # MAPPINGS IMPLEMENTATION DONE HERE, needs to match scim_user
+    SCIM_ATTRIBUTE_COLUMNS = {
+        'userName': ['email'],
+        'name': ['firstName', 'lastName'],
+        'emails': ['email'],
+        'phoneNumbers': ['phone'],
+        'active': ['active'],
+        'urn:okta:%s:1.0:user:custom' % APP_SCHEMA: ['city', 'favorite_color', 'number']
+    }
 
     @property
     # for whatever reason when i try and strongly typecast this is cant find
@@ -49,23 +86,70 @@ class UsersDB(db.Model):
 
     @property
     def scim_user(self) -> SCIMUser:
-        scim_user_create_dict = {
-            'id': self.id,
-            'active': self.active,
-            'userName': self.email,
-            'email': self.email,
-            'givenName': self.firstName,
-            'familyName':self.lastName,
-            'mobilePhone': self.phone,
-            'password': self.password,
-            'groups': self.scim_formatted_groups,
-            'custom_attributes': {
-                'city': self.city,
-                'favorite_color': self.favorite_color,
-                'number': self.number
+        # the columns a projection did not load are left empty instead of being loaded one user at a time
+        deferred = deferred_columns(self)
+        value = lambda column: None if column in deferred else getattr(self, column)
+        email = value('email')
+        return SCIMUser.from_backend(
+            id=self.id,
+            active=value('active'),
+            userName=email,
+            email=email,
+            givenName=value('firstName'),
+            familyName=value('lastName'),
+            mobilePhone=value('phone'),
+            password=value('password'),
+            groups=self.scim_formatted_groups,
+            custom_attributes={
+                'city': value('city'),
+                'favorite_color': value('favorite_color'),
+                'number': value('number')
             }
-        }
-        return SCIMUser(scim_user_create_dict, init_type='backend')
+        )
+
+    # a Core select of what scim_resource_from_row needs, for building resources without loading UsersDB objects
+    # (see list_user_resources in DBUsersBackend). Each user's groups are aggregated into one JSON array by the
+    # database, the password is not in the resource so it is not selected. None if the dialect cant aggregate JSON
+    # MAPPINGS IMPLEMENTATION DONE HERE, needs to match scim_user
+    @classmethod
+    def resource_select(cls, dialect_name: str) -> Union[Select, None]:
+        groups = json_array_aggregate(dialect_name, value=UsersGroupsAssociation.group_id, display=GroupsDB.displayName)
+        if groups is None:
+            return None
+        groups_subquery = select(groups).select_from(UsersGroupsAssociation.__table__.join(GroupsDB.__table__)) \
+            .where(UsersGroupsAssociation.user_id == cls.id).scalar_subquery()
+        return select(cls.id, cls.active, cls.email, cls.firstName, cls.lastName, cls.phone, cls.city, cls.favorite_color, cls.number,
+                      groups_subquery.label('groups'))
+
+    # the same SCIM resource as scim_user.scim_resource, from a row of resource_select
+    @staticmethod
+    def scim_resource_from_row(row) -> dict:
+        return scim_user_resource(
+            id=row.id,
+            active=row.active,
+            userName=row.email,
+            familyName=row.lastName,
+            middleName="",
+            givenName=row.firstName,
+            email=row.email,
+            secondaryEmail="",
+            mobilePhone=row.phone,
+            # users without groups aggregate to NULL on some databases
+            groups=row.groups or [],
+            custom_attributes={
+                'city': row.city,
+                'favorite_color': row.favorite_color,
+                'number': row.number
+            }
+        )
+
+    # query options that load the groups used by scim_user with the given strategy. With a projection only the
+    # columns of the attributes it returns are selected, and the groups are not loaded unless it returns them
+    @classmethod
+    def load_options(cls, strategy: str = 'selectin', projection: Projection = None) -> List[Load]:
+        if projection is None:
+            return association_load_options(cls.group_associations, UsersGroupsAssociation.group, strategy)
+        return projection_load_options(cls, projection, 'groups', cls.group_associations, UsersGroupsAssociation.group, strategy)
 
     def __repr__(self) -> str:
         out = {
@@ -98,6 +182,17 @@ class GroupsDB(db.Model):
     # https://docs.sqlalchemy.org/en/14/orm/basic_relationships.html#association-object
     member_associations = db.relationship('UsersGroupsAssociation', back_populates='group', lazy='select')
     lastModified = db.Column(db.DateTime, nullable=True, name='lastModified')
+    # the columns each top level SCIM attribute in scim_group is built from, a projection only loads the ones it returns
+    # MAPPINGS IMPLEMENTATION DONE HERE, needs to match scim_group
+    SCIM_ATTRIBUTE_COLUMNS = {
+        'displayName': ['displayName'],
+        'urn:okta:custom:group:1.0': ['description']
+    }
+    # indexes for the columns DBGroupsFilter can filter on
+    __table_args__ = (
+        db.Index('ix_groups_lastModified', lastModified),
+        db.Index('ix_groups_displayName', displayName),
+    )
 
     @property
     def members(self) -> List[UsersDB]:
@@ -115,19 +210,29 @@ class GroupsDB(db.Model):
                 'display': association.user.lastName + ', ' + association.user.firstName
             }
             members_dicts.append(member_dict)
-        return member_dict
+        return members_dicts
 
     @property
     def scim_group(self) -> SCIMGroup:
-        scim_group_create_dict = {
-            'id': self.id,
-            'displayName': self.displayName,
-            'members': self.scim_formatted_members,
-            'custom_attributes': {
-                'description': self.description
+        # the columns a projection did not load are left empty instead of being loaded one group at a time
+        deferred = deferred_columns(self)
+        value = lambda column: None if column in deferred else getattr(self, column)
+        return SCIMGroup.from_backend(
+            id=self.id,
+            displayName=value('displayName'),
+            members=self.scim_formatted_members,
+            custom_attributes={
+                'description': value('description')
             }
-        }
-        return SCIMGroup(scim_group_create_dict, init_type='backend')
+        )
+
+    # query options that load the members used by scim_group with the given strategy. With a projection only the
+    # columns of the attributes it returns are selected, and the members are not loaded unless it returns them
+    @classmethod
+    def load_options(cls, strategy: str = 'selectin', projection: Projection = None) -> List[Load]:
+        if projection is None:
+            return association_load_options(cls.member_associations, UsersGroupsAssociation.user, strategy)
+        return projection_load_options(cls, projection, 'members', cls.member_associations, UsersGroupsAssociation.user, strategy)
 
     def __repr__(self) -> str:
         out = {
@@ -149,6 +254,40 @@ class UsersGroupsAssociation(db.Model):
     group_id = Column('group_id', ForeignKey('groups.id'), primary_key=True)
     user = db.relationship('UsersDB', back_populates='group_associations', lazy='select')
     group = db.relationship('GroupsDB', back_populates='member_associations', lazy='select')
+    # the primary key only helps user_id first lookups, this one is for loading and deleting a group's members
+    __table_args__ = (db.Index('ix_users_group_associations_group_id', group_id, user_id),)
+
+    # membership changes as chunked Core INSERTs and DELETE ... IN statements, the rows never go through the
+    # session's identity map so expire the relationships of any loaded user or group they change.
+    # Like the rest of the methods here they run in db.session unless the backend passes its own session
+    @classmethod
+    def add_members(cls, group_id: str, user_ids: Iterable[str], session: Session = db.session) -> None:
+        for chunk in chunks(user_ids):
+            session.execute(cls.__table__.insert(), [{'user_id': user_id, 'group_id': group_id} for user_id in chunk])
+
+    @classmethod
+    def remove_members(cls, group_id: str, user_ids: Iterable[str], session: Session = db.session) -> None:
+        for chunk in chunks(user_ids):
+            session.execute(cls.__table__.delete().where(cls.group_id == group_id, cls.user_id.in_(chunk)))
+
+    @classmethod
+    def add_groups(cls, user_id: str, group_ids: Iterable[str], session: Session = db.session) -> None:
+        for chunk in chunks(group_ids):
+            session.execute(cls.__table__.insert(), [{'user_id': user_id, 'group_id': group_id} for group_id in chunk])
+
+    @classmethod
+    def remove_groups(cls, user_id: str, group_ids: Iterable[str], session: Session = db.session) -> None:
+        for chunk in chunks(group_ids):
+            session.execute(cls.__table__.delete().where(cls.user_id == user_id, cls.group_id.in_(chunk)))
+
+    # the ids of a group's members or a user's groups, without loading the associations
+    @classmethod
+    def member_ids(cls, group_id: str, session: Session = db.session) -> set:
+        return {user_id for (user_id,) in session.query(cls.user_id).filter(cls.group_id == group_id)}
+
+    @classmethod
+    def group_ids(cls, user_id: str, session: Session = db.session) -> set:
+        return {group_id for (group_id,) in session.query(cls.group_id).filter(cls.user_id == user_id)}
 
     def __repr__(self) -> str:
         out = {
@@ -158,4 +297,135 @@ class UsersGroupsAssociation(db.Model):
         return 'UsersGroupsAssociation<%s>' % str(out)
 
     def __str__(self) -> str:
-        return self.__repr__()
\ No newline at end of file
+        return self.__repr__()
+
+# append only log of the users and groups changed through the backends, incremental imports read the ids
+# changed after their meta.lastModified filter from here instead of scanning lastModified on every row.
+# Membership changes are journaled for both the user and the group so they show up in both imports
+class ChangeJournal(db.Model):
+    __tablename__ = 'change_journal'
+    # written when the table is created, changes from before it are not in the journal
+    JOURNAL_START = 'Journal'
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True, name='seq')
+    resource_type = db.Column(db.String(10), nullable=False, name='resource_type')
+    resource_id = db.Column(db.String(255), nullable=False, name='resource_id')
+    changed = db.Column(db.DateTime, nullable=False, name='changed')
+    __table_args__ = (
+        db.Index('ix_change_journal_type_changed', 'resource_type', 'changed'),
+        # for the last change to a single resource in version
+        db.Index('ix_change_journal_resource', 'resource_type', 'resource_id', 'seq'),
+    )
+
+    # inserts a journal entry for each resource in the session's transaction, so it is committed with the change
+    # itself. The resources are also invalidated in the resource cache when the transaction commits
+    @classmethod
+    def record(cls, resource_type: str, resource_ids: Iterable[str], session: Session = db.session) -> None:
+        resource_ids = set(resource_ids)
+        changed(resource_type, resource_ids, session)
+        changed_at = datetime.now()
+        for chunk in chunks(resource_ids):
+            session.execute(cls.__table__.insert(), [{'resource_type': resource_type, 'resource_id': resource_id, 'changed': changed_at} for resource_id in chunk])
+
+    # like record, for the ids in id_column of the rows matching criteria. INSERT ... SELECT copies them
+    # in the database without loading them
+    @classmethod
+    def record_select(cls, resource_type: str, id_column: Column, *criteria, session: Session = db.session) -> None:
+        # the ids are never loaded, so every cached resource of the type is invalidated
+        changed(resource_type, None, session)
+        changed_rows = select(literal(resource_type), id_column, literal(datetime.now(), db.DateTime)).where(*criteria)
+        session.execute(cls.__table__.insert().from_select(['resource_type', 'resource_id', 'changed'], changed_rows))
+
+    # a version of a resource's current state for ETags, from its lastModified and the last change journaled
+    # for it (membership and name changes made from the other resource only show up in the journal).
+    # None if there is no resource with resource_id
+    @classmethod
+    def version(cls, resource_type: str, model: db.Model, resource_id: str, session: Session = db.session) -> Union[str, None]:
+        last_change = select(db.func.max(cls.seq)).where(cls.resource_type == resource_type, cls.resource_id == model.id).scalar_subquery()
+        row = session.query(model.lastModified, last_change).filter(model.id == resource_id).first()
+        if row is None:
+            return None
+        last_modified, seq = row
+        return '%s-%s' % (last_modified.timestamp() if last_modified is not None else 0, seq or 0)
+
+    # query of the ids of resource_type changed after since, None if the journal was started after since
+    # and the caller has to fall back to scanning lastModified
+    @classmethod
+    def changed_since(cls, resource_type: str, since: datetime, session: Session = db.session) -> Union[Select, None]:
+        journal_start = session.query(db.func.min(cls.changed)).filter(cls.resource_type == cls.JOURNAL_START).scalar()
+        if journal_start is None or journal_start > since:
+            return None
+        return select(cls.resource_id).where(cls.resource_type == resource_type, cls.changed > since)
+
+    # drops the entries from before `before` and moves the journal start up to it, so changed_since falls back to
+    # scanning lastModified for filters older than what is left. The version of a resource whose last entry is
+    # dropped changes once, a client holding its ETag gets the resource again instead of a 304
+    @classmethod
+    def prune(cls, before: datetime) -> None:
+        cls.query.filter(cls.resource_type == cls.JOURNAL_START, cls.changed < before).update({cls.changed: before}, synchronize_session=False)
+        pruned = cls.query.filter(cls.resource_type != cls.JOURNAL_START, cls.changed < before).delete(synchronize_session=False)
+        commit()
+        logger.info('Pruned %i change journal entries from before %s' % (pruned, before.isoformat()))
+
+    def __repr__(self) -> str:
+        out = {
+            'seq': self.seq,
+            'resource_type': self.resource_type,
+            'resource_id': self.resource_id,
+            'changed': self.changed
+        }
+        return 'ChangeJournal<%s>' % str(out)
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+@event.listens_for(ChangeJournal.__table__, 'after_create')
+def start_change_journal(target, connection, **kwargs) -> None:
+    connection.execute(target.insert().values(resource_type=ChangeJournal.JOURNAL_START, resource_id='', changed=datetime.now()))
+
+# https://docs.sqlalchemy.org/en/14/orm/loading_relationships.html
+LOADERS = {
+    'selectin': selectinload,
+    'joined': joinedload,
+    'lazy': lazyload
+}
+
+# builds the loader options for a model -> association -> model relationship chain, see
+# LOAD_STRATEGIES in SCIM/__init__.py for what each strategy does
+def association_load_options(association_relationship, target_relationship, strategy: str = 'selectin') -> List[Load]:
+    loader = LOADERS[strategy]
+    return [loader(association_relationship).options(loader(target_relationship))]
+
+# the loader options for the attributes a projection returns, model.SCIM_ATTRIBUTE_COLUMNS maps them to columns and
+# relationship_attribute is the SCIM attribute built from the association relationship (ex: a user's groups)
+def projection_load_options(model, projection: Projection, relationship_attribute: str, association_relationship, target_relationship, strategy: str = 'selectin') -> List[Load]:
+    columns = {'id'}
+    for attribute, attribute_columns in model.SCIM_ATTRIBUTE_COLUMNS.items():
+        if projection.returns(attribute): columns.update(attribute_columns)
+    options = [load_only(*[getattr(model, column) for column in sorted(columns)])]
+    if projection.returns(relationship_attribute):
+        return options + association_load_options(association_relationship, target_relationship, strategy)
+    # the relationship is set to empty without querying it
+    return options + [noload(association_relationship)]
+
+# the aggregate and object functions that build a JSON array of objects from a group of rows, by dialect
+JSON_ARRAY_FUNCTIONS = {
+    'sqlite': ('json_group_array', 'json_object'),
+    'postgresql': ('json_agg', 'json_build_object'),
+    'mysql': ('json_arrayagg', 'json_object'),
+    'mariadb': ('json_arrayagg', 'json_object')
+}
+
+# aggregates the rows into a JSON array with an object per row, the keyword arguments are the objects' keys and
+# the columns of their values. The result is decoded into a list of dicts. None if the dialect is not supported
+def json_array_aggregate(dialect_name: str, **fields: ColumnElement) -> Union[ColumnElement, None]:
+    if dialect_name not in JSON_ARRAY_FUNCTIONS:
+        return None
+    array_function, object_function = JSON_ARRAY_FUNCTIONS[dialect_name]
+    json_object = getattr(db.func, object_function)(*[argument for key, column in fields.items() for argument in (key, column)])
+    return getattr(db.func, array_function)(json_object, type_=db.JSON)
+
+# the columns of a loaded model object that were left out of its query by load_only. Columns expired by a commit
+# are not included, they are refreshed as usual when read
+def deferred_columns(obj: db.Model) -> set:
+    state = inspect(obj)
+    return state.unloaded - state.expired_attributes
@@ -0,0 +1,111 @@
+import os
+import time
+import threading
+from configparser import SectionProxy
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from SCIM.helpers import set_up_logger
+
+logger = set_up_logger(__name__)
+
+# how long this worker's requests waited to get a connection from its pool, including opening a new
+# connection when the pool was not full yet. Only pools created with TimedQueuePool are counted
+class CheckoutStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_sec = 0.0
+        self.max_wait_sec = 0.0
+
+    def record(self, wait_sec: float, timed_out: bool) -> None:
+        with self.lock:
+            self.checkouts += 1
+            if timed_out: self.timeouts += 1
+            self.total_wait_sec += wait_sec
+            self.max_wait_sec = max(self.max_wait_sec, wait_sec)
+
+    @property
+    def scim_resource(self) -> dict:
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'averageWaitMs': self.total_wait_sec * 1000 / self.checkouts if self.checkouts else 0,
+                'maxWaitMs': self.max_wait_sec * 1000
+            }
+
+# one per worker process, shared by every TimedQueuePool in it
+checkout_stats = CheckoutStats()
+
+# https://docs.sqlalchemy.org/en/14/core/pooling.html#sqlalchemy.pool.QueuePool
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            checkout_stats.record(time.perf_counter() - start, timed_out)
+
+# connect_args that make the database cancel statements running longer than timeout_ms
+def statement_timeout_connect_args(dialect_driver_string: str, timeout_ms: int) -> dict:
+    dialect = dialect_driver_string.split('+')[0].lower()
+    if dialect == 'postgresql':
+        # psycopg2 passes these to the server as session settings
+        return {'options': '-c statement_timeout=%i' % timeout_ms}
+    if dialect == 'mysql':
+        # pymysql and mysqlclient run this on every new connection, MySQL only applies it to SELECTs
+        return {'init_command': 'SET SESSION max_execution_time=%i' % timeout_ms}
+    if dialect == 'mariadb':
+        return {'init_command': 'SET SESSION max_statement_time=%f' % (timeout_ms / 1000)}
+    logger.warning('statement_timeout_ms is not supported for %s, statements will not time out' % dialect)
+    return {}
+
+# SQLALCHEMY_ENGINE_OPTIONS for a remote database from the [Database] section of the config, see the
+# pool settings in config.ini.template
+def engine_options(database_config: SectionProxy) -> dict:
+    setting = lambda key, default: database_config.get(key, '').strip() or default
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(setting('pool_size', '5')),
+        'max_overflow': int(setting('max_overflow', '10')),
+        'pool_timeout': float(setting('pool_timeout', '30')),
+        'pool_recycle': int(setting('pool_recycle', '3600')),
+        'pool_pre_ping': setting('pool_pre_ping', 'true').lower() == 'true'
+    }
+    timeout_ms = int(setting('statement_timeout_ms', '0'))
+    if timeout_ms > 0:
+        options['connect_args'] = statement_timeout_connect_args(database_config['dialect_driver_string'], timeout_ms)
+    return options
+
+# engine_options for the asyncio engine of the async backends (see async_session.py). Asyncio engines pool their
+# connections with AsyncAdaptedQueuePool instead of TimedQueuePool, and the statement timeout connect_args are
+# for the sync drivers, so both are left out
+def async_engine_options(database_config: SectionProxy) -> dict:
+    options = engine_options(database_config)
+    options.pop('poolclass')
+    if options.pop('connect_args', None) is not None:
+        logger.warning('statement_timeout_ms is not supported by the async backends, their statements will not time out')
+    return options
+
+# opens the pool's pool_size connections and puts them back, so the first requests a worker serves
+# do not pay for connecting. Failures are only logged, the connections are then opened on demand
+def prewarm_pool(engine: Engine) -> None:
+    size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 0
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(engine.connect())
+        logger.info('Opened %i connections in the pool of worker %i' % (len(connections), os.getpid()))
+    except Exception as e:
+        logger.error('Could not pre-warm the connection pool after %i connections: %s' % (len(connections), e))
+    finally:
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,77 @@
+import os
+import time
+import random
+from hashlib import sha256
+from typing import List
+from sqlalchemy import orm
+from flask import request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+
+from SCIM.helpers import set_up_logger, config
+from SCIM.classes.generic.Cache import Cache
+
+logger = set_up_logger(__name__)
+
+# the read replicas from [Database] replica_hosts and their SQLALCHEMY_BINDS keys, the local database has none
+REPLICA_HOSTS: List[str] = [] if config['Database']['local'].lower() == 'true' else \
+    [host.strip() for host in config['Database'].get('replica_hosts', '').split(',') if host.strip() != '']
+REPLICA_BINDS: List[str] = ['replica_%i' % i for i in range(len(REPLICA_HOSTS))]
+READ_YOUR_WRITES_SEC: float = float(config['Database'].get('replica_read_your_writes_sec', '5') or 0)
+# one file per client that wrote recently, its mtime is the time of the last write. Shared by every worker, they
+# are kept directly in the cache dir since everything that cleans it up expects only files in it
+RECENT_WRITE_FILE_PREFIX = 'recent_write.'
+
+# sends everything to the primary, except the reads made while session.info['replica_reads'] is set (see
+# replica_read in transaction.py) which go to one of the replicas. A session sticks to the replica it first
+# picked so the reads of a request see the same point in time
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('replica_reads') and REPLICA_BINDS:
+            bind = self.info.setdefault('replica_bind', random.choice(REPLICA_BINDS))
+            return get_state(self.app).db.get_engine(self.app, bind=bind)
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+# the client making the current request, by its credentials since Okta's requests can come from any of its IPs
+def client_key() -> str:
+    client = request.headers.get('Authorization') or request.remote_addr or ''
+    return sha256(client.encode('utf-8')).hexdigest()
+
+def recent_write_path() -> str:
+    return os.path.join(Cache.cache_base_dir, RECENT_WRITE_FILE_PREFIX + client_key())
+
+# called after the current request's client committed a write, its reads go to the primary for
+# READ_YOUR_WRITES_SEC so they dont miss the write on a replica that has not caught up yet
+def mark_recent_write() -> None:
+    path = recent_write_path()
+    with open(path, 'a'):
+        pass
+    os.utime(path)
+
+# an expired marker is deleted on the client's next read, remove_expired_recent_writes sweeps the ones of
+# clients that do not come back
+def wrote_recently() -> bool:
+    path = recent_write_path()
+    try:
+        if time.time() - os.stat(path).st_mtime < READ_YOUR_WRITES_SEC: return True
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return False
+
+def remove_expired_recent_writes() -> None:
+    expired_before = time.time() - READ_YOUR_WRITES_SEC
+    removed = 0
+    for entry in os.scandir(Cache.cache_base_dir):
+        if not entry.name.startswith(RECENT_WRITE_FILE_PREFIX): continue
+        try:
+            if entry.stat().st_mtime < expired_before:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            # removed by another worker
+            pass
+    if removed > 0: logger.info('Removed %i expired recent write markers' % removed)
@@ -0,0 +1,83 @@
+from functools import wraps
+from contextlib import contextmanager
+from typing import Iterator, Iterable, Union, Callable
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from SCIM import db
+from SCIM.classes.generic.ResourceCache import resource_cache
+from SCIM.classes.implementation.database.routing import REPLICA_BINDS, mark_recent_write, wrote_recently
+
+# the session arguments default to db.session, the scoped session of the current thread (request). The async
+# backends pass the sessions they run the backends in instead, see async_session.py
+
+# how many batch() blocks the session is inside of, kept in the session so each one has its own
+def in_batch(session: Session = db.session) -> bool:
+    return session.info.get('batch_depth', 0) > 0
+
+# groups every write made in the with block into one transaction, the backends' commit() calls inside of it
+# only flush so later writes in the batch can see them. If the block raises everything in it is rolled back
+@contextmanager
+def batch(session: Session = db.session) -> Iterator[None]:
+    session.info['batch_depth'] = session.info.get('batch_depth', 0) + 1
+    try:
+        yield
+        if session.info['batch_depth'] == 1:
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.info['batch_depth'] -= 1
+
+# used by the backends in place of session.commit()
+def commit(session: Session = db.session) -> None:
+    if in_batch(session):
+        session.flush()
+    else:
+        session.commit()
+
+# the resources changed in the session's transaction, they are invalidated in the resource cache once it
+# commits. resource_ids=None stands for every resource of resource_type
+def changed(resource_type: str, resource_ids: Union[Iterable[str], None], session: Session = db.session) -> None:
+    pending: dict = session.info.setdefault('changed_resources', {})
+    if resource_ids is None or (resource_type in pending and pending[resource_type] is None):
+        pending[resource_type] = None
+    else:
+        pending.setdefault(resource_type, set()).update(resource_ids)
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_resources(session) -> None:
+    changed_resources: dict = session.info.pop('changed_resources', {})
+    for resource_type, resource_ids in changed_resources.items():
+        resource_cache.invalidate(resource_type, resource_ids)
+    if REPLICA_BINDS and changed_resources and has_request_context():
+        mark_recent_write()
+
+# whether a read can go to a replica. Reads that are part of a write stay on the primary: inside a batch, after
+# the transaction wrote, in a request that is not a GET (ex: the If-Match check of a PUT), or from a client
+# that wrote within the read-your-writes window
+def replica_allowed(session: Session = db.session) -> bool:
+    if in_batch(session) or session.info.get('changed_resources') or session.new or session.dirty or session.deleted:
+        return False
+    return not has_request_context() or (request.method in ('GET', 'HEAD') and not wrote_recently())
+
+# backend methods that only read are decorated with this, the statements they run in the backend's session go
+# to a read replica when [Database] replica_hosts is set and replica_allowed
+def replica_read(method: Callable) -> Callable:
+    @wraps(method)
+    def replica_read_method(backend, *args, **kwargs):
+        session_info = backend.session.info
+        if not REPLICA_BINDS or session_info.get('replica_reads') or not replica_allowed(backend.session):
+            return method(backend, *args, **kwargs)
+        session_info['replica_reads'] = True
+        try:
+            return method(backend, *args, **kwargs)
+        finally:
+            session_info['replica_reads'] = False
+    return replica_read_method
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_resources(session) -> None:
+    session.info.pop('changed_resources', None)
@@ -0,0 +1,50 @@
+from typing import List, Union, AsyncContextManager
+
+from SCIM.classes.generic.SCIMUser import SCIMUser
+from SCIM.classes.generic.Patch import UserPatch
+from SCIM.classes.generic.Projection import Projection
+from SCIM.classes.generic.AsyncUsersBackend import AsyncUserBackend
+from SCIM.classes.implementation.database.async_session import batch, run_in_session
+from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend
+
+# DBUsersBackend on the database's asyncio driver, see async_session.py. The mappings are all in DBUsersBackend,
+# every call here runs its method in the session of the call
+class AsyncDBUsersBackend(AsyncUserBackend):
+    # shared with AsyncDBGroupsBackend, a batch from either one covers both
+    def batch(self) -> AsyncContextManager[None]:
+        return batch()
+
+    async def get_user(self, user_id: str, load_strategy: str = 'joined') -> Union[SCIMUser, None]:
+        return await run_in_session(lambda session: DBUsersBackend(session).get_user(user_id, load_strategy))
+
+    async def get_user_version(self, user_id: str) -> Union[str, None]:
+        return await run_in_session(lambda session: DBUsersBackend(session).get_user_version(user_id))
+
+    async def list_users(self, filter: str = None, load_strategy: str = 'selectin', start_index: int = 1, count: int = None, after_id: str = None, projection: Projection = None) -> List[SCIMUser]:
+        return await run_in_session(lambda session: DBUsersBackend(session).list_users(filter=filter, load_strategy=load_strategy, start_index=start_index,
+                                                                                       count=count, after_id=after_id, projection=projection))
+
+    async def list_user_resources(self, filter: str = None, start_index: int = 1, count: int = None, after_id: str = None) -> List[dict]:
+        return await run_in_session(lambda session: DBUsersBackend(session).list_user_resources(filter=filter, start_index=start_index, count=count, after_id=after_id))
+
+    async def count_users(self, filter: str = None) -> int:
+        return await run_in_session(lambda session: DBUsersBackend(session).count_users(filter=filter))
+
+    async def create_user(self, scim_user: SCIMUser) -> SCIMUser:
+        return await run_in_session(lambda session: DBUsersBackend(session).create_user(scim_user))
+
+    async def update_user(self, scim_user: SCIMUser) -> SCIMUser:
+        return await run_in_session(lambda session: DBUsersBackend(session).update_user(scim_user))
+
+    # the password and active changes are made in one session and committed together
+    async def patch_user(self, user_id: str, patch: UserPatch) -> Union[SCIMUser, None]:
+        return await run_in_session(lambda session: DBUsersBackend(session).patch_user(user_id, patch))
+
+    async def enable_user(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
+        return await run_in_session(lambda session: DBUsersBackend(session).enable_user(scim_user))
+
+    async def disable_user(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
+        return await run_in_session(lambda session: DBUsersBackend(session).disable_user(scim_user))
+
+    async def reset_password(self, scim_user: SCIMUser) -> Union[SCIMUser, None]:
+        return await run_in_session(lambda session: DBUsersBackend(session).reset_password(scim_user))
@@ -1,25 +1,39 @@
 import logging
 from uuid import uuid4
-from typing import List
+from typing import List, ContextManager, Union
 from datetime import datetime
+from sqlalchemy.orm import Session
 
 from SCIM import db
 from SCIM.helpers import set_up_logger, LOG_LEVEL
 from SCIM.classes.generic.SCIMUser import SCIMUser
+from SCIM.classes.generic.Projection import Projection
 from SCIM.classes.generic.UsersBackend import UserBackend
-from SCIM.classes.implementation.database.models import UsersDB, UsersGroupsAssociation
+from SCIM.classes.implementation.database.transaction import batch, commit, replica_read
+from SCIM.classes.implementation.database.models import UsersDB, UsersGroupsAssociation, ChangeJournal
 from SCIM.classes.implementation.database.users.DBUsersFilter import DBUsersFilter
 
 logger = set_up_logger(__name__)
 
 class DBUsersBackend(UserBackend):
-    def get_user(self, user_id: str) -> SCIMUser:
+    # the session the statements run in. By default it is db.session, the scoped session of the current request,
+    # the async backends run this one in the session of each of their calls instead
+    def __init__(self, session: Session = db.session) -> None:
+        self.session = session
+
+    # the users and groups backends share one session, so a batch from either one covers both
+    def batch(self) -> ContextManager[None]:
+        return batch(self.session)
+
+    # the reads go to a read replica when there is one, see replica_read in transaction.py
+    @replica_read
+    def get_user(self, user_id: str, load_strategy: str = 'joined') -> SCIMUser:
         # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
         # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
         # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
         # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
         # name= input on the Column() constructor
-        user_db_object: List[UsersDB] = UsersDB.query.filter_by(id=user_id).all()
+        user_db_object: List[UsersDB] = self.session.query(UsersDB).options(*UsersDB.load_options(load_strategy)).filter_by(id=user_id).all()
 
 
         if len(user_db_object) > 1:
@@ -30,27 +44,72 @@ class DBUsersBackend(UserBackend):
         else:
             return user_db_object[0].scim_user
 
-    def list_users(self, filter: str = None) -> List[SCIMUser]:
+    # one row from the users table and the change journal, the user and their groups are not loaded
+    @replica_read
+    def get_user_version(self, user_id: str) -> Union[str, None]:
+        return ChangeJournal.version('User', UsersDB, user_id, self.session)
+
+    # applies a SCIM filter string to a UsersDB query
+    def filter_query(self, query, filter: str = None):
+        if filter is None:
+            return query
+        filter_obj = DBUsersFilter(filter)
+        # incremental imports, the change journal has the ids that changed since the filter's timestamp so
+        # lastModified does not need to be scanned, and it also has the membership changes
+        # lastModified MAPPING IMPLEMENTATION HERE, IF NOT SUPPORTED THEN REMOVE
+        if filter_obj.search_key is UsersDB.lastModified and filter_obj.comparator == 'gt':
+            changed_ids = ChangeJournal.changed_since('User', filter_obj.search_value, self.session)
+            if changed_ids is not None:
+                return query.filter(UsersDB.id.in_(changed_ids))
+            logger.info('Change journal does not go back to %s, scanning lastModified' % filter_obj.search_value)
+        # the whole filter, compound or not, is one expression evaluated by the database
+        return query.filter(filter_obj.expression)
+
+    # orders and pages a UsersDB query or select
+    def page_query(self, query, start_index: int = 1, count: int = None, after_id: str = None):
+        # the pages need a stable order, the primary key is always indexed
+        # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
+        # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
+        # COLUMN THEN IT WILL NEED TO BE CHANGED
+        query = query.order_by(UsersDB.id)
+        # keyset pagination, continue after the last id of the previous page instead of
+        # having the DB walk and throw away every row before the offset
+        if after_id is not None:
+            query = query.filter(UsersDB.id > after_id)
+        elif start_index > 1:
+            query = query.offset(start_index - 1)
+        if count is not None:
+            query = query.limit(count)
+        return query
+
+    @replica_read
+    def list_users(self, filter: str = None, load_strategy: str = 'selectin', start_index: int = 1, count: int = None, after_id: str = None, projection: Projection = None) -> List[SCIMUser]:
         out: List[SCIMUser] = []
-        user_db_objs: List[UsersDB] = []
 
         # Check for filter, create one if needed, and query the users
-        if filter is None:
-            user_db_objs: List[UsersDB] = UsersDB.query.all()
-        else:
-            filter_obj = DBUsersFilter(filter)
-            if filter_obj.comparator == 'lt':
-                user_db_objs = UsersDB.query.filter(filter_obj.search_key < filter_obj.search_value).all()
-            elif filter_obj.comparator == 'eq':
-                user_db_objs = UsersDB.query.filter(filter_obj.search_key == filter_obj.search_value).all()
-            elif filter_obj.comparator == 'gt':
-                user_db_objs = UsersDB.query.filter(filter_obj.search_key > filter_obj.search_value).all()
+        # a projection selects only the columns it returns and skips the groups if it does not return them
+        query = self.filter_query(self.session.query(UsersDB).options(*UsersDB.load_options(load_strategy, projection)), filter)
+        user_db_objs: List[UsersDB] = self.page_query(query, start_index, count, after_id).all()
 
         # format output as scim objects to return to Okta
         for user in user_db_objs: 
             out.append(user.scim_user)
 
         return out
+
+    # one Core select straight to SCIM resources, the rows never become UsersDB objects in the session's identity
+    # map or SCIMUsers. Falls back to list_users on databases resource_select cant aggregate the groups on
+    @replica_read
+    def list_user_resources(self, filter: str = None, start_index: int = 1, count: int = None, after_id: str = None) -> List[dict]:
+        query = UsersDB.resource_select(self.session.bind.dialect.name)
+        if query is None:
+            return super().list_user_resources(filter=filter, start_index=start_index, count=count, after_id=after_id)
+        rows = self.session.execute(self.page_query(self.filter_query(query, filter), start_index, count, after_id))
+        return [UsersDB.scim_resource_from_row(row) for row in rows]
+
+    @replica_read
+    def count_users(self, filter: str = None) -> int:
+        return self.filter_query(self.session.query(UsersDB), filter).count()
     
     def create_user(self, scim_user: SCIMUser) -> SCIMUser:
         # if no unique ID exists on incoming scim object, create one
@@ -63,7 +122,7 @@ class DBUsersBackend(UserBackend):
 
 
         if LOG_LEVEL == logging.DEBUG:
-            logger.debug('Creating user in DB: %s' % vars(scim_user))
+            logger.debug('Creating user in DB: %s' % scim_user)
         else: 
             logger.info('Creating %s in users DB' % scim_user.userName)
 
@@ -95,12 +154,10 @@ class DBUsersBackend(UserBackend):
         db_user.lastModified = datetime.now()
 
 
-        db.session.add(db_user)
-        db.session.commit()
-        if LOG_LEVEL == logging.DEBUG:
-            logger.debug('User create sucessful: %s' % str(db_user))
-        else:
-            logger.info('%s created sucessfully' % scim_user.userName)
+        self.session.add(db_user)
+        ChangeJournal.record('User', [id], self.session)
+        # the user row has to exist before the group assignments reference it
+        self.session.flush()
 
         
         # GROUPS IMPLEMENTATION HERE. CHANGES MAY BE NEEDED HERE DEPENDING ON THE DETAILS OF THE 
@@ -108,29 +165,28 @@ class DBUsersBackend(UserBackend):
         # check if groups were sent as part of the user object and attempt assignment
         if scim_user.groups != []:
             logger.info('Attempting group assignment for %s' % scim_user.userName)
-            # groups take the form of a scim resource {value: group.id, display: group.displayName}
-            for group in scim_user.groups:
-                # group assignments must be done through the assoication object
-                user_group_assoc = UsersGroupsAssociation(user_id=id, group_id=group['value'])
-                db.session.add(user_group_assoc)
-            db.session.commit()
-            logger.info('Groups assignment sucessful for %s' % scim_user.userName)
-            # if logging in debug mode print the new users userName and the list of grups they
-            # are assigned to
-            if LOG_LEVEL == logging.DEBUG:
-                # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
-                # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
-                # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
-                # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
-                # name= input on the Column() constructor
-                new_db_user: UsersDB = UsersDB.query.filter_by(id=id).first()
-                group_list: List[str] = []
-                for group in new_db_user.groups:
-                    group_list.append(group.displayName)
-                logger.debug('%s\'s groups: %s' % (scim_user.userName, str(group_list)))
-
-
-        return db_user.scim_user
+            # groups take the form of a scim resource {value: group.id, display: group.displayName}, the
+            # assignments are inserted in bulk
+            group_ids = {group['value'] for group in scim_user.groups}
+            UsersGroupsAssociation.add_groups(id, group_ids, self.session)
+            # the groups gained a member
+            ChangeJournal.record('Group', group_ids, self.session)
+            logger.info('%i groups assigned to %s' % (len(group_ids), scim_user.userName))
+
+        # the user and their group assignments are committed together
+        commit(self.session)
+        if LOG_LEVEL == logging.DEBUG:
+            logger.debug('User create sucessful: %s' % str(db_user))
+        else:
+            logger.info('%s created sucessfully' % scim_user.userName)
+
+
+        # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
+        # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
+        # COLUMN THEN IT WILL NEED TO BE CHANGED
+        # the groups were inserted outside of the session, load them with the user in one query
+        self.session.expire(db_user, ['group_associations'])
+        return self.session.query(UsersDB).options(*UsersDB.load_options('joined')).filter_by(id=id).first().scim_user
 
     def update_user(self, scim_user: SCIMUser) -> SCIMUser:
         # we can assume they exist because a GET is always called before the update to check for existence 
@@ -140,8 +196,13 @@ class DBUsersBackend(UserBackend):
         # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
         # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
         # name= input on the Column() constructor
-        user_db_object: UsersDB = UsersDB.query.filter_by(id=scim_user.id).first()
+        user_db_object: UsersDB = self.session.query(UsersDB).filter_by(id=scim_user.id).first()
+
 
+        # the user's groups show the user's name as the member display, a name change changes them too
+        # MAPPINGS IMPLEMENTATION DONE HERE, needs to match the display in GroupsDB.scim_formatted_members
+        if (user_db_object.firstName, user_db_object.lastName) != (scim_user.givenName, scim_user.familyName):
+            ChangeJournal.record_select('Group', UsersGroupsAssociation.group_id, UsersGroupsAssociation.user_id == scim_user.id, session=self.session)
 
         # override existing value with values from the incoming scim object
         # MAPPINGS IMPLEMENTATION DONE HERE
@@ -173,45 +234,57 @@ class DBUsersBackend(UserBackend):
 
         # GROUPS IMPLEMENTATION HERE, WILL NEED TO BE UPDATED ACCORDING TO HOW GROUPS ARE HANDLED
         # IN YOUR DATABASE STRUCTURE. REMOVE IF GROUPS NOT SUPPORTED
-        # get the groups the user is currently assigned to
-        user_groups_assoc_db_objs: List[UsersGroupsAssociation] = user_db_object.group_associations
-        # if there are groups in the scim object then figure out if there are changes and make them
-        if scim_user.groups != []:
-            # loop through incoming groups, if its already assigned do nothing, if its not assigned
-            # assign it
-            for group in scim_user.groups:
-                group_id = group['value']
-                for group_assoc in user_groups_assoc_db_objs:
-                    if group_id == group_assoc.group_id:
-                        break
-                else:
-                    new_assoc = UsersGroupsAssociation(user_id=scim_user.id, group_id=group_id)
-                    db.session.add(new_assoc)
-            # loop through existing associations, if an existing association is not found in the incoming
-            # group list, then remove it.
-            for assoc in user_groups_assoc_db_objs:
-                for group in scim_user.groups:
-                    if assoc.group_id == group['value']:
-                        break
-                else:
-                    db.session.delete(assoc)
-        # if there are no groups in the incoming scim request but there are groups in the DB then
-        # remove all the users group assignments in the DB
-        elif scim_user.groups == [] and user_groups_assoc_db_objs is not None:
-            for assoc in user_groups_assoc_db_objs:
-                db.session.delete(assoc)
-            
+        # the incoming groups replace the existing ones, the delta is two set differences over the group ids
+        # applied as bulk inserts and deletes
+        current_ids = UsersGroupsAssociation.group_ids(scim_user.id, self.session)
+        incoming_ids = {group['value'] for group in scim_user.groups}
+        added_ids = incoming_ids - current_ids
+        removed_ids = current_ids - incoming_ids
+        UsersGroupsAssociation.add_groups(scim_user.id, added_ids, self.session)
+        UsersGroupsAssociation.remove_groups(scim_user.id, removed_ids, self.session)
+        self.session.expire(user_db_object, ['group_associations'])
+
 
         # update the last modified attribute on the user object to now
         # lastModified MAPPING IMPLEMENTATION HERE, IF NOT SUPPORTED THEN REMOVE
         user_db_object.lastModified = datetime.now()
         
 
-        db.session.commit()
+        ChangeJournal.record('User', [scim_user.id], self.session)
+        # groups the user is added to or removed from are journaled as changed too
+        ChangeJournal.record('Group', added_ids | removed_ids, self.session)
+        commit(self.session)
         # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
         # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
         # COLUMN THEN IT WILL NEED TO BE CHANGED. NOTE THE ATTRIBUTE CAN BE NAMED
         # 'id' ON THE DB OBJECT AND MAPPED TO A DIFFERENT COLUMN NAME VIA THE 
         # name= input on the Column() constructor
         # return the updated object
-        return UsersDB.query.filter_by(id=scim_user.id).first().scim_user
\ No newline at end of file
+        return self.session.query(UsersDB).options(*UsersDB.load_options('joined')).filter_by(id=scim_user.id).first().scim_user
+
+    # PATCH updates, these only set the columns the PATCH changes instead of replacing the whole user
+    def enable_user(self, scim_user: SCIMUser) -> SCIMUser:
+        return self.update_user_columns(scim_user.id, active=True)
+
+    def disable_user(self, scim_user: SCIMUser) -> SCIMUser:
+        return self.update_user_columns(scim_user.id, active=False)
+
+    # IF PASSWORDS ARENT SUPPORTED IN YOUR CONNECTOR REMOVE THIS
+    def reset_password(self, scim_user: SCIMUser) -> SCIMUser:
+        return self.update_user_columns(scim_user.id, password=scim_user.password)
+
+    def update_user_columns(self, user_id: str, **columns) -> SCIMUser:
+        logger.info('Patching %s on user with ID %s in DB' % (list(columns.keys()), user_id))
+        # BELOW LINE MAY NEED CHANGES DEPENDING ON IMPLEMENTATION AND HOW THE 
+        # OBJECT WAS SET UP IN models.py. IF NOT USING 'id' AS THE UNIQUE IDENTIFIER
+        # COLUMN THEN IT WILL NEED TO BE CHANGED
+        user_db_object: UsersDB = self.session.query(UsersDB).options(*UsersDB.load_options('joined')).filter_by(id=user_id).first()
+        if user_db_object is None:
+            return None
+        for column, value in columns.items():
+            setattr(user_db_object, column, value)
+        # lastModified MAPPING IMPLEMENTATION HERE, IF NOT SUPPORTED THEN REMOVE
+        user_db_object.lastModified = datetime.now()
+        ChangeJournal.record('User', [user_id], self.session)
+        commit(self.session)
+        return user_db_object.scim_user
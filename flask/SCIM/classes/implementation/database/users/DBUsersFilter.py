@@ -1,24 +1,26 @@
 from typing import Tuple
 from datetime import datetime
 
-from SCIM import USERNAME_FIELD
-from SCIM.classes.generic.Filter import Filter, FilterValidationError
+from SCIM import db, USERNAME_FIELD
+from SCIM.classes.generic.Filter import FilterValidationError
+from SCIM.classes.implementation.database.DBFilter import DBFilter
 from SCIM.classes.implementation.database.models import UsersDB
 
-class DBUsersFilter(Filter):
+class DBUsersFilter(DBFilter):
     def set_search_key_and_value(self, filter_args: Tuple[str]):
         # this always needs to be mapped, in this case the
         # userName coming from Okta is mapped to the "email"
         # column in the database. This can also be seen in 
-        # models.py.
-        if filter_args == USERNAME_FIELD:
+        # models.py. SCIM attribute names and userName values
+        # are case insensitive, lower(email) has an index in models.py
+        if filter_args[0].lower() == USERNAME_FIELD.lower():
             # MAPPING IMPLEMENTATION HERE, SET PROPER DATA TYPE
-            self.search_value = filter_args[2]
+            self.search_value = filter_args[2].lower() if filter_args[2] is not None else None
             try:
                 # MAPPING IMPLEMENTATION HERE, CONFIGURE USERNAME_FILED
                 # DB OBJECT PROPERTY MAPPING IN CASE PROPERTY NAME
                 # IS DIFFERENT FROM INCOMING KEY
-                self.search_key = getattr(UsersDB, 'email')
+                self.search_key = db.func.lower(getattr(UsersDB, 'email'))
             except AttributeError as e:
                 raise FilterValidationError(message=str(e))
         # id always needs to be mapped to the column that would be the
@@ -37,7 +39,7 @@ class DBUsersFilter(Filter):
         elif filter_args[0] == 'meta.lastModified':
             try:
                 # MAPPING IMPLEMENTATION HERE, SET PROPER DATA TYPE
-                self.search_value = datetime.fromisoformat(filter_args[2].strip('Z'))
+                self.search_value = datetime.fromisoformat(filter_args[2].strip('Z')) if filter_args[2] is not None else None
                 # if database has lastModified as date and not datetime
                 # self.search_value = datetime.date(self.search_value)
             except ValueError as e:
@@ -57,7 +59,10 @@ class DBUsersFilter(Filter):
         # on how to implement in case of need is below
         elif filter_args[0] == 'number':
             # MAPPING IMPLEMENTATION HERE, SET PROPER DATA TYPE
-            self.search_value = int(filter_args[2])
+            try:
+                self.search_value = int(filter_args[2]) if filter_args[2] is not None else None
+            except ValueError as e:
+                raise FilterValidationError(message=str(e))
             try:
                 # MAPPING IMPLEMENTATION HERE, CONFIGURE number
                 # DB OBJECT PROPERTY MAPPING IN CASE PROPERTY NAME
@@ -74,7 +79,7 @@ class DBUsersFilter(Filter):
             except AttributeError as e:
                 raise FilterValidationError(message=str(e))
             # MAPPING IMPLEMENTATION HERE, SET PROPER DATA TYPE
-            self.search_value = filter_args[2].lower().strip() == 'true'
+            self.search_value = filter_args[2].lower().strip() == 'true' if filter_args[2] is not None else None
 
         # throw a validation error if a search key that is not mapped is received
         else:
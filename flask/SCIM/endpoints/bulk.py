@@ -0,0 +1,168 @@
+from typing import List, Tuple, Union
+from flask import request, jsonify, make_response, Response
+from flask_restful import Resource
+
+from SCIM import SUPPORTED_PROVISIONING_FEATURES
+from SCIM.helpers import set_up_logger, scim_error, BULK_MAX_OPERATIONS, BULK_MAX_PAYLOAD_SIZE, BULK_BATCH_SIZE
+from SCIM.endpoints.general import handle_server_side_error, handle_validation_error
+from SCIM.classes.generic.SCIMUser import SCIMUser
+from SCIM.classes.generic.SCIMGroup import SCIMGroup
+from SCIM.classes.generic.Patch import GroupPatch, UserPatch, PatchValidationError
+# import our specific classes as generic Backend names, same as in users.py and groups.py
+from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend as UsersBackend
+from SCIM.classes.implementation.database.groups.DBGroupsBackend import DBGroupsBackend as GroupsBackend
+
+logger = set_up_logger(__name__)
+
+users_backend = UsersBackend()
+groups_backend = GroupsBackend()
+
+# the features each operation needs, same as the single resource endpoints in users.py and groups.py
+OPERATION_FEATURES = {
+    ('POST', 'Users'): ['PUSH_NEW_USERS', 'PUSH_PENDING_USERS'],
+    ('PUT', 'Users'): ['PUSH_PASSWORD_UPDATES', 'PUSH_PENDING_USERS', 'PUSH_PROFILE_UPDATES', 'PUSH_USER_DEACTIVATION', 'REACTIVATE_USERS'],
+    ('POST', 'Groups'): ['GROUP_PUSH'],
+    ('PUT', 'Groups'): ['GROUP_PUSH'],
+    ('PATCH', 'Users'): ['PUSH_PASSWORD_UPDATES', 'PUSH_USER_DEACTIVATION', 'REACTIVATE_USERS'],
+    ('DELETE', 'Groups'): ['GROUP_PUSH'],
+    ('PATCH', 'Groups'): ['GROUP_PUSH']
+}
+
+class BulkOperationError(Exception):
+    def __init__(self, message: str, status: int) -> None:
+        super().__init__(message)
+        self.status = status
+
+# replaces "bulkId:<id>" references to resources created earlier in the request with their ids
+def resolve_bulk_ids(data: Union[dict, list, str], bulk_ids: dict) -> Union[dict, list, str]:
+    if isinstance(data, dict):
+        return {key: resolve_bulk_ids(value, bulk_ids) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [resolve_bulk_ids(value, bulk_ids) for value in data]
+    elif isinstance(data, str) and data.startswith('bulkId:'):
+        try:
+            return bulk_ids[data[len('bulkId:'):]]
+        except KeyError:
+            raise BulkOperationError('Unknown bulkId reference %s' % data, 409)
+    return data
+
+# runs a single operation against the backends, returns (status, resource id)
+def run_operation(operation: dict, bulk_ids: dict) -> Tuple[int, Union[str, None]]:
+    method = operation.get('method', '').upper()
+    path_parts = operation.get('path', '').strip('/').split('/')
+    resource_type = path_parts[0]
+    resource_id = path_parts[1] if len(path_parts) > 1 else None
+    if (method, resource_type) not in OPERATION_FEATURES or (method == 'POST') != (resource_id is None):
+        raise BulkOperationError('%s %s is not supported in a bulk request' % (method, operation.get('path')), 405)
+    for feature in OPERATION_FEATURES[(method, resource_type)]:
+        if feature in SUPPORTED_PROVISIONING_FEATURES: break
+    else:
+        raise BulkOperationError('%s %s is not enabled' % (method, operation.get('path')), 501)
+    if resource_id is not None:
+        resource_id = resolve_bulk_ids(resource_id, bulk_ids)
+    data = resolve_bulk_ids(operation.get('data', {}), bulk_ids)
+
+    if resource_type == 'Users':
+        if method == 'POST':
+            return 201, users_backend.create_user(SCIMUser(data, init_type='scim')).id
+        if method == 'PATCH':
+            if users_backend.patch_user(resource_id, UserPatch(data)) is None:
+                raise BulkOperationError('User %s not found' % resource_id, 404)
+            return 200, resource_id
+        if users_backend.get_user(resource_id) is None:
+            raise BulkOperationError('User %s not found' % resource_id, 404)
+        data['id'] = resource_id
+        return 200, users_backend.update_user(SCIMUser(data, init_type='scim')).id
+    else:
+        if method == 'POST':
+            return 201, groups_backend.create_group(SCIMGroup(data, init_type='scim')).id
+        if method == 'PATCH':
+            if not groups_backend.patch_group(resource_id, GroupPatch(data)):
+                raise BulkOperationError('Group %s not found' % resource_id, 404)
+            return 204, resource_id
+        if groups_backend.get_group(resource_id) is None:
+            raise BulkOperationError('Group %s not found' % resource_id, 404)
+        if method == 'DELETE':
+            groups_backend.delete_group(resource_id)
+            return 204, resource_id
+        data['id'] = resource_id
+        return 200, groups_backend.update_group(SCIMGroup(data, init_type='scim')).id
+
+def operation_result(operation: dict, status: int, resource_id: str = None, error: Exception = None) -> dict:
+    result = {'method': operation.get('method'), 'status': str(status)}
+    if 'bulkId' in operation: result['bulkId'] = operation['bulkId']
+    if resource_id is not None:
+        result['location'] = request.url_root + operation.get('path', '').strip('/').split('/')[0] + '/' + resource_id
+    if error is not None:
+        result['response'] = scim_error(str(error), status)
+    return result
+
+def error_status(e: Exception) -> int:
+    if isinstance(e, PatchValidationError): return 400
+    return e.status if isinstance(e, BulkOperationError) else 500
+
+class BulkSCIM(Resource):
+    # bulk requests: https://datatracker.ietf.org/doc/html/rfc7644#section-3.7
+    def post(self) -> Response:
+        if request.content_length is not None and request.content_length > BULK_MAX_PAYLOAD_SIZE:
+            return make_response(scim_error('The size of the bulk operation exceeds the maxPayloadSize (%i)' % BULK_MAX_PAYLOAD_SIZE, 413), 413)
+        # get request JSON, error out if invalid
+        try:
+            bulk_json = request.get_json(force=True)
+            operations: List[dict] = bulk_json['Operations']
+        except Exception as e:
+            return handle_validation_error(e)
+        if len(operations) > BULK_MAX_OPERATIONS:
+            return make_response(scim_error('The number of operations exceeds the maxOperations (%i)' % BULK_MAX_OPERATIONS, 413), 413)
+        # stop after this many errors, process everything if not set
+        fail_on_errors = bulk_json.get('failOnErrors')
+        # bool is an int too
+        if fail_on_errors is not None and (type(fail_on_errors) is not int or fail_on_errors < 1):
+            return make_response(scim_error('failOnErrors must be a positive integer', 400, scim_type='invalidValue'), 400)
+
+        try:
+            results: List[dict] = []
+            bulk_ids = {}
+            errors = 0
+            logger.info('Running %i bulk operations in batches of %i' % (len(operations), BULK_BATCH_SIZE))
+            for batch_start in range(0, len(operations), BULK_BATCH_SIZE):
+                batch_operations = operations[batch_start:batch_start + BULK_BATCH_SIZE]
+                batch_results: List[dict] = []
+                # ids the batch creates, only kept if the batch is committed
+                batch_bulk_ids = dict(bulk_ids)
+                try:
+                    # one transaction for the whole batch
+                    with users_backend.batch(), groups_backend.batch():
+                        for operation in batch_operations:
+                            status, resource_id = run_operation(operation, batch_bulk_ids)
+                            if 'bulkId' in operation: batch_bulk_ids[operation['bulkId']] = resource_id
+                            batch_results.append(operation_result(operation, status, resource_id))
+                except Exception as e:
+                    # the batch was rolled back, run its operations one at a time so only the ones
+                    # that fail are reported as failed
+                    logger.info('Bulk batch failed (%s), running its operations one at a time' % e)
+                    batch_results = []
+                    batch_bulk_ids = dict(bulk_ids)
+                    for operation in batch_operations:
+                        try:
+                            with users_backend.batch(), groups_backend.batch():
+                                status, resource_id = run_operation(operation, batch_bulk_ids)
+                            if 'bulkId' in operation: batch_bulk_ids[operation['bulkId']] = resource_id
+                            batch_results.append(operation_result(operation, status, resource_id))
+                        except Exception as e:
+                            logger.error('Bulk operation %s %s failed: %s' % (operation.get('method'), operation.get('path'), e))
+                            batch_results.append(operation_result(operation, error_status(e), error=e))
+                            errors += 1
+                            if fail_on_errors is not None and errors >= fail_on_errors: break
+                results.extend(batch_results)
+                bulk_ids = batch_bulk_ids
+                if fail_on_errors is not None and errors >= fail_on_errors:
+                    logger.info('Stopping bulk request after %i errors' % errors)
+                    break
+
+            response: Response = jsonify({'schemas': ['urn:ietf:params:scim:api:messages:2.0:BulkResponse'], 'Operations': results})
+            logger.debug('Response: %s' % response.get_json())
+            response.status_code = 200
+            return response
+        except Exception as e:
+            return handle_server_side_error(e)
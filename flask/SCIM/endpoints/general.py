@@ -1,9 +1,14 @@
 from traceback import format_exc
-from flask import Response, jsonify, make_response
+from typing import Union, Callable
+from flask import Response, request, jsonify, make_response
 from flask_restful import Resource
 
-from SCIM.helpers import scim_error, create_spconfig_json, set_up_logger
+from SCIM.helpers import scim_error, create_spconfig_json, set_up_logger, config
+from SCIM import app
 from SCIM.classes.generic.Cache import Cache
+from SCIM.classes.generic.SnapshotRefresher import SnapshotRefresher
+from SCIM.classes.generic.ListResponse import ListResponse
+from SCIM.classes.generic.ResourceCache import resource_cache
 
 logger = set_up_logger(__name__)
 
@@ -11,8 +16,11 @@ full_import_cache = Cache('full_import_cache.json')
 incremental_import_cache = Cache('incremental_import_cache.json')
 full_import_groups_cache = Cache('full_import_groups_cache.json')
 incremental_import_groups_cache = Cache('incremental_import_groups_cache.json')
+# keeps the full import snapshots warm, the users and groups endpoints register their snapshots with it
+snapshot_refresher = SnapshotRefresher(app)
 
 SPCONFIG_JSON: dict = create_spconfig_json()
+STREAM_LIST_RESPONSES: bool = config['General'].get('stream_list_responses', 'false').lower() == 'true'
 
 def handle_server_side_error(e: Exception) -> Response:
     error_json = scim_error("An unexpected error has occured: %s" % e, 500, format_exc())
@@ -26,6 +34,44 @@ def handle_validation_error(e: Exception) -> Response:
     logger.error(error_json)
     return error_response
 
+# weak ETags from the backends' resource versions: https://datatracker.ietf.org/doc/html/rfc7644#section-3.14
+# SCIM only uses weak ETags, so If-Match is compared weakly too
+def etag_matches_if_none_match(version: Union[str, None]) -> bool:
+    return version is not None and request.if_none_match.contains_weak(version)
+
+# a write with an If-Match that is not the current version (or a resource that does not exist) fails,
+# the version is only looked up if the request has an If-Match
+def etag_precondition_failed(get_version: Callable[[], Union[str, None]]) -> bool:
+    if not request.if_match: return False
+    version = get_version()
+    return version is None or not request.if_match.contains_weak(version)
+
+def precondition_failed_response() -> Response:
+    return make_response(scim_error('The resource was changed since it was read (If-Match)', 412), 412)
+
+def set_etag(response: Response, version: Union[str, None]) -> Response:
+    if version is not None: response.set_etag(version, weak=True)
+    return response
+
+def not_modified_response(version: str) -> Response:
+    return set_etag(make_response('', 304), version)
+
+def list_response(list_resp: ListResponse) -> Response:
+    if STREAM_LIST_RESPONSES:
+        response = Response(list_resp.stream(), mimetype='application/json')
+        # let nginx pass the chunks on as they are generated instead of buffering the whole body
+        response.headers['X-Accel-Buffering'] = 'no'
+        logger.debug('Streaming response with %i resources' % len(list_resp.list))
+    elif list_resp.encoded:
+        # resources read from a snapshot are already JSON, skip decoding and re-encoding them
+        response = Response(list_resp.scim_bytes, mimetype='application/json')
+        logger.debug('Response: %s' % response.get_json())
+    else:
+        response = jsonify(list_resp.scim_resource)
+        logger.debug('Response: %s' % response.get_json())
+    response.status_code = 200
+    return response
+
 class ServiceProviderConfigSCIM(Resource):
     def get(self) -> Response:
         try:
@@ -41,10 +87,24 @@ class ClearCache(Resource):
         try:
             full_import_cache.force_clear_cache()
             incremental_import_cache.force_clear_cache()
+            resource_cache.invalidate('User', None)
+            resource_cache.invalidate('Group', None)
             return make_response('', 204)
         except Exception as e:
             return handle_server_side_error(e)
 
+# how long this worker waited for database connections, only registered for the database backend
+class PoolStats(Resource):
+    def get(self) -> Response:
+        try:
+            from SCIM import db
+            from SCIM.classes.implementation.database.pool import checkout_stats
+            stats = checkout_stats.scim_resource
+            stats['pool'] = db.engine.pool.status()
+            return jsonify(stats)
+        except Exception as e:
+            return handle_server_side_error(e)
+
 class HealthCheck(Resource):
     def get(self) -> Response:
         return make_response('', 200)
\ No newline at end of file
@@ -1,12 +1,17 @@
+import json
 from typing import List
 from flask import request, jsonify, make_response, Response
 from flask_restful import Resource
 
-from SCIM import SUPPORTED_PROVISIONING_FEATURES
-from SCIM.helpers import set_up_logger
-from SCIM.endpoints.general import handle_server_side_error, handle_validation_error, full_import_groups_cache, incremental_import_groups_cache, SPCONFIG_JSON
+from SCIM import SUPPORTED_PROVISIONING_FEATURES, LIST_LOAD_STRATEGY, GET_LOAD_STRATEGY
+from SCIM.helpers import set_up_logger, scim_error
+from SCIM.endpoints.general import handle_server_side_error, handle_validation_error, list_response, full_import_groups_cache, incremental_import_groups_cache, snapshot_refresher, SPCONFIG_JSON, \
+    etag_matches_if_none_match, etag_precondition_failed, precondition_failed_response, set_etag, not_modified_response
 from SCIM.classes.generic.SCIMGroup import SCIMGroup, obj_list_to_scim_json_list
+from SCIM.classes.generic.Patch import GroupPatch
 from SCIM.classes.generic.ListResponse import ListResponse
+from SCIM.classes.generic.Projection import Projection
+from SCIM.classes.generic.ResourceCache import resource_cache
 # import our specific class as a generic Backend name, so that only the class being imported needs to be modified and the rest of the code runs the same
 # all specific implementations should be subclasses of the SCIM.classes.generic.Backend.UserBackend class
 #from SCIM.classes.implementation.database.DBBackend import DBBackend as Backend
@@ -15,6 +20,8 @@ from SCIM.classes.implementation.database.groups.DBGroupsBackend import DBGroups
 logger = set_up_logger(__name__)
 
 backend = Backend()
+# full imports have no filter, so their snapshot can be built ahead of time
+snapshot_refresher.register(full_import_groups_cache, lambda: obj_list_to_scim_json_list(backend.list_groups(load_strategy=LIST_LOAD_STRATEGY)))
 
 def check_feature_supported(feature_list: List[str]) -> bool:
     for feature in feature_list:
@@ -55,42 +62,78 @@ class GroupsSCIM(Resource):
                 filter_string = None
                 import_type = 'full'
 
+            if 'count' in args: 
+                count = int(args.get('count'))
+            else:
+                count = SPCONFIG_JSON['filter']['maxResults']
+
+            if 'totalResults' in args: 
+                totalResults = int(args.get('totalResults'))
+            else:
+                totalResults = None
+
+            # attributes and excludedAttributes, the snapshots hold whole groups so a projected page is read
+            # from the backend, which then only loads the attributes that are returned
+            projection = Projection.from_args(args)
+
             first_page: bool = startIndex == 1
-            # if not doing an import (ex: getting user before create/update) dont bother
-            # with the cache
-            if import_type == 'other':
-                logger.info('Non-import, calling backend')
-                groups = backend.list_groups(filter=filter_string)
+            # the snapshot cache for this type of import, if not doing an import
+            # (ex: getting group before create/update) dont bother with the cache
+            if projection is not None:
+                cache = None
+            elif import_type == 'full':
+                cache = full_import_groups_cache
+            elif import_type == 'incremental':
+                cache = incremental_import_groups_cache
+            else:
+                cache = None
+            # builds the snapshot when this process wins the build lock, concurrent imports wait for it instead
+            build = lambda: obj_list_to_scim_json_list(backend.list_groups(filter=filter_string, load_strategy=LIST_LOAD_STRATEGY))
+
+            if cache is None:
+                logger.info('Non-import, calling backend for the requested page')
+                groups = backend.list_groups(filter=filter_string, load_strategy=LIST_LOAD_STRATEGY, start_index=startIndex, count=count, projection=projection)
+                # a short first page has every matching group, so the count is only queried when there can be more
+                if totalResults is None:
+                    totalResults = backend.count_groups(filter=filter_string) if len(groups) == count or startIndex > 1 else startIndex - 1 + len(groups)
             # check if first page and no existing cache lock, if so, call DB
-            elif first_page and ((import_type == 'full' and not full_import_groups_cache.check_for_lock_file()) or (import_type == 'incremental' and not incremental_import_groups_cache.check_for_lock_file())):
-                logger.info('First page and no cache lock, reading groups from backend')
-                groups = backend.list_groups(filter=filter_string)
-            # else just get the users from the cache
+            elif first_page and not cache.check_for_lock_file():
+                if totalResults is None: totalResults = backend.count_groups(filter=filter_string)
+                # if everything fits on one page there is no pagination to cache for
+                if totalResults <= count:
+                    logger.info('First page and no cache lock, all groups fit on one page, reading page from backend')
+                    groups = backend.list_groups(filter=filter_string, load_strategy=LIST_LOAD_STRATEGY, start_index=startIndex, count=count)
+                else:
+                    # with the refresher running, imports start on the pre-warmed snapshot. A stale snapshot is still
+                    # served while it is rebuilt in the background, the rebuilt one is used by the next import
+                    if snapshot_refresher.enabled and import_type == 'full' and cache.acquire_lease(require_snapshot=True) is not None:
+                        logger.info('First page and no cache lock, reading groups from pre-warmed snapshot')
+                        if not cache.check_cache_lifetime_valid(): snapshot_refresher.refresh_async(cache)
+                    else:
+                        logger.info('First page and no cache lock, building snapshot of groups from backend')
+                        # the snapshot is leased as it is published so it cant be replaced before this pagination process reads it
+                        cache.build_snapshot(build, acquire_lease=True)
+                    groups = cache.read_raw_cache(start_index=startIndex, count=count)
+                    totalResults = cache.resource_count()
+            # else just get the groups from the cache
             else:
                 logger.info('Not the first page or the cache is locked, reading groups from cache')
-                # if its the first page but a lock file exists, append to it so it doesnt get removed
-                # by another pagination process
-                if first_page and ((import_type == 'full' and full_import_groups_cache.check_for_lock_file()) or (import_type == 'incremental' and incremental_import_groups_cache.check_for_lock_file())):
-                    if import_type == 'full': full_import_groups_cache.append_lock_file('start')
-                    elif import_type == 'incremental': incremental_import_groups_cache.append_lock_file('start')
+                # if its the first page but the cache is leased, take another lease so the snapshot
+                # doesnt get replaced while this pagination process is using it
+                if first_page: cache.acquire_lease()
                 try:
-                    if import_type == 'full':  groups = full_import_groups_cache.read_json_cache()
-                    elif import_type == 'incremental': groups = incremental_import_groups_cache.read_json_cache()
+                    # only the resources on the requested page are read out of the snapshot, they
+                    # stay encoded and are copied straight into the response
+                    groups = cache.read_raw_cache(start_index=startIndex, count=count)
                 except (TimeoutError, FileNotFoundError):
                     logger.info('Error reading cache, either no longer valid or does not exist. Pulling from backend and saving new cache')
-                    groups = backend.list_groups(filter=filter_string)
-                    if import_type == 'full': full_import_groups_cache.write_json_cache(obj_list_to_scim_json_list(groups))
-                    elif import_type == 'incremental': incremental_import_groups_cache.write_json_cache(obj_list_to_scim_json_list(groups))
+                    cache.build_snapshot(build)
+                    groups = cache.read_raw_cache(start_index=startIndex, count=count)
+                if totalResults is None: totalResults = cache.resource_count()
 
-            if 'totalResults' in args: 
-                totalResults = int(args.get('totalResults'))
-            else:
+            if totalResults is None:
                 totalResults = len(groups)
 
-            if 'count' in args: 
-                count = int(args.get('count'))
-            else:
-                count = SPCONFIG_JSON['filter']['maxResults']
             # if the total results are smaller than a page size
             if totalResults < count:
                 count = totalResults
@@ -100,30 +143,12 @@ class GroupsSCIM(Resource):
             elif startIndex + count > totalResults + 1:
                 count = totalResults - startIndex + 1
 
-            # if first page, and there will be more than one page, and there is no current cache/lock,
-            # write data to cache and create a cache lock
-            if first_page and startIndex + count < totalResults + 1 and ((import_type == 'full' and not full_import_groups_cache.check_for_lock_file()) or (import_type == 'incremental' and not incremental_import_groups_cache.check_for_lock_file())):
-                logger.info('First page of pagination and no cache lock, writing data to cache and creating lock')
-                if import_type == 'full':
-                    full_import_groups_cache.write_json_cache(obj_list_to_scim_json_list(groups))
-                    full_import_groups_cache.create_lock_file()
-                elif import_type == 'incremental':
-                    incremental_import_groups_cache.write_json_cache(obj_list_to_scim_json_list(groups))
-                    incremental_import_groups_cache.create_lock_file()
-            # if last page clean up cache lock
-            if startIndex + count == totalResults + 1 and not first_page:
+            # if last page release this pagination process's lease
+            if startIndex + count == totalResults + 1 and not first_page and cache is not None:
                 logger.info('Last page, attempting to clean up cache lock')
-                if import_type == 'full':
-                    full_import_groups_cache.append_lock_file('end')
-                    full_import_groups_cache.cleanup_lock_file()
-                elif import_type == 'incremental':
-                    incremental_import_groups_cache.append_lock_file('end')
-                    incremental_import_groups_cache.cleanup_lock_file()
-
-            response: Response = jsonify(ListResponse(groups[startIndex-1:startIndex-1+count], startIndex, count, totalResults).scim_resource)
-            logger.debug('Response: %s' % response.get_json())
-            response.status_code = 200
-            return response
+                cache.release_lease()
+
+            return list_response(ListResponse(groups, startIndex, count, totalResults, projection=projection))
 
         except Exception as e:
             return handle_server_side_error(e)
@@ -162,6 +187,9 @@ class GroupsSpecificSCIM(Resource):
     PUT_FEATURES = [
         'GROUP_PUSH'
     ]
+    PATCH_FEATURES = [
+        'GROUP_PUSH'
+    ]
     DELETE_FEATURES = [
         'GROUP_PUSH'
     ]
@@ -171,15 +199,23 @@ class GroupsSpecificSCIM(Resource):
             # if this method is not needed for the supported features return a 501 Not Implemented
             if not check_feature_supported(self.GET_FEATURES): return make_response('', 501)
             
-            scim_group: SCIMGroup = backend.get_group(group_id)
-            if scim_group is not None:
-                list_resp = ListResponse([scim_group], start_index=1, count=None, total_results=1)
-            else:
-                list_resp = ListResponse([])
-            response: Response = jsonify(list_resp.scim_resource)
-            logger.debug('Response: %s' % response.get_json())
-            response.status_code = 200
-            return response
+            # repeated lookups are served from the resource cache
+            cached_group = resource_cache.get('Group', group_id)
+            if cached_group is None:
+                position = resource_cache.position()
+                # the version is read before the group so a write in between can only make it older than the group,
+                # an unchanged group is answered without loading its members
+                version = backend.get_group_version(group_id)
+                if etag_matches_if_none_match(version): return not_modified_response(version)
+                scim_group: SCIMGroup = backend.get_group(group_id, load_strategy=GET_LOAD_STRATEGY)
+                if scim_group is None:
+                    return list_response(ListResponse([]))
+                cached_group = (json.dumps(scim_group.scim_resource).encode('utf-8'), version)
+                resource_cache.put('Group', group_id, cached_group, position)
+            encoded_group, version = cached_group
+            if etag_matches_if_none_match(version): return not_modified_response(version)
+            # the cache holds the whole group, attributes and excludedAttributes are applied to it
+            return set_etag(list_response(ListResponse([encoded_group], start_index=1, count=None, total_results=1, projection=Projection.from_args(request.args))), version)
         except Exception as e:
             return handle_server_side_error(e)
 
@@ -199,32 +235,49 @@ class GroupsSpecificSCIM(Resource):
             return handle_validation_error(e)
 
         try:
+            # dont overwrite changes the client has not seen
+            if etag_precondition_failed(lambda: backend.get_group_version(group_id)): return precondition_failed_response()
             in_scim_group = SCIMGroup(scim_json, init_type='scim')
             logger.debug('Input: %s' % in_scim_group.scim_resource)
             out_scim_group = backend.update_group(in_scim_group)
             response: Response = jsonify(out_scim_group.scim_resource)
             logger.debug('Response: %s' % response.get_json())
             response.status_code = 200
-            return response
+            return set_etag(response, backend.get_group_version(group_id))
         except Exception as e:
             return handle_server_side_error(e)
 
     # update group name: https://developer.okta.com/docs/reference/scim/scim-20/#update-a-specific-group-name
     # update group membership: https://developer.okta.com/docs/reference/scim/scim-20/#update-specific-group-membership
     # this is for OIN applications, not currently supported for OPP
-    """
-    def patch(self, group_id: str):
+    # only the members added and removed are written, Okta expects a 204 without the group in the response
+    def patch(self, group_id: str) -> Response:
         try:
-            pass
+            # if this method is not needed for the supported features return a 501 Not Implemented
+            if not check_feature_supported(self.PATCH_FEATURES): return make_response('', 501)
+        except Exception as e:
+            return handle_server_side_error(e)
+
+        # get request JSON, error out if invalid
+        try:
+            patch = GroupPatch(request.get_json(force=True))
+        except Exception as e:
+            return handle_validation_error(e)
+
+        try:
+            if etag_precondition_failed(lambda: backend.get_group_version(group_id)): return precondition_failed_response()
+            if not backend.patch_group(group_id, patch):
+                return make_response(scim_error('Group %s not found' % group_id, 404), 404)
+            return set_etag(make_response('', 204), backend.get_group_version(group_id))
         except Exception as e:
             return handle_server_side_error(e)
-    """
 
     # delete group: https://developer.okta.com/docs/reference/scim/scim-20/#delete-a-specific-group
     def delete(self, group_id: str) -> Response:
         try:
             # if this method is not needed for the supported features return a 501 Not Implemented
             if not check_feature_supported(self.DELETE_FEATURES): return make_response('', 501)
+            if etag_precondition_failed(lambda: backend.get_group_version(group_id)): return precondition_failed_response()
             backend.delete_group(group_id)
             return make_response('', 204)
         except Exception as e:
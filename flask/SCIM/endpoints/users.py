@@ -1,13 +1,18 @@
+import json
 from typing import List
 from flask import request, jsonify, make_response, Response
 from flask_restful import Resource
 
-from SCIM import SUPPORTED_PROVISIONING_FEATURES
-from SCIM.helpers import set_up_logger
-from SCIM.endpoints.general import handle_server_side_error, handle_validation_error, full_import_cache, incremental_import_cache, SPCONFIG_JSON
+from SCIM import SUPPORTED_PROVISIONING_FEATURES, LIST_LOAD_STRATEGY, GET_LOAD_STRATEGY
+from SCIM.helpers import set_up_logger, scim_error
+from SCIM.endpoints.general import handle_server_side_error, handle_validation_error, list_response, full_import_cache, incremental_import_cache, snapshot_refresher, SPCONFIG_JSON, \
+    etag_matches_if_none_match, etag_precondition_failed, precondition_failed_response, set_etag, not_modified_response
 from SCIM.classes.generic.Filter import FilterValidationError
-from SCIM.classes.generic.SCIMUser import SCIMUser, obj_list_to_scim_json_list
+from SCIM.classes.generic.Patch import UserPatch
+from SCIM.classes.generic.SCIMUser import SCIMUser
 from SCIM.classes.generic.ListResponse import ListResponse
+from SCIM.classes.generic.Projection import Projection
+from SCIM.classes.generic.ResourceCache import resource_cache
 # import our specific class as a generic Backend name, so that only the class being imported needs to be modified and the rest of the code runs the same
 # all specific implementations should be subclasses of the SCIM.classes.generic.Backend.UserBackend class
 from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend as Backend
@@ -19,6 +24,8 @@ from SCIM.classes.implementation.database.users.DBUsersFilter import DBUsersFilt
 logger = set_up_logger(__name__)
 
 backend = Backend()
+# full imports have no filter, so their snapshot can be built ahead of time
+snapshot_refresher.register(full_import_cache, lambda: backend.list_user_resources())
 
 def check_feature_supported(feature_list: List[str]) -> bool:
     for feature in feature_list:
@@ -66,42 +73,83 @@ class UsersSCIM(Resource):
             else:
                 startIndex = 1
 
+            count = SPCONFIG_JSON['filter']['maxResults']
+            if 'count' in args: 
+                if int(args.get('count')) <= count:
+                    count = int(args.get('count'))
+
+            if 'totalResults' in args: 
+                totalResults = int(args.get('totalResults'))
+            else:
+                totalResults = None
+
+            # attributes and excludedAttributes, the snapshots hold whole users so a projected page is read
+            # from the backend, which then only loads the attributes that are returned
+            projection = Projection.from_args(args)
+
             first_page: bool = startIndex == 1
-            # if not doing an import (ex: getting user before create/update) dont bother
-            # with the cache
-            if import_type == 'other':
-                logger.info('Non-import, calling backend')
-                users = backend.list_users(filter=filter_string)
+            # the snapshot cache for this type of import, if not doing an import
+            # (ex: getting user before create/update) dont bother with the cache
+            if projection is not None:
+                cache = None
+            elif import_type == 'full':
+                cache = full_import_cache
+            elif import_type == 'incremental':
+                cache = incremental_import_cache
+            else:
+                cache = None
+            # builds the snapshot when this process wins the build lock, concurrent imports wait for it instead
+            build = lambda: backend.list_user_resources(filter=filter_string)
+
+            if cache is None:
+                logger.info('Non-import, calling backend for the requested page')
+                # whole users are built straight from the backend's rows, a projection needs the SCIMUsers it loads partially
+                if projection is None:
+                    users = backend.list_user_resources(filter=filter_string, start_index=startIndex, count=count)
+                else:
+                    users = backend.list_users(filter=filter_string, load_strategy=LIST_LOAD_STRATEGY, start_index=startIndex, count=count, projection=projection)
+                # a short first page has every matching user, so the count is only queried when there can be more
+                # (ex: the userName eq lookup Okta makes before every push is one query)
+                if totalResults is None:
+                    totalResults = backend.count_users(filter=filter_string) if len(users) == count or startIndex > 1 else startIndex - 1 + len(users)
             # check if first page and no existing cache lock, if so, call DB
-            elif first_page and ((import_type == 'full' and not full_import_cache.check_for_lock_file()) or (import_type == 'incremental' and not incremental_import_cache.check_for_lock_file())):
-                logger.info('First page and no cache lock, reading users from backend')
-                users = backend.list_users(filter=filter_string)
+            elif first_page and not cache.check_for_lock_file():
+                if totalResults is None: totalResults = backend.count_users(filter=filter_string)
+                # if everything fits on one page there is no pagination to cache for
+                if totalResults <= count:
+                    logger.info('First page and no cache lock, all users fit on one page, reading page from backend')
+                    users = backend.list_user_resources(filter=filter_string, start_index=startIndex, count=count)
+                else:
+                    # with the refresher running, imports start on the pre-warmed snapshot. A stale snapshot is still
+                    # served while it is rebuilt in the background, the rebuilt one is used by the next import
+                    if snapshot_refresher.enabled and import_type == 'full' and cache.acquire_lease(require_snapshot=True) is not None:
+                        logger.info('First page and no cache lock, reading users from pre-warmed snapshot')
+                        if not cache.check_cache_lifetime_valid(): snapshot_refresher.refresh_async(cache)
+                    else:
+                        logger.info('First page and no cache lock, building snapshot of users from backend')
+                        # the snapshot is leased as it is published so it cant be replaced before this pagination process reads it
+                        cache.build_snapshot(build, acquire_lease=True)
+                    users = cache.read_raw_cache(start_index=startIndex, count=count)
+                    totalResults = cache.resource_count()
             # else just get the users from the cache
             else:
                 logger.info('Not the first page or the cache is locked, reading users from cache')
-                # if its the first page but a lock file exists, append to it so it doesnt get removed
-                # by another pagination process
-                if first_page and ((import_type == 'full' and full_import_cache.check_for_lock_file()) or (import_type == 'incremental' and incremental_import_cache.check_for_lock_file())):
-                    if import_type == 'full': full_import_cache.append_lock_file('start')
-                    elif import_type == 'incremental': incremental_import_cache.append_lock_file('start')
+                # if its the first page but the cache is leased, take another lease so the snapshot
+                # doesnt get replaced while this pagination process is using it
+                if first_page: cache.acquire_lease()
                 try:
-                    if import_type == 'full':  users = full_import_cache.read_json_cache()
-                    elif import_type == 'incremental': users = incremental_import_cache.read_json_cache()
+                    # only the resources on the requested page are read out of the snapshot, they
+                    # stay encoded and are copied straight into the response
+                    users = cache.read_raw_cache(start_index=startIndex, count=count)
                 except (TimeoutError, FileNotFoundError):
                     logger.info('Error reading cache, either no longer valid or does not exist. Pulling from backend and saving new cache')
-                    users = backend.list_users(filter=filter_string)
-                    if import_type == 'full': full_import_cache.write_json_cache(obj_list_to_scim_json_list(users))
-                    elif import_type == 'incremental': incremental_import_cache.write_json_cache(obj_list_to_scim_json_list(users))
+                    cache.build_snapshot(build)
+                    users = cache.read_raw_cache(start_index=startIndex, count=count)
+                if totalResults is None: totalResults = cache.resource_count()
 
-            if 'totalResults' in args: 
-                totalResults = int(args.get('totalResults'))
-            else:
+            if totalResults is None:
                 totalResults = len(users)
 
-            count = SPCONFIG_JSON['filter']['maxResults']
-            if 'count' in args: 
-                if int(args.get('count')) <= count:
-                    count = int(args.get('count'))
             # if the total results are smaller than a page size
             if totalResults < count:
                 count = totalResults
@@ -111,30 +159,12 @@ class UsersSCIM(Resource):
             elif startIndex + count > totalResults + 1:
                 count = totalResults - startIndex + 1
 
-            # if first page, and there will be more than one page, and there is no current cache/lock,
-            # write data to cache and create a cache lock
-            if first_page and startIndex + count < totalResults + 1 and ((import_type == 'full' and not full_import_cache.check_for_lock_file()) or (import_type == 'incremental' and not incremental_import_cache.check_for_lock_file())):
-                logger.info('First page of pagination and no cache lock, writing data to cache and creating lock')
-                if import_type == 'full':
-                    full_import_cache.write_json_cache(obj_list_to_scim_json_list(users))
-                    full_import_cache.create_lock_file()
-                elif import_type == 'incremental':
-                    incremental_import_cache.write_json_cache(obj_list_to_scim_json_list(users))
-                    incremental_import_cache.create_lock_file()
-            # if last page clean up cache lock
-            if startIndex + count == totalResults + 1 and not first_page:
+            # if last page release this pagination process's lease
+            if startIndex + count == totalResults + 1 and not first_page and cache is not None:
                 logger.info('Last page, attempting to clean up cache lock')
-                if import_type == 'full':
-                    full_import_cache.append_lock_file('end')
-                    full_import_cache.cleanup_lock_file()
-                elif import_type == 'incremental':
-                    incremental_import_cache.append_lock_file('end')
-                    incremental_import_cache.cleanup_lock_file()
-
-            response: Response = jsonify(ListResponse(users[startIndex-1:startIndex-1+count], startIndex, count, totalResults).scim_resource)
-            logger.debug('Response: %s' % response.get_json())
-            response.status_code = 200
-            return response
+                cache.release_lease()
+
+            return list_response(ListResponse(users, startIndex, count, totalResults, projection=projection))
         except Exception as e:
             return handle_server_side_error(e)
 
@@ -175,21 +205,34 @@ class UserSpecificSCIM(Resource):
         'PUSH_USER_DEACTIVATION',
         'REACTIVATE_USERS'
     ]
+    PATCH_FEATURES = [
+        'PUSH_PASSWORD_UPDATES',
+        'PUSH_USER_DEACTIVATION',
+        'REACTIVATE_USERS'
+    ]
     # get a specific user: https://developer.okta.com/docs/reference/scim/scim-20/#retrieve-a-specific-user
     def get(self, user_id: str) -> Response:
         try:
             # if this method is not needed for the supported features return a 501 Not Implemented
             if not check_feature_supported(self.GET_FEATURES): return make_response('', 501)
 
-            scim_user: SCIMUser = backend.get_user(user_id)
-            if scim_user is not None:
-                list_resp = ListResponse([scim_user], start_index=1, count=None, total_results=1)
-            else:
-                list_resp = ListResponse([])
-            response: Response = jsonify(list_resp.scim_resource)
-            logger.debug('Response: %s' % response.get_json())
-            response.status_code = 200
-            return response
+            # Okta gets the user before almost every push, repeated lookups are served from the resource cache
+            cached_user = resource_cache.get('User', user_id)
+            if cached_user is None:
+                position = resource_cache.position()
+                # the version is read before the user so a write in between can only make it older than the user,
+                # an unchanged user is answered without loading it
+                version = backend.get_user_version(user_id)
+                if etag_matches_if_none_match(version): return not_modified_response(version)
+                scim_user: SCIMUser = backend.get_user(user_id, load_strategy=GET_LOAD_STRATEGY)
+                if scim_user is None:
+                    return list_response(ListResponse([]))
+                cached_user = (json.dumps(scim_user.scim_resource).encode('utf-8'), version)
+                resource_cache.put('User', user_id, cached_user, position)
+            encoded_user, version = cached_user
+            if etag_matches_if_none_match(version): return not_modified_response(version)
+            # the cache holds the whole user, attributes and excludedAttributes are applied to it
+            return set_etag(list_response(ListResponse([encoded_user], start_index=1, count=None, total_results=1, projection=Projection.from_args(request.args))), version)
         except Exception as e:
             return handle_server_side_error(e)
 
@@ -209,13 +252,15 @@ class UserSpecificSCIM(Resource):
             return handle_validation_error(e)
 
         try:
+            # dont overwrite changes the client has not seen
+            if etag_precondition_failed(lambda: backend.get_user_version(user_id)): return precondition_failed_response()
             in_scim_user = SCIMUser(scim_json, init_type='scim')
             logger.debug('Input: %s' % in_scim_user.scim_resource)
             out_scim_user = backend.update_user(in_scim_user)
             response: Response = jsonify(out_scim_user.scim_resource)
             logger.debug('Response: %s' % response.get_json())
             response.status_code = 200
-            return response
+            return set_etag(response, backend.get_user_version(user_id))
         except Exception as e:
             return handle_server_side_error(e)
 
@@ -223,12 +268,29 @@ class UserSpecificSCIM(Resource):
     # note okta says this is currently only supported for OIN applications, so if we create this as an app wizard app all of these updates
     # will happen in the PUT operation
     # this is also used for user deactivation in OIN apps
-    """
-    def patch(self, user_id: str):
+    def patch(self, user_id: str) -> Response:
         try:
-            
+            # if this method is not needed for the supported features return a 501 Not Implemented
+            if not check_feature_supported(self.PATCH_FEATURES): return make_response('', 501)
+        except Exception as e:
+            return handle_server_side_error(e)
+
+        # get request JSON, error out if invalid
+        try:
+            patch = UserPatch(request.get_json(force=True))
+        except Exception as e:
+            return handle_validation_error(e)
+
+        try:
+            if etag_precondition_failed(lambda: backend.get_user_version(user_id)): return precondition_failed_response()
+            out_scim_user = backend.patch_user(user_id, patch)
+            if out_scim_user is None:
+                return make_response(scim_error('User %s not found' % user_id, 404), 404)
+            response: Response = jsonify(out_scim_user.scim_resource)
+            logger.debug('Response: %s' % response.get_json())
+            response.status_code = 200
+            return set_etag(response, backend.get_user_version(user_id))
         except Exception as e:
             return handle_server_side_error(e)
-    """
 
     # Okta's notes on user deletion: https://developer.okta.com/docs/concepts/scim/#delete-deprovision
\ No newline at end of file
@@ -0,0 +1,57 @@
+import gc
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import List, Callable
+
+from SCIM.classes.implementation.database.models import UsersDB
+from SCIM.examples.populate_example_db import read_user_data
+
+# measures what a full import spends on SCIMUser objects: the time to build them from database rows and
+# to format their scim_resource, and the memory the built users hold. The rows are users.csv repeated
+# up to --count and are never added to a session, so no database is used. Run from the flask directory:
+# python -m SCIM.examples.benchmark_scim_objects --count 500000
+
+def best_time(func: Callable, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def held_memory(func: Callable) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        held, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return held
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000, help='number of users to build')
+    parser.add_argument('--repeat', type=int, default=3, help='timings are the best of this many runs')
+    args = parser.parse_args()
+
+    csv_rows: List[UsersDB] = read_user_data('./SCIM/examples/users.csv')
+    rows = [csv_rows[i % len(csv_rows)] for i in range(args.count)]
+    # load the (empty) relationships of the rows so they are not part of the measurements
+    for row in csv_rows: row.group_associations
+
+    build = lambda: [row.scim_user for row in rows]
+    scim_users = build()
+    build_sec = best_time(build, args.repeat)
+    format_sec = best_time(lambda: [scim_user.scim_resource for scim_user in scim_users], args.repeat)
+    del scim_users
+    memory = held_memory(build)
+
+    print('%i users' % args.count)
+    print('build scim_user:     %8.3f s  %6.2f us/user' % (build_sec, build_sec * 1e6 / args.count))
+    print('format scim_resource: %7.3f s  %6.2f us/user' % (format_sec, format_sec * 1e6 / args.count))
+    print('memory held:         %8.1f MB  %6i B/user' % (memory / 1e6, memory / args.count))
@@ -46,6 +46,12 @@ else:
 headerName = config['Auth']['headerName']
 headerValue = config['Auth']['headerValue']
 
+# [Bulk] was added after the other sections, fall back to bulk being off if it is missing
+BULK_SUPPORTED: bool = config.get('Bulk', 'supported', fallback='false').lower() == 'true'
+BULK_MAX_OPERATIONS: int = int(config.get('Bulk', 'max_operations', fallback='1000'))
+BULK_MAX_PAYLOAD_SIZE: int = int(config.get('Bulk', 'max_payload_size', fallback='1048576'))
+BULK_BATCH_SIZE: int = int(config.get('Bulk', 'batch_size', fallback='100'))
+
 def set_up_logger(name: str, level=LOG_LEVEL, handlers: List[Handler] = [StreamHandler()]) -> Logger:
     logger = getLogger(name)
     logger.setLevel(level)
@@ -72,12 +78,15 @@ def authenticate(headers: Headers, type: str='Header') -> bool:
     else:
         raise ValueError("The authentication type: %s is not recognized" % type)
 
-def scim_error(message: str, status_code: int=500, stack_trace:str = None) -> dict:
+# scim_type is the detail error keyword of a 400 (https://datatracker.ietf.org/doc/html/rfc7644#section-3.12)
+def scim_error(message: str, status_code: int=500, stack_trace:str = None, scim_type: str = None) -> dict:
     rv = {
         "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
         "detail": message,
         "status": status_code
     }
+    if scim_type is not None:
+        rv['scimType'] = scim_type
     if stack_trace is not None:
         rv['stack_trace'] = stack_trace
     return rv
@@ -85,10 +94,10 @@ def scim_error(message: str, status_code: int=500, stack_trace:str = None) -> di
 def create_spconfig_json() -> dict:
     spconfig_json = {
         'schemas': ['urn:scim:schemas:core:1.0', 'urn:okta:schemas:scim:providerconfig:1.0'],
-        'patch': {'supported': False},
-        'bulk': {'supported': False},
+        'patch': {'supported': True},
+        'bulk': {'supported': BULK_SUPPORTED, 'maxOperations': BULK_MAX_OPERATIONS, 'maxPayloadSize': BULK_MAX_PAYLOAD_SIZE},
         'sort': {'supported': False},
-        'etag': {'supported': False},
+        'etag': {'supported': True},
         'filter': {'supported': True, 'maxResults': 200},
         'authenticationSchemes': []
     }
@@ -2,6 +2,7 @@ from os import path, listdir, remove
 from sys import exit
 from json import load
 from logging import Logger
+from typing import Callable
 from requests import Response, get, post, put
 from configparser import ConfigParser
 from urllib.parse import urljoin
@@ -19,6 +20,19 @@ GET_ID: str = config['Deployment']['get_id']
 CACHE_DIR: str = config['Cache']['dir'].strip('/').strip('\\')
 LOCAL_DEPLOYMENT: bool = config['Deployment']['local'].lower() == 'true'
 
+# counts the SQL statements sent to the engine while func runs
+def count_statements(engine, func: Callable) -> int:
+    from sqlalchemy import event
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        func()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements)
+
 class TestHelper:
     def __init__(self, endpoint_uri: str, logger: Logger) -> None:
         self.endpoint_uri = endpoint_uri
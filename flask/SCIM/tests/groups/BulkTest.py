@@ -0,0 +1,58 @@
+from logging import DEBUG
+from unittest import TestCase, main, skipUnless
+from requests import get, post
+
+from SCIM.helpers import set_up_logger
+from SCIM.tests.common import TestHelper, BASE_URL
+
+logger = set_up_logger(__name__, level=DEBUG)
+
+test_helper = TestHelper('/Bulk', logger)
+
+BULK_SUPPORTED: bool = get(BASE_URL + '/ServiceProviderConfigs').json()['bulk']['supported']
+
+@skipUnless(BULK_SUPPORTED, 'bulk is not enabled on the connector')
+class BulkTests(TestCase):
+    def test_bulk_request(self) -> None:
+        response = test_helper.post_file_contents('../data/bulkRequest.json')
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        operations = response.json()['Operations']
+        logger.info('The bulk response from the connector: %s' % operations)
+        self.assertEqual([operation['status'] for operation in operations], ['201', '200', '404', '204'])
+        # the update and delete found the group created earlier in the same request by its bulkId
+        group_id = operations[0]['location'].split('/')[-1]
+        self.assertEqual(operations[1]['location'].split('/')[-1], group_id)
+        self.assertEqual(operations[3]['location'].split('/')[-1], group_id)
+        # the failed update was reported on its own, the operations around it were still committed
+        self.assertEqual(operations[2]['response']['status'], 404)
+        group_response = get(BASE_URL + '/Groups/' + group_id)
+        self.assertEqual(group_response.json()['totalResults'], 0)
+
+    def test_bulk_fail_on_errors(self) -> None:
+        missing_group = {'schemas': ['urn:scim:schemas:core:1.0'], 'displayName': 'BulkGroup-Missing', 'members': []}
+        bulk_request = {
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:BulkRequest'],
+            'failOnErrors': 1,
+            'Operations': [
+                {'method': 'PUT', 'path': '/Groups/00000000-0000-0000-0000-000000000001', 'data': missing_group},
+                {'method': 'PUT', 'path': '/Groups/00000000-0000-0000-0000-000000000002', 'data': missing_group}
+            ]
+        }
+        response = post(BASE_URL + '/Bulk', json=bulk_request, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        # processing stops at the first error
+        operations = response.json()['Operations']
+        self.assertEqual(len(operations), 1)
+        self.assertEqual(operations[0]['status'], '404')
+
+    def test_bulk_invalid_fail_on_errors(self) -> None:
+        for fail_on_errors in ['1', 0, -1, True]:
+            bulk_request = {'schemas': ['urn:ietf:params:scim:api:messages:2.0:BulkRequest'], 'failOnErrors': fail_on_errors, 'Operations': []}
+            response = post(BASE_URL + '/Bulk', json=bulk_request, verify=False)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['scimType'], 'invalidValue')
+
+if __name__ == '__main__':
+    main()
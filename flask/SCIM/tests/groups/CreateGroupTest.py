@@ -1,9 +1,9 @@
 from logging import DEBUG
-from unittest import TestCase, main
+from unittest import TestCase, main, skipUnless
 from requests import get
 
 from SCIM.helpers import set_up_logger
-from SCIM.tests.common import TestHelper, BASE_URL
+from SCIM.tests.common import TestHelper, BASE_URL, LOCAL_DEPLOYMENT, count_statements
 
 logger = set_up_logger(__name__, level=DEBUG)
 
@@ -48,6 +48,29 @@ class CreateGroupsTests(TestCase):
 
         logger.info('The group returned from the connector: %s' % response.json())
 
+    @skipUnless(LOCAL_DEPLOYMENT, 'SQL statements can only be counted against the local example database')
+    def test_create_group_statement_count(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.generic.SCIMGroup import SCIMGroup
+        from SCIM.classes.implementation.database.models import UsersDB
+        from SCIM.classes.implementation.database.groups.DBGroupsBackend import DBGroupsBackend
+        backend = DBGroupsBackend()
+        with app.app_context():
+            user_ids = [user_id for (user_id,) in db.session.query(UsersDB.id)]
+            statement_counts = []
+            # the members are inserted in one statement, so the count does not grow with the group
+            for members in [user_ids[:1], user_ids]:
+                scim_group = SCIMGroup({'displayName': 'StatementCount', 'members': [{'value': user_id} for user_id in members],
+                    'urn:okta:custom:group:1.0': {'description': 'test'}}, init_type='scim')
+                db.session.expunge_all()
+                created_groups = []
+                statement_counts.append(count_statements(db.engine, lambda: created_groups.append(backend.create_group(scim_group))))
+                self.assertEqual(len(created_groups[0].members), len(members))
+                backend.delete_group(created_groups[0].id)
+        logger.info('create_group statements with 1 and %i members: %s' % (len(user_ids), statement_counts))
+        self.assertEqual(statement_counts[0], statement_counts[1])
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
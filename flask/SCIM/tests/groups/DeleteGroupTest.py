@@ -1,9 +1,10 @@
+from datetime import datetime
 from logging import DEBUG
-from unittest import TestCase, main
-from requests import delete
+from unittest import TestCase, main, skipUnless
+from requests import delete, get
 
 from SCIM.helpers import set_up_logger
-from SCIM.tests.common import TestHelper, BASE_URL
+from SCIM.tests.common import TestHelper, BASE_URL, LOCAL_DEPLOYMENT, count_statements
 
 logger = set_up_logger(__name__, level=DEBUG)
 
@@ -20,6 +21,31 @@ class DeleteGroupsTests(TestCase):
         self.assertEqual(response.status_code, 204)
         logger.info('Group with ID %s was deleted successfully')
 
+    @skipUnless(LOCAL_DEPLOYMENT, 'SQL statements can only be counted against the local example database')
+    def test_delete_group_with_members(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.generic.SCIMGroup import SCIMGroup
+        from SCIM.classes.implementation.database.models import UsersDB
+        from SCIM.classes.implementation.database.groups.DBGroupsBackend import DBGroupsBackend
+        backend = DBGroupsBackend()
+        with app.app_context():
+            user_ids = [user_id for (user_id,) in db.session.query(UsersDB.id)]
+            scim_group = SCIMGroup({'displayName': 'DeleteWithMembers', 'members': [{'value': user_id} for user_id in user_ids],
+                'urn:okta:custom:group:1.0': {'description': 'test'}}, init_type='scim')
+            group_id = backend.create_group(scim_group).id
+            since = datetime.now().isoformat()
+            db.session.expunge_all()
+            # the members are deleted and journaled without being loaded
+            statement_count = count_statements(db.engine, lambda: backend.delete_group(group_id))
+            self.assertIsNone(backend.get_group(group_id))
+        logger.info('delete_group with %i members: %i statements' % (len(user_ids), statement_count))
+        self.assertLessEqual(statement_count, 5)
+        # every former member shows up in the incremental user import
+        response = get(BASE_URL + '/Users?filter=meta.lastModified gt "%s"' % since, verify=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['totalResults'], len(user_ids))
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,13 +1,15 @@
 import requests
 from logging import DEBUG
-from unittest import TestCase, main
+from unittest import TestCase, main, skipUnless
 
 from SCIM.helpers import set_up_logger
-from SCIM.tests.common import BASE_URL, TestHelper
+from SCIM.tests.common import BASE_URL, LOCAL_DEPLOYMENT, TestHelper, count_statements
 
 logger = set_up_logger(__name__, level=DEBUG)
 
 ENDPOINT_URI = '/Groups'
+# the Sales group in SCIM/examples/group-membership.csv has 4 members
+MULTI_MEMBER_GROUP_ID = '312EB3D5-C1CE-F499-51D1-4EF1B417CA80'
 
 test_helper = TestHelper(ENDPOINT_URI, logger)
 
@@ -26,6 +28,68 @@ class ReadGroupsTests(TestCase):
         logger.info('%i Groups returned from Connector' % len(response.json()['Resources']))
         self.assertEqual(len(response.json()['Resources']), 5)
 
+    def test_get_group_with_multiple_members(self) -> None:
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + '/' + MULTI_MEMBER_GROUP_ID
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        members = response.json()['Resources'][0]['members']
+        logger.info('%i Members returned from Connector' % len(members))
+        self.assertIsInstance(members, list)
+        self.assertEqual(len(members), 4)
+
+    def test_list_groups_or_filter(self) -> None:
+        filter = '?filter=displayName eq "Sales" or displayName eq "HR"'
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + filter
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(group['id'] for group in response.json()['Resources']), sorted([MULTI_MEMBER_GROUP_ID, '36E1EAD6-39DB-5084-29CD-D5FE9B3E28F4']))
+        self.assertEqual(sorted(group['displayName'] for group in response.json()['Resources']), ['HR', 'Sales'])
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'SQL statements can only be counted against the local example database')
+    def test_list_groups_query_count(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.implementation.database.groups.DBGroupsBackend import DBGroupsBackend
+        backend = DBGroupsBackend()
+        with app.app_context():
+            # start each count with an empty identity map so nothing is already loaded
+            db.session.expunge_all()
+            lazy_count = count_statements(db.engine, lambda: backend.list_groups(load_strategy='lazy'))
+            db.session.expunge_all()
+            selectin_count = count_statements(db.engine, lambda: backend.list_groups(load_strategy='selectin'))
+        logger.info('lazy: %i statements, selectin: %i statements' % (lazy_count, selectin_count))
+        # the groups, their associations and the associated objects no matter how many groups there are
+        self.assertLessEqual(selectin_count, 3)
+        self.assertGreater(lazy_count, selectin_count)
+
+    def test_list_groups_excluded_members(self) -> None:
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + '?excludedAttributes=members'
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(response.json()['Resources']), 0)
+        for group in response.json()['Resources']:
+            self.assertNotIn('members', group)
+            self.assertIn('displayName', group)
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'SQL statements can only be counted against the local example database')
+    def test_list_groups_projection_query_count(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.generic.Projection import Projection
+        from SCIM.classes.implementation.database.groups.DBGroupsBackend import DBGroupsBackend
+        backend = DBGroupsBackend()
+        with app.app_context():
+            db.session.expunge_all()
+            groups = []
+            statement_count = count_statements(db.engine, lambda: groups.extend(backend.list_groups(projection=Projection(excluded_attributes='members'))))
+        # only the groups, the memberships are not loaded
+        self.assertEqual(statement_count, 1)
+        self.assertGreater(len(groups), 0)
+        self.assertTrue(all(group.members == [] for group in groups))
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,12 +1,17 @@
+import asyncio
+import requests
+from json import load
+from datetime import datetime
 from logging import DEBUG
-from unittest import TestCase, main
+from unittest import TestCase, main, skipUnless
 
 from SCIM.helpers import set_up_logger
-from SCIM.tests.common import TestHelper
+from SCIM.tests.common import BASE_URL, GET_ID, LOCAL_DEPLOYMENT, TestHelper, count_statements
 
 logger = set_up_logger(__name__, level=DEBUG)
 
 ENDPOINT_URI = '/Groups'
+MULTI_MEMBER_GROUP_ID = '312EB3D5-C1CE-F499-51D1-4EF1B417CA80'
 
 test_helper = TestHelper(ENDPOINT_URI, logger)
 
@@ -21,5 +26,159 @@ class UpdateGroupTests(TestCase):
         self.assertEqual(response.json()['diplayName'], 'AppGroup-Changed')
         logger.info('Group Name has been changed')
 
+    @skipUnless(LOCAL_DEPLOYMENT, 'the lastModified filter is compared against the connector\'s clock')
+    def test_membership_change_in_incremental_import(self) -> None:
+        with open('../data/updateGroup.json', 'r') as data_file:
+            test_data = load(data_file)
+        group_url = BASE_URL.strip('/') + ENDPOINT_URI + '/' + test_data['id']
+        response = requests.get(group_url, verify=False)
+        self.assertEqual(response.status_code, 200)
+        old_members = set(member['value'] for member in response.json()['Resources'][0].get('members', []))
+        new_members = set(member['value'] for member in test_data['members'])
+
+        since = datetime.now().isoformat()
+        response = requests.put(group_url, json=test_data, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+
+        # the users added to and removed from the group show up in the incremental user import
+        test_filter = '?filter=meta.lastModified gt \"%s\"' % since
+        response = requests.get(BASE_URL.strip('/') + '/Users' + test_filter, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        changed_users = set(user['id'] for user in response.json().get('Resources', []))
+        self.assertEqual(changed_users, old_members ^ new_members)
+        # and so does the group
+        response = requests.get(BASE_URL.strip('/') + ENDPOINT_URI + test_filter, verify=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([group['id'] for group in response.json()['Resources']], [test_data['id']])
+
+    def test_patch_group_members(self) -> None:
+        with open('../data/updateGroup.json', 'r') as data_file:
+            test_data = load(data_file)
+        group_url = BASE_URL.strip('/') + ENDPOINT_URI + '/' + test_data['id']
+        response = requests.get(group_url, verify=False)
+        self.assertEqual(response.status_code, 200)
+        old_members = set(member['value'] for member in response.json()['Resources'][0].get('members', []))
+        added_member = GET_ID if GET_ID not in old_members else None
+        removed_member = next(iter(old_members - {GET_ID}), None)
+
+        operations = []
+        if added_member is not None:
+            operations.append({'op': 'add', 'path': 'members', 'value': [{'value': added_member}]})
+        if removed_member is not None:
+            operations.append({'op': 'remove', 'path': 'members[value eq "%s"]' % removed_member})
+        patch = {'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': operations}
+        response = requests.patch(group_url, json=patch, verify=False)
+        if response.status_code != 204: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 204)
+
+        # only the patched members changed
+        response = requests.get(group_url, verify=False)
+        new_members = set(member['value'] for member in response.json()['Resources'][0].get('members', []))
+        self.assertEqual(new_members, (old_members | {added_member}) - {removed_member, None})
+        logger.info('Group members patched')
+
+    def test_patch_group_display_name_case_insensitive(self) -> None:
+        group_url = BASE_URL.strip('/') + ENDPOINT_URI + '/' + MULTI_MEMBER_GROUP_ID
+        old_name = requests.get(group_url, verify=False).json()['Resources'][0]['displayName']
+        for name in ['Sales-Patched', old_name]:
+            patch = {'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': [{'op': 'replace', 'path': 'displayname', 'value': name}]}
+            response = requests.patch(group_url, json=patch, verify=False)
+            if response.status_code != 204: logger.error('Response from Connector: %s' % str(response.json()))
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(requests.get(group_url, verify=False).json()['Resources'][0]['displayName'], name)
+
+    def test_update_group_if_match(self) -> None:
+        with open('../data/updateGroup.json', 'r') as data_file:
+            test_data = load(data_file)
+        group_url = BASE_URL.strip('/') + ENDPOINT_URI + '/' + test_data['id']
+        user_url = BASE_URL.strip('/') + '/Users/' + GET_ID
+        response = requests.get(group_url, verify=False)
+        group_etag = response.headers.get('ETag')
+        if group_etag is None: self.skipTest('the connector does not send ETags')
+        is_member = GET_ID in [member['value'] for member in response.json()['Resources'][0].get('members', [])]
+        user_etag = requests.get(user_url, verify=False).headers.get('ETag')
+
+        # a write with the current ETag goes through and changes it
+        patch = {'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': [{'op': 'remove' if is_member else 'add', 'path': 'members', 'value': [{'value': GET_ID}]}]}
+        response = requests.patch(group_url, json=patch, headers={'If-Match': group_etag}, verify=False)
+        self.assertEqual(response.status_code, 204)
+        self.assertNotEqual(response.headers.get('ETag'), group_etag)
+        # a write based on the old version is rejected
+        response = requests.patch(group_url, json=patch, headers={'If-Match': group_etag}, verify=False)
+        self.assertEqual(response.status_code, 412)
+        # the member's groups changed as well
+        response = requests.get(user_url, headers={'If-None-Match': user_etag}, verify=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(test_data['id'] in [group['value'] for group in response.json()['Resources'][0].get('groups', [])], not is_member)
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'SQL statements can only be counted against the local example database')
+    def test_update_group_statement_count(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.generic.SCIMGroup import SCIMGroup
+        from SCIM.classes.implementation.database.groups.DBGroupsBackend import DBGroupsBackend
+        backend = DBGroupsBackend()
+        with open('../data/updateGroup.json', 'r') as data_file:
+            test_data = load(data_file)
+        with app.app_context():
+            old_members = backend.get_group(test_data['id']).members
+            # swap every member for one other user, the added and removed members are one bulk statement each
+            scim_group = SCIMGroup(test_data, init_type='scim')
+            scim_group.members = [{'value': GET_ID}] if {'value': GET_ID} not in old_members else []
+            db.session.expunge_all()
+            statement_count = count_statements(db.engine, lambda: backend.update_group(scim_group))
+            self.assertEqual([member['value'] for member in backend.get_group(test_data['id']).members], [member['value'] for member in scim_group.members])
+            # put the old members back
+            backend.update_group(SCIMGroup(dict(test_data, members=old_members), init_type='scim'))
+        logger.info('update_group: %i statements' % statement_count)
+        self.assertLessEqual(statement_count, 9)
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'the backend can only be called directly against the local example database')
+    def test_async_backend_concurrent_patches(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app
+        from SCIM.classes.generic.Patch import GroupPatch
+        from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend
+        from SCIM.classes.implementation.database.groups.AsyncDBGroupsBackend import AsyncDBGroupsBackend
+        backend = AsyncDBGroupsBackend()
+        with app.app_context():
+            user_ids = [user.id for user in DBUsersBackend().list_users()]
+        patch = lambda op, user_id: GroupPatch({'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': [{'op': op, 'path': 'members', 'value': [{'value': user_id}]}]})
+
+        async def concurrent_patches():
+            old_members = {member['value'] for member in (await backend.get_group(MULTI_MEMBER_GROUP_ID)).members}
+            new_ids = [user_id for user_id in user_ids if user_id not in old_members]
+            # each patch is its own session and transaction, they all commit
+            results = await asyncio.gather(*[backend.patch_group(MULTI_MEMBER_GROUP_ID, patch('add', user_id)) for user_id in new_ids])
+            added_members = {member['value'] for member in (await backend.get_group(MULTI_MEMBER_GROUP_ID)).members}
+            # a batch that raises rolls back every patch in it
+            with self.assertRaises(RuntimeError):
+                async with backend.batch():
+                    await asyncio.gather(*[backend.patch_group(MULTI_MEMBER_GROUP_ID, patch('remove', user_id)) for user_id in new_ids])
+                    raise RuntimeError
+            rolled_back_members = {member['value'] for member in (await backend.get_group(MULTI_MEMBER_GROUP_ID)).members}
+            # put the old members back
+            await asyncio.gather(*[backend.patch_group(MULTI_MEMBER_GROUP_ID, patch('remove', user_id)) for user_id in new_ids])
+            restored_members = {member['value'] for member in (await backend.get_group(MULTI_MEMBER_GROUP_ID)).members}
+            return old_members, new_ids, results, added_members, rolled_back_members, restored_members
+        old_members, new_ids, results, added_members, rolled_back_members, restored_members = asyncio.run(concurrent_patches())
+
+        self.assertGreater(len(new_ids), 1)
+        self.assertEqual(results, [True] * len(new_ids))
+        self.assertEqual(added_members, old_members | set(new_ids))
+        self.assertEqual(rolled_back_members, added_members)
+        self.assertEqual(restored_members, old_members)
+
+    def test_patch_missing_group(self) -> None:
+        patch = {'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': [{'op': 'replace', 'value': {'displayName': 'Missing'}}]}
+        response = requests.patch(BASE_URL.strip('/') + ENDPOINT_URI + '/00000000-0000-0000-0000-000000000000', json=patch, verify=False)
+        self.assertEqual(response.status_code, 404)
+        # unsupported operations are a validation error
+        patch['Operations'] = [{'op': 'move', 'path': 'members'}]
+        response = requests.patch(BASE_URL.strip('/') + ENDPOINT_URI + '/00000000-0000-0000-0000-000000000000', json=patch, verify=False)
+        self.assertEqual(response.status_code, 400)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
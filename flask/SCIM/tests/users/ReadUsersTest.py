@@ -1,10 +1,12 @@
+import asyncio
 import requests
 from logging import DEBUG
-from unittest import TestCase, main
+from unittest import TestCase, main, skipUnless
 from os.path import isfile
+from concurrent.futures import ThreadPoolExecutor
 
 from SCIM.helpers import set_up_logger
-from SCIM.tests.common import BASE_URL, GET_ID, CACHE_DIR, LOCAL_DEPLOYMENT, TestHelper
+from SCIM.tests.common import BASE_URL, GET_ID, CACHE_DIR, LOCAL_DEPLOYMENT, TestHelper, count_statements
 
 logger = set_up_logger(__name__, level=DEBUG)
 
@@ -42,6 +44,7 @@ class ReadUsersTests(TestCase):
             # cant check if these files exist when not running locally
             if LOCAL_DEPLOYMENT:
                 self.assertTrue(isfile(CACHE_DIR + '/full_import_cache.json'))
+                self.assertTrue(isfile(CACHE_DIR + '/full_import_cache.json.idx'))
                 self.assertTrue(isfile(CACHE_DIR + '/full_import_cache.json.lock'))
             request_url = BASE_URL.strip('/') + '/Users?startIndex=%i&count=1&totalResults=%i' % (index, total_results)
             response = requests.get(request_url, verify=False)
@@ -52,6 +55,21 @@ class ReadUsersTests(TestCase):
         self.assertEqual(len(users), total_results)
         if LOCAL_DEPLOYMENT: self.assertFalse(isfile(CACHE_DIR + '/full_import_cache.json.lock'))
 
+    def test_concurrent_first_pages(self) -> None:
+        # concurrent imports starting at the same time share one snapshot instead of each building their own
+        request_url = BASE_URL.strip('/') + '/Users?startIndex=1&count=5'
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(lambda _: requests.get(request_url, verify=False), range(4)))
+        for response in responses:
+            if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()['Resources']), 5)
+        self.assertEqual(len(set(response.json()['totalResults'] for response in responses)), 1)
+        # every import holds its own lease on the shared snapshot
+        if LOCAL_DEPLOYMENT:
+            with open(CACHE_DIR + '/full_import_cache.json.lock') as lock_file:
+                self.assertEqual(len(lock_file.read().splitlines()), 4)
+
     def test_list_users_single_page(self) -> None:
         # do get all users with no params to get the total results
         request_url = BASE_URL.strip('/') + '/Users?startIndex=1&count=3'
@@ -74,6 +92,56 @@ class ReadUsersTests(TestCase):
         if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
         self.assertEqual(response.status_code, 200)
 
+    def test_get_single_user_etag(self) -> None:
+        request_url = BASE_URL.strip('/') + '/Users/' + GET_ID
+        response = requests.get(request_url, verify=False)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers.get('ETag')
+        if etag is None: self.skipTest('the connector does not send ETags')
+        self.assertTrue(etag.startswith('W/'))
+        # an unchanged user is not sent again
+        response = requests.get(request_url, headers={'If-None-Match': etag}, verify=False)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers.get('ETag'), etag)
+
+    def test_list_users_attributes(self) -> None:
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + '?attributes=userName,name.givenName'
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        for user in response.json()['Resources']:
+            self.assertLessEqual(set(user.keys()), {'id', 'schemas', 'userName', 'name'})
+            self.assertEqual(list(user['name'].keys()), ['givenName'])
+        # excluded attributes are left out of the whole user
+        response = requests.get(BASE_URL.strip('/') + ENDPOINT_URI + '/' + GET_ID + '?excludedAttributes=groups,emails', verify=False)
+        self.assertEqual(response.status_code, 200)
+        user = response.json()['Resources'][0]
+        self.assertNotIn('groups', user)
+        self.assertNotIn('emails', user)
+        self.assertIn('userName', user)
+
+    def test_pool_stats(self) -> None:
+        response = requests.get(BASE_URL.strip('/') + '/PoolStats', verify=False)
+        if response.status_code == 404: self.skipTest('the connector does not use the database backend')
+        self.assertEqual(response.status_code, 200)
+        for key in ['pid', 'checkouts', 'timeouts', 'averageWaitMs', 'maxWaitMs', 'pool']:
+            self.assertIn(key, response.json())
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'the pool is tested against an in memory database')
+    def test_pool_checkout_wait(self) -> None:
+        from sqlalchemy import create_engine
+        from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+        from SCIM.classes.implementation.database.pool import TimedQueuePool, checkout_stats
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+        before = checkout_stats.scim_resource
+        with engine.connect():
+            # the only connection is checked out, the next checkout waits pool_timeout and gives up
+            self.assertRaises(PoolTimeoutError, engine.connect)
+        after = checkout_stats.scim_resource
+        self.assertEqual(after['checkouts'] - before['checkouts'], 2)
+        self.assertEqual(after['timeouts'] - before['timeouts'], 1)
+        self.assertGreaterEqual(after['maxWaitMs'], 100)
+
     def test_list_users_lt_filter(self) -> None:
         filter = '?filter=number lt 4'
         request_url = BASE_URL.strip('/') + ENDPOINT_URI + filter
@@ -102,6 +170,64 @@ class ReadUsersTests(TestCase):
         logger.info('%i Users returned from Connector' % len(response.json()['Resources']))
         self.assertEqual(len(response.json()['Resources']), 17)
 
+    def test_list_users_username_filter(self) -> None:
+        # userName matching is case insensitive
+        filter = '?filter=userName eq "VULPUTATE.DUI.NEC@yahoo.couk"'
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + filter
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user['id'] for user in response.json()['Resources']], [GET_ID])
+        # a short first page is counted from the page itself
+        self.assertEqual(response.json()['totalResults'], 1)
+
+    def test_list_users_full_first_page_total(self) -> None:
+        # a full first page may have more users after it, so they are counted
+        filter = '?filter=number gt 5&count=5'
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + filter
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['Resources']), 5)
+        self.assertEqual(response.json()['totalResults'], 17)
+
+    def test_list_users_compound_filter(self) -> None:
+        filter = '?filter=number gt 5 and (active eq true or userName sw "VUL")'
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + filter
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        logger.info('%i Users returned from Connector' % len(response.json()['Resources']))
+        self.assertEqual(len(response.json()['Resources']), 9)
+
+    def test_list_users_not_filter(self) -> None:
+        filter = '?filter=not (active eq true) and number pr'
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + filter
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        logger.info('%i Users returned from Connector' % len(response.json()['Resources']))
+        self.assertEqual(len(response.json()['Resources']), 10)
+
+    def test_list_users_invalid_filter(self) -> None:
+        for filter in ['?filter=number gt 5 and', '?filter=(number gt 5', '?filter=number xx 5', '?filter=city eq "Edremit"']:
+            request_url = BASE_URL.strip('/') + ENDPOINT_URI + filter
+            response = requests.get(request_url, verify=False)
+            self.assertEqual(response.status_code, 400)
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'query plans can only be checked against the local example database')
+    def test_username_filter_uses_index(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.implementation.database.models import UsersDB
+        from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend
+        with app.app_context():
+            query = DBUsersBackend().filter_query(UsersDB.query, 'userName eq "vulputate.dui.nec@yahoo.couk"')
+            statement = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+            plan = db.session.execute('EXPLAIN QUERY PLAN %s' % statement).fetchall()
+        logger.info('Query plan: %s' % plan)
+        self.assertIn('ix_users_email_lower', str(plan))
+
     def test_incremental_import(self) -> None:
         test_filter = '?filter=meta.lastModified gt \"2021-05-07T14:19:34Z\"'
         request_url = BASE_URL.strip('/') + ENDPOINT_URI + test_filter
@@ -136,5 +262,121 @@ class ReadUsersTests(TestCase):
         self.assertEqual(len(users), total_results)
         if LOCAL_DEPLOYMENT: self.assertFalse(isfile(CACHE_DIR + '/incremental_import_cache.json.lock'))
 
+    @skipUnless(LOCAL_DEPLOYMENT, 'the change journal can only be read directly from the local example database')
+    def test_change_journal_prune(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from datetime import datetime, timedelta
+        from SCIM import app, db
+        from SCIM.classes.implementation.database.models import ChangeJournal
+        now = datetime.now()
+        with app.app_context():
+            db.session.execute(ChangeJournal.__table__.insert(), [
+                {'resource_type': 'User', 'resource_id': 'pruned', 'changed': now - timedelta(days=2)},
+                {'resource_type': 'User', 'resource_id': 'kept', 'changed': now}
+            ])
+            db.session.commit()
+            ChangeJournal.prune(now - timedelta(days=1))
+            remaining = {resource_id for (resource_id,) in db.session.query(ChangeJournal.resource_id).filter(ChangeJournal.resource_id.in_(['pruned', 'kept']))}
+            # the journal still covers filters newer than the cutoff, but no longer the ones older than it
+            journal_covers_since = ChangeJournal.changed_since('User', now) is not None
+            journal_covers_pruned = ChangeJournal.changed_since('User', now - timedelta(days=2)) is not None
+            ChangeJournal.query.filter(ChangeJournal.resource_id == 'kept').delete()
+            db.session.commit()
+        self.assertEqual(remaining, {'kept'})
+        self.assertTrue(journal_covers_since)
+        self.assertFalse(journal_covers_pruned)
+
+    def test_list_users_filter_page(self) -> None:
+        filter = '?filter=number gt 5&startIndex=2&count=5'
+        request_url = BASE_URL.strip('/') + ENDPOINT_URI + filter
+        response = requests.get(request_url, verify=False)
+        if response.status_code != 200: logger.error('Response from Connector: %s' % str(response.json()))
+        self.assertEqual(response.status_code, 200)
+        logger.info('%i Users returned from Connector' % len(response.json()['Resources']))
+        self.assertEqual(len(response.json()['Resources']), 5)
+        self.assertEqual(response.json()['totalResults'], 17)
+        self.assertEqual(response.json()['startIndex'], 2)
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'the backend can only be called directly against the local example database')
+    def test_list_users_keyset_page(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app
+        from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend
+        backend = DBUsersBackend()
+        with app.app_context():
+            first_page = backend.list_users(count=5)
+            offset_page = backend.list_users(start_index=6, count=5)
+            keyset_page = backend.list_users(after_id=first_page[-1].id, count=5)
+            total = backend.count_users()
+            all_users = backend.list_users()
+        self.assertEqual(total, len(all_users))
+        self.assertEqual([user.id for user in keyset_page], [user.id for user in offset_page])
+        self.assertNotIn(first_page[-1].id, [user.id for user in keyset_page])
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'SQL statements can only be counted against the local example database')
+    def test_list_users_query_count(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend
+        backend = DBUsersBackend()
+        with app.app_context():
+            # start each count with an empty identity map so nothing is already loaded
+            db.session.expunge_all()
+            lazy_count = count_statements(db.engine, lambda: backend.list_users(load_strategy='lazy'))
+            db.session.expunge_all()
+            selectin_count = count_statements(db.engine, lambda: backend.list_users(load_strategy='selectin'))
+        logger.info('lazy: %i statements, selectin: %i statements' % (lazy_count, selectin_count))
+        # the users, their associations and the associated objects no matter how many users there are
+        self.assertLessEqual(selectin_count, 3)
+        self.assertGreater(lazy_count, selectin_count)
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'SQL statements can only be counted against the local example database')
+    def test_list_user_resources(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend
+        backend = DBUsersBackend()
+        # the groups are in no particular order
+        sort_groups = lambda resource: dict(resource, groups=sorted(resource.get('groups', []), key=lambda group: group['value']))
+        with app.app_context():
+            expected = [sort_groups(user.scim_resource) for user in backend.list_users()]
+            db.session.expunge_all()
+            resources = []
+            statement_count = count_statements(db.engine, lambda: resources.extend(backend.list_user_resources()))
+            # the users are never loaded as UsersDB objects
+            self.assertEqual(len(db.session.identity_map), 0)
+        # the users and their groups in one statement, the same resources as the ORM path
+        self.assertEqual(statement_count, 1)
+        self.assertEqual([sort_groups(resource) for resource in resources], expected)
+        self.assertTrue(any('groups' in resource for resource in resources))
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'the backend can only be called directly against the local example database')
+    def test_async_backend_concurrent_calls(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app
+        from SCIM.classes.implementation.database.users.DBUsersBackend import DBUsersBackend
+        from SCIM.classes.implementation.database.users.AsyncDBUsersBackend import AsyncDBUsersBackend
+        backend = AsyncDBUsersBackend()
+        with app.app_context():
+            expected_users = DBUsersBackend().list_users()
+        expected_resources = {user.id: user.scim_resource for user in expected_users}
+        filter = 'userName eq "%s"' % expected_users[0].userName
+
+        # every call is in flight at the same time on the one event loop, each in its own session
+        async def concurrent_calls():
+            gets = asyncio.gather(*[backend.get_user(user.id) for user in expected_users for _ in range(5)])
+            lists = asyncio.gather(*[backend.list_user_resources(start_index=start_index, count=5) for start_index in range(1, len(expected_users) + 1)])
+            counts = asyncio.gather(*[backend.count_users(filter=filter) for _ in range(20)])
+            return await asyncio.gather(gets, lists, counts)
+        users, pages, counts = asyncio.run(concurrent_calls())
+
+        self.assertEqual(len(users), len(expected_users) * 5)
+        for user in users:
+            self.assertEqual(user.scim_resource, expected_resources[user.id])
+        for start_index, page in enumerate(pages, 1):
+            self.assertEqual([resource['id'] for resource in page], [user.id for user in expected_users[start_index - 1:start_index + 4]])
+        self.assertEqual(counts, [1] * 20)
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
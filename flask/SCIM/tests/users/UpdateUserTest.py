@@ -1,8 +1,11 @@
+import requests
 from logging import DEBUG
-from unittest import TestCase, TestSuite, TextTestRunner
+from unittest import mock
+from tempfile import TemporaryDirectory
+from unittest import TestCase, TestSuite, TextTestRunner, skipUnless
 
 from SCIM.helpers import set_up_logger
-from SCIM.tests.common import TestHelper
+from SCIM.tests.common import TestHelper, BASE_URL, GET_ID, LOCAL_DEPLOYMENT, count_statements
 
 logger = set_up_logger(__name__, level=DEBUG)
 
@@ -32,6 +35,78 @@ class UpdateUserTests(TestCase):
         self.assertEqual(response.json()['name']['familyName'], 'Ruiz1')
         logger.info('User attributes updated successfully')
 
+    def test_patch_deactivate_user(self) -> None:
+        user_url = BASE_URL.strip('/') + '/Users/' + GET_ID
+        for active in [False, True]:
+            patch = {'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': [{'op': 'replace', 'value': {'active': active}}]}
+            response = requests.patch(user_url, json=patch, verify=False)
+            if response.status_code != 200:
+                logger.error('Response from Connector: %s' % str(response.json()))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['active'], active)
+        logger.info('User deactivated and reactivated with PATCH')
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'the resource cache can only be checked in process against the local example database')
+    def test_get_single_user_cache(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from SCIM import app, db
+        from SCIM.classes.generic.Cache import Cache
+        from SCIM.classes.generic.ResourceCache import ResourceCache, resource_cache
+        if not resource_cache.enabled: self.skipTest('the resource cache is disabled')
+        client = app.test_client()
+        user_path = '/Users/' + GET_ID
+        # the invalidation log goes in a temporary cache dir instead of the connector's
+        with TemporaryDirectory() as cache_dir, mock.patch.object(Cache, 'cache_base_dir', cache_dir):
+            # the cache of another worker process, they share invalidations through the log in the cache dir
+            other_process_cache = ResourceCache()
+            with mock.patch.object(resource_cache, 'log_file_path', other_process_cache.log_file_path):
+                with app.app_context():
+                    self.assertEqual(client.get(user_path).status_code, 200)
+                    # the repeated lookup never touches the database
+                    self.assertEqual(count_statements(db.engine, lambda: client.get(user_path)), 0)
+                active = client.get(user_path).get_json()['Resources'][0]['active']
+                other_process_cache.put('User', GET_ID, (b'{}', None), other_process_cache.position())
+                self.assertIsNotNone(other_process_cache.get('User', GET_ID))
+                # a write in one process invalidates the user cached by the others
+                patch = {'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': [{'op': 'replace', 'value': {'active': not active}}]}
+                self.assertEqual(client.patch(user_path, json=patch).status_code, 200)
+                self.assertIsNone(other_process_cache.get('User', GET_ID))
+                self.assertEqual(client.get(user_path).get_json()['Resources'][0]['active'], not active)
+                patch['Operations'][0]['value']['active'] = active
+                self.assertEqual(client.patch(user_path, json=patch).status_code, 200)
+                self.assertEqual(client.get(user_path).get_json()['Resources'][0]['active'], active)
+
+    @skipUnless(LOCAL_DEPLOYMENT, 'the replica routing can only be checked in process against the local example database')
+    def test_replica_read_your_writes(self) -> None:
+        # imported here so the app and its database are only set up for local deployments
+        from os import listdir
+        from SCIM import app
+        from SCIM.classes.generic.Cache import Cache
+        from SCIM.classes.implementation.database import routing
+        from SCIM.classes.implementation.database.transaction import replica_allowed
+        # the recent write markers go in a temporary cache dir instead of the connector's
+        with TemporaryDirectory() as cache_dir, mock.patch.object(Cache, 'cache_base_dir', cache_dir):
+            with app.test_request_context('/Users/' + GET_ID, method='GET', headers={'Authorization': 'Basic replica-test'}):
+                self.assertTrue(replica_allowed())
+                # the client's reads stay on the primary right after its write
+                routing.mark_recent_write()
+                self.assertFalse(replica_allowed())
+            # other clients are not affected
+            with app.test_request_context('/Users/' + GET_ID, method='GET', headers={'Authorization': 'Basic other-client'}):
+                self.assertTrue(replica_allowed())
+            # reads made by a write (ex: the If-Match check) always go to the primary
+            with app.test_request_context('/Users/' + GET_ID, method='PUT', headers={'Authorization': 'Basic other-client'}):
+                self.assertFalse(replica_allowed())
+                routing.mark_recent_write()
+            self.assertEqual(len(listdir(cache_dir)), 2)
+            with mock.patch.object(routing, 'READ_YOUR_WRITES_SEC', 0):
+                # an expired marker is deleted when its client reads again, the others by the sweep
+                with app.test_request_context('/Users/' + GET_ID, method='GET', headers={'Authorization': 'Basic replica-test'}):
+                    self.assertTrue(replica_allowed())
+                self.assertEqual(len(listdir(cache_dir)), 1)
+                routing.remove_expired_recent_writes()
+                self.assertEqual(listdir(cache_dir), [])
+
     def test_password_update(self) -> None:
         response = test_helper.put_file_contents('../data/pushPasswordUpdate.json')
         if response.status_code != 200:
@@ -1,7 +1,7 @@
 import sys, os
 from pathlib import Path
 
-from SCIM import app, LOCAL_DATABASE, config
+from SCIM import app, LOCAL_DATABASE, config, start_worker
 from SCIM.helpers import set_up_logger
 from SCIM.examples.populate_example_db import generate_example_database
 
@@ -29,4 +29,5 @@ if __name__ == '__main__':
                     for file in cache_files:
                         os.remove(os.path.join(cache_dir, file))
     
+    start_worker()
     app.run(host='127.0.0.1', port=5001)
\ No newline at end of file